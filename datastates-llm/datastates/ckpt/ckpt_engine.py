@@ -1,15 +1,24 @@
-from datastates.ckpt.src import handle as datastates_handle
 import torch
 import time
 import sys
 import os
 from datastates.utils import get_logger
+from .py_engine import PyCkptHandle
+
+try:
+    from datastates.ckpt.src import handle as datastates_handle
+except ImportError:
+    # The native engine is not built (or there is no CUDA): use the Python engine
+    datastates_handle = None
 
 # Acts as a Python Interfact to manage the CPP checkpoint engine
 class CkptEngine:
-    def __init__(self, host_cache_size, gpu_device_id, rank) -> None:
+    def __init__(self, host_cache_size, gpu_device_id, rank, copy_threads=1, flush_threads=1) -> None:
         try:
-            self.ckpt_engine = datastates_handle(host_cache_size, gpu_device_id, rank)
+            if datastates_handle is not None and torch.cuda.is_available():
+                self.ckpt_engine = datastates_handle(host_cache_size, gpu_device_id, rank, copy_threads, flush_threads)
+            else:
+                self.ckpt_engine = PyCkptHandle(host_cache_size, gpu_device_id, rank, copy_threads, flush_threads)
             self.logger = get_logger(__name__)
             self.last_ckpt_version = -1
         except Exception as exc:
@@ -70,5 +79,12 @@ class CkptEngine:
             self.logger.error(f"[DataStates.ckpt][ERROR] From wait, generated exception: {exc}")
             sys.exit(-1)
     
+    def wait_for_flush(self):
+        try:
+            self.ckpt_engine.wait_for_flush()
+        except Exception as exc:
+            self.logger.error(f"[DataStates.ckpt][ERROR] From wait_for_flush, generated exception: {exc}")
+            sys.exit(-1)
+
     def __del__(self):
         return self.ckpt_engine.shutdown()
\ No newline at end of file
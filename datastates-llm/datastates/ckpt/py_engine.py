@@ -0,0 +1,219 @@
+import os
+import queue
+import threading
+from collections import deque
+
+import numpy as np
+import torch
+
+# Regions larger than this are split so several flush threads write them in parallel
+FLUSH_PIECE_SIZE = 64 << 20
+
+
+class HostCachePool:
+    """
+    Circular allocator over one host buffer, pinned when CUDA is available.
+
+    Regions are handed out in order; they may be released in any order, but
+    their space is reclaimed in allocation order. `allocate` blocks until the
+    oldest regions have been written out and there is room.
+    """
+
+    def __init__(self, total_size):
+        self.total_size = total_size
+        self.buffer = torch.empty(total_size, dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+        self.array = self.buffer.numpy()
+        # (start, size) of live regions, oldest first
+        self.regions = deque()
+        # Starts of regions released before an older one
+        self.released = set()
+        self.cv = threading.Condition()
+        self.active = True
+
+    def _find(self, size):
+        if not self.regions:
+            return 0
+        tail = self.regions[0][0]
+        head = self.regions[-1][0] + self.regions[-1][1]
+        if self.regions[-1][0] >= tail:
+            # Live data is [tail, head): use the end of the buffer, else wrap to its start
+            if self.total_size - head >= size:
+                return head
+            if tail >= size:
+                return 0
+        elif tail - head >= size:
+            # Live data wraps around: the free space is [head, tail)
+            return head
+        return None
+
+    def allocate(self, size):
+        if size > self.total_size:
+            raise ValueError(f"cannot allocate {size} bytes from a host cache of {self.total_size}")
+        with self.cv:
+            while True:
+                if not self.active:
+                    return None
+                start = self._find(size)
+                if start is not None:
+                    self.regions.append((start, size))
+                    return start
+                self.cv.wait()
+
+    def deallocate(self, start, size):
+        with self.cv:
+            if (start, size) not in self.regions:
+                raise RuntimeError(f"{(start, size)} is not allocated from the host cache")
+            self.released.add(start)
+            while self.regions and self.regions[0][0] in self.released:
+                self.released.discard(self.regions.popleft()[0])
+            self.cv.notify_all()
+
+    def shutdown(self):
+        with self.cv:
+            self.active = False
+            self.cv.notify_all()
+
+
+class _Region:
+
+    def __init__(self, start, size, pieces):
+        self.start = start
+        self.size = size
+        self.pending = pieces
+        self.lock = threading.Lock()
+
+    def piece_done(self):
+        with self.lock:
+            self.pending -= 1
+            return self.pending == 0
+
+
+class PyCkptHandle:
+    """
+    Pure Python stand-in for the native engine handle, with the same interface.
+
+    `ckpt_tensor` copies the tensor into the host cache (device tensors on
+    one of `copy_threads` side streams, host tensors right away) and queues
+    the region for the `flush_threads` flush threads. Regions are split into
+    FLUSH_PIECE_SIZE pieces that are written at their own file offset in
+    `path`, so several threads share a large tensor; os.pwrite releases the
+    GIL. A region is freed once its last piece is written. `wait` returns
+    once every copy into the cache is done, so the tensors can be modified
+    again; `wait_for_flush` and `shutdown` also wait for the file writes.
+    """
+
+    def __init__(self, host_cache_size, gpu_device_id=-1, rank=-1, copy_threads=1, flush_threads=1):
+        self.rank = rank
+        self.pool = HostCachePool(host_cache_size)
+        self.use_cuda = torch.cuda.is_available() and gpu_device_id >= 0
+        self.streams = [torch.cuda.Stream(device=gpu_device_id) for _ in range(copy_threads)] if self.use_cuda else []
+        self.next_stream = 0
+        # Events of device-to-host copies not waited on yet
+        self.copies = []
+        self.flush_q = queue.Queue()
+        self.error = None
+        self.is_active = True
+        self.flush_threads = [
+            threading.Thread(target=self._flush_io, name=f"datastates-flush-{i}", daemon=True)
+            for i in range(flush_threads)
+        ]
+        for thread in self.flush_threads:
+            thread.start()
+
+    def ckpt_tensor(self, version, tensor, size, file_offset, path):
+        if size == 0:
+            return
+        start = self.pool.allocate(size)
+        if start is None:
+            return
+        dest = self.pool.buffer[start:start + size]
+        src = tensor.detach().reshape(-1).view(torch.uint8)
+        event = None
+        if tensor.device.type == 'cuda':
+            stream = self.streams[self.next_stream]
+            self.next_stream = (self.next_stream + 1) % len(self.streams)
+            stream.wait_stream(torch.cuda.current_stream(tensor.device))
+            with torch.cuda.stream(stream):
+                dest.copy_(src, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(stream)
+            self.copies.append(event)
+        else:
+            dest.copy_(src)
+        pieces = range(0, size, FLUSH_PIECE_SIZE) if len(self.flush_threads) > 1 else [0]
+        region = _Region(start, size, len(pieces))
+        for offset in pieces:
+            nbytes = min(FLUSH_PIECE_SIZE, size - offset) if len(self.flush_threads) > 1 else size
+            self.flush_q.put((region, offset, nbytes, file_offset + offset, path, event))
+
+    def restore_tensor(self, version, tensor, size, file_offset, path):
+        with open(path, 'rb', buffering=0) as f:
+            f.seek(file_offset)
+            if tensor.device.type == 'cpu':
+                view = memoryview(tensor.reshape(-1).view(torch.uint8).numpy())
+            else:
+                host = np.empty(size, dtype=np.uint8)
+                view = memoryview(host)
+            read = 0
+            while read < size:
+                n = f.readinto(view[read:])
+                if not n:
+                    raise RuntimeError(f"{path} is truncated at {file_offset + read}")
+                read += n
+        if tensor.device.type != 'cpu':
+            tensor.reshape(-1).view(torch.uint8).copy_(torch.from_numpy(host))
+
+    def _flush_io(self):
+        fds = {}
+        while True:
+            item = self.flush_q.get()
+            if item is None:
+                self.flush_q.task_done()
+                break
+            region, offset, size, file_offset, path, event = item
+            try:
+                if event is not None:
+                    event.synchronize()
+                if path not in fds:
+                    fds[path] = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+                start = region.start + offset
+                view = memoryview(self.pool.array[start:start + size])
+                written = 0
+                while written < size:
+                    written += os.pwrite(fds[path], view[written:], file_offset + written)
+            except Exception as exc:
+                self.error = exc
+            finally:
+                if region.piece_done():
+                    self.pool.deallocate(region.start, region.size)
+                self.flush_q.task_done()
+            if self.flush_q.empty():
+                # Reopen per checkpoint, a later one may replace the file
+                for fd in fds.values():
+                    os.close(fd)
+                fds = {}
+        for fd in fds.values():
+            os.close(fd)
+
+    def wait(self):
+        for event in self.copies:
+            event.synchronize()
+        self.copies = []
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def wait_for_flush(self):
+        self.flush_q.join()
+        self.wait()
+
+    def shutdown(self):
+        if not self.is_active:
+            return
+        self.is_active = False
+        self.wait_for_flush()
+        for _ in self.flush_threads:
+            self.flush_q.put(None)
+        for thread in self.flush_threads:
+            thread.join()
+        self.pool.shutdown()
@@ -13,6 +13,7 @@ class atomic_queue_t {
     std::mutex mtx;
     std::condition_variable cv;
     std::atomic<bool> is_active = true;
+    size_t in_flight = 0;       // Items taken by a consumer but not done yet
 public:
     atomic_queue_t() {};
     ~atomic_queue_t() {};
@@ -35,9 +36,27 @@ public:
         lck.unlock();
         cv.notify_all();
     };
+    // For several consumers: remove the front item (nullptr once inactive); call done() when finished with it
+    mem_region_t* take() {
+        std::unique_lock<std::mutex> lck(mtx);
+        while(q.empty() && is_active)
+            cv.wait(lck);
+        if (!is_active)
+            return nullptr;
+        mem_region_t* e = q.front();
+        q.pop_front();
+        in_flight++;
+        return e;
+    };
+    void done() {
+        std::unique_lock<std::mutex> lck(mtx);
+        in_flight--;
+        lck.unlock();
+        cv.notify_all();
+    };
     void wait_for_completion() {
         std::unique_lock<std::mutex> lck(mtx);
-        while(q.size() > 0)
+        while(q.size() > 0 || in_flight > 0)
             cv.wait(lck);
         lck.unlock();
         cv.notify_all();
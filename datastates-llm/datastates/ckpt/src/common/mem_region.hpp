@@ -3,6 +3,8 @@
 #include <iostream>
 #include <limits.h>
 #include <deque>
+#include <atomic>
+#include <string>
 #include "defs.hpp"
 
 
@@ -14,10 +16,14 @@ struct mem_region_t {
     const size_t        file_start_offset;  // Start offset in file
     const std::string   path;               // Pathname of the checkpoint file.
     TIER_TYPES          curr_tier_type;     // Memory/cache tier on which it currently resides
+    mem_region_t*       parent = nullptr;   // Region this is a piece of, if any
+    std::atomic<size_t> pending_pieces{0};  // Pieces of this region not written yet
     mem_region_t(const int version_, const uint64_t uid_, char* const ptr_, 
         const size_t size_, const size_t file_start_offset_, const std::string path_, TIER_TYPES tier): 
         version(version_), uid(uid_), ptr(ptr_), size(size_), file_start_offset(file_start_offset_), path(path_), curr_tier_type(tier) {};
     mem_region_t(const mem_region_t* other, TIER_TYPES next_tier): version(other->version), uid(other->uid), ptr(nullptr), size(other->size), file_start_offset(other->file_start_offset), path(other->path), curr_tier_type(next_tier) {};
+    // The piece [offset, offset+size_) of `other`, at the matching file offset
+    mem_region_t(mem_region_t* other, const size_t offset, const size_t size_): version(other->version), uid(other->uid), ptr(other->ptr + offset), size(size_), file_start_offset(other->file_start_offset + offset), path(other->path), curr_tier_type(other->curr_tier_type), parent(other) {};
     mem_region_t& operator=(const mem_region_t&) = delete;
 };
 
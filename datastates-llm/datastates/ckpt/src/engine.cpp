@@ -1,14 +1,14 @@
 #include "engine.hpp"
 
-datastates_llm_t::datastates_llm_t(size_t host_cache_size, int gpu_id_, int rank_): gpu_id(gpu_id_), rank(rank_) {
+datastates_llm_t::datastates_llm_t(size_t host_cache_size, int gpu_id_, int rank_, unsigned int copy_threads, unsigned int flush_threads): gpu_id(gpu_id_), rank(rank_) {
     try {
-        DBG("DataStates initing: GPU: " << gpu_id << ", host cache (MB): " << (host_cache_size >> 20));
+        DBG("DataStates initing: GPU: " << gpu_id << ", host cache (MB): " << (host_cache_size >> 20) << ", copy threads: " << copy_threads << ", flush threads: " << flush_threads);
         checkCuda(cudaSetDevice(gpu_id));
         is_active = true;
-        int num_threads = 1;    // For initial prototype, set number of threads=1
         size_t gpu_cache = 0;   // For initial prototype, assume no GPU memory available for checkpointing.
-        host_tier = new host_tier_t(gpu_id, num_threads, host_cache_size);
-        gpu_tier = new gpu_tier_t(gpu_id, num_threads, gpu_cache);
+        // Device-to-host copies and file writes each get their own pool of threads
+        host_tier = new host_tier_t(gpu_id, flush_threads, host_cache_size);
+        gpu_tier = new gpu_tier_t(gpu_id, copy_threads, gpu_cache);
         gpu_tier->set_successor_tier(host_tier);
         
     } catch(std::exception& e) {
@@ -37,7 +37,8 @@ void datastates_llm_t::ckpt_tensor(int version, const torch::Tensor &t, const st
         //       << std::endl;
 
         mem_region_t* m = new mem_region_t(version, uid, static_cast<char *>(t.data_ptr()), size, file_offset, path, HOST_PINNED_TIER);
-        host_tier->flush(m);
+        host_tier->stage(m);
+        delete m;
 
         return;
     } catch (std::exception &e) {
@@ -53,6 +54,8 @@ void datastates_llm_t::restore_tensor(int version, const torch::Tensor &t, const
         DBG("Going to restore from " << path << " tensor of size " << size << " at file offset " << file_offset);
         mem_region_t* m = new mem_region_t(version, uid, static_cast<char *>(t.data_ptr()), size, file_offset, path, HOST_PINNED_TIER);
         host_tier->fetch(m);
+        // The tensor is only usable once its bytes are in
+        host_tier->wait_for_fetch();
         return;
     } catch (std::exception &e) {
         FATAL("Exception caught in ckpt_tensor." << e.what());
@@ -61,14 +64,29 @@ void datastates_llm_t::restore_tensor(int version, const torch::Tensor &t, const
 
 void datastates_llm_t::wait() {
     try {
+        // Once the GPU regions are in the host cache the tensors can be modified; file writes continue
         gpu_tier->wait_for_completion();
     }  catch (std::exception &e) {
         FATAL("Exception caught in wait D2H." << e.what());
     }
 }
 
+void datastates_llm_t::wait_for_flush() {
+    try {
+        gpu_tier->wait_for_completion();
+        host_tier->wait_for_completion();
+    }  catch (std::exception &e) {
+        FATAL("Exception caught in wait for flush." << e.what());
+    }
+}
+
 void datastates_llm_t::shutdown() {
     try {
+        if (!is_active)
+            return;
+        is_active = false;
+        gpu_tier->wait_for_completion();
+        host_tier->wait_for_completion();
         delete gpu_tier;
         delete host_tier;
         return;
@@ -3,9 +3,12 @@
 mem_pool_t::mem_pool_t(char* start_ptr, size_t total_size, int rank): start_ptr_(start_ptr), 
     total_size_(total_size), rank_(rank) {
     try {
-        cudaPointerAttributes attributes;
-        checkCuda(cudaPointerGetAttributes (&attributes, start_ptr_));
-        device_type_ = attributes.type;
+        // An empty pool (e.g. no GPU cache memory) has no allocation to query
+        if (start_ptr_ != nullptr) {
+            cudaPointerAttributes attributes;
+            checkCuda(cudaPointerGetAttributes (&attributes, start_ptr_));
+            device_type_ = attributes.type;
+        }
         is_active = true;
         DBG("Returned from the memory pool function");
     } catch (std::exception &e) {
@@ -38,11 +41,11 @@ void mem_pool_t::assign_(mem_region_t* m) {
             FATAL("Exception in assign: exceeding total memory size");
         m->ptr = start_ptr_ + head_;
         head_ += m->size;
-        if (head_ > total_size_)
+        if (head_ >= total_size_)
             head_ = 0;
         curr_size_ += m->size;
         alloc_map_[m->uid] = m->size;
-        mem_q_.push_back(m);
+        mem_q_.push_back({m->uid, static_cast<size_t>(m->ptr - start_ptr_), m->size});
         DBG("[" << rank_ << "]" << "Assigned " << m->uid << " of size " << m->size << " curr size " << curr_size_ << " cur head " << head_  << " cur tail " << tail_);
     } catch (std::exception &e) {
         FATAL("Exception caught in assign_." << e.what());
@@ -100,29 +103,30 @@ void mem_pool_t::allocate(mem_region_t* m) {
 
 void mem_pool_t::deallocate(mem_region_t* m) {
     try {
-        if (get_capacity() <= 0 || alloc_map_.find(m->uid) == alloc_map_.end())
+        if (get_capacity() <= 0 || m->uid < 1)
             return;
-        if (mem_q_.empty() || m->uid < 1)
+        std::unique_lock<std::mutex> mem_lock_(mem_mutex_);
+        if (alloc_map_.find(m->uid) == alloc_map_.end()) 
             return;
-        mem_region_t *top_m = mem_q_.front();
         if (alloc_map_[m->uid] != m->size) {
             FATAL("The size allocated from the pool " << alloc_map_[m->uid] << " is different than the original size of tensor " << m->size);
         }
-        if (m->uid != top_m->uid) {
-            print_trace_();
-            FATAL("Should deallocate the tail first. Only FIFO eviction allowed. Tried deleting " << m->uid << " but front element was " << top_m->uid);            
-            return;
+        // Several threads release regions out of order; space is reclaimed in allocation order
+        released_.insert(m->uid);
+        while (!mem_q_.empty() && released_.count(mem_q_.front().uid)) {
+            pool_entry_t top = mem_q_.front();
+            // The region may have wrapped to the start of the buffer, leaving a gap at the end: free up to its end
+            tail_ = top.offset + top.size;
+            if (tail_ >= total_size_)
+                tail_ = 0;
+            curr_size_ -= top.size;
+            released_.erase(top.uid);
+            alloc_map_.erase(top.uid);
+            mem_q_.pop_front();
+            DBG("[" << rank_ << "]" << "deallocated " << top.uid << " of size " << top.size << " cur size " << curr_size_ << " cur head " << head_  << " cur tail " << tail_);
         }
-        std::unique_lock<std::mutex> mem_lock_(mem_mutex_);
-        tail_ += m->size;
-        if (tail_ > total_size_)
-            tail_ = 0;
-        curr_size_ -= m->size;
         if (curr_size_ == 0)
             head_ = tail_ = 0;
-        alloc_map_.erase(m->uid);
-        DBG("[" << rank_ << "]" << "deallocated " << m->uid << " of size " << m->size << " cur size " << curr_size_ << " cur head " << head_  << " cur tail " << tail_);
-        mem_q_.pop_front();
         mem_lock_.unlock();
         mem_cv_.notify_all();
     } catch (std::exception &e) {
@@ -135,10 +139,10 @@ void mem_pool_t::print_trace_() {
         DBG("===================================================");
         for (size_t i = 0; i < mem_q_.size(); ++i) {
             const auto e = mem_q_[i];
-            DBG("UID: " << e->uid << " ptr: " << (void*)e->ptr << " start: " << e->file_start_offset << " end: " << e->file_start_offset+e->size);
+            DBG("UID: " << e.uid << " start: " << e.offset << " end: " << e.offset+e.size << (released_.count(e.uid) ? " (released)" : ""));
         }
         auto e = mem_q_.front();
-        DBG("First element " << e->uid << " ptr " << (void *)e->ptr << " at start offset " << e->file_start_offset);
+        DBG("First element " << e.uid << " at pool offset " << e.offset);
         DBG("Head " << head_ << ", Tail " << tail_);
         DBG("===================================================");
     } catch (std::exception &e) {
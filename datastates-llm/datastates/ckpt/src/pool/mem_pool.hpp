@@ -8,10 +8,17 @@
 #include <deque>
 #include <cassert>
 #include <map>
+#include <set>
 #include "common/defs.hpp"
 #include "common/mem_region.hpp"
 #include "common/utils.hpp"
 
+struct pool_entry_t {
+    uint64_t uid;
+    size_t offset;
+    size_t size;
+};
+
 class mem_pool_t {
     char* start_ptr_ = nullptr;
     std::atomic<size_t> total_size_{0};
@@ -22,8 +29,9 @@ class mem_pool_t {
     int device_type_ = -1;
     std::mutex mem_mutex_;
     std::condition_variable mem_cv_;
-    std::deque<mem_region_t*> mem_q_;
+    std::deque<pool_entry_t> mem_q_;       // Live allocations, oldest first
     std::map<uint64_t, size_t> alloc_map_;
+    std::set<uint64_t> released_;           // Released but not reclaimed: an older allocation is still live
     bool is_active = true;
     int rank_ = -1;
     void print_trace_();
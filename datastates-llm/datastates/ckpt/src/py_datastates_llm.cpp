@@ -14,13 +14,17 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
            ckpt_tensor
            restore_tensor
            wait
+           wait_for_flush
            shutdown
     )pbdoc";
 
     py::class_<datastates_llm_t>(m, "handle")
-        .def(py::init<const size_t, int, int>())
+        .def(py::init<const size_t, int, int, unsigned int, unsigned int>(),
+             py::arg("host_cache_size"), py::arg("gpu_id"), py::arg("rank") = -1,
+             py::arg("copy_threads") = 1, py::arg("flush_threads") = 1)
         .def("ckpt_tensor", &datastates_llm_t::ckpt_tensor, py::call_guard<py::gil_scoped_release>())
         .def("restore_tensor", &datastates_llm_t::restore_tensor, py::call_guard<py::gil_scoped_release>())
         .def("wait", &datastates_llm_t::wait, py::call_guard<py::gil_scoped_release>())
+        .def("wait_for_flush", &datastates_llm_t::wait_for_flush, py::call_guard<py::gil_scoped_release>())
         .def("shutdown", &datastates_llm_t::shutdown);
 }
\ No newline at end of file
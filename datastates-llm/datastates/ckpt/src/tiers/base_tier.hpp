@@ -4,6 +4,7 @@
 #include "common/atomic_queue.hpp"
 #include "pool/mem_pool.hpp"
 #include <thread>
+#include <vector>
 
 
 class base_tier_t {
@@ -15,7 +16,7 @@ protected:
     unsigned int num_threads_ = 0;
     size_t total_size_ = 0;
     base_tier_t* successor_tier_ = nullptr;
-    std::thread flush_thread_;
+    std::vector<std::thread> flush_threads_;    // num_threads_ of them, sharing flush_q
     std::thread fetch_thread_;
     std::atomic<bool> is_active{true};
     atomic_queue_t flush_q;
@@ -6,9 +6,6 @@
 
 class gpu_tier_t : public base_tier_t {
     char* start_ptr_ = nullptr;
-    atomic_queue_t flush_q;
-    atomic_queue_t fetch_q;
-    cudaStream_t flush_stream;
     cudaStream_t fetch_stream;
 public:
     gpu_tier_t(int gpu_id, unsigned int num_threads, size_t total_size);
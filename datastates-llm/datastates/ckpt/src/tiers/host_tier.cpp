@@ -2,22 +2,43 @@
 
 host_tier_t::host_tier_t(int gpu_id, unsigned int num_threads, size_t total_size): 
     base_tier_t(HOST_PINNED_TIER, gpu_id, num_threads, total_size) {
-    assert((num_threads == 1) && "[HOST_TIER] Number of flush and fetch threads should be set to 1.");
+    assert((num_threads >= 1) && "[HOST_TIER] Need at least one flush thread.");
     checkCuda(cudaSetDevice(gpu_id_));
     checkCuda(cudaMallocHost(&start_ptr_, total_size));
     mem_pool = new mem_pool_t(start_ptr_, total_size, gpu_id);
-    flush_thread_ = std::thread([&] { flush_io_(); });
+    for (unsigned int i = 0; i < num_threads_; i++) {
+        flush_threads_.emplace_back([this] { flush_io_(); });
+        flush_threads_.back().detach();
+    }
     fetch_thread_ = std::thread([&] { fetch_io_(); });
-    flush_thread_.detach();
     fetch_thread_.detach();
-    DBG("Started flush and fetch threads_ on Host tier for GPU: " << gpu_id);
+    DBG("Started " << num_threads_ << " flush threads and a fetch thread on Host tier for GPU: " << gpu_id);
 }
 
 void host_tier_t::flush(mem_region_t *src) {
-    assert((successor_tier_ != nullptr) && "[HOST_TIER] Successor tier is not set.");
+    // The host tier is the last cache tier: its regions are written to their file by the flush thread
     assert((src->curr_tier_type == HOST_PINNED_TIER) && "[HOST_TIER] Source to flush from should be a host memory type.");
-    assert((successor_tier_->tier_type == FILE_TIER) && "[HOST_TIER] Only flush from host to file supported.");
-    flush_q.push(src);
+    if (num_threads_ == 1 || src->size <= HOST_FLUSH_PIECE_SIZE) {
+        flush_q.push(src);
+        return;
+    }
+    // Split by file offset; the region goes back to the pool once its last piece is written
+    size_t pieces = (src->size + HOST_FLUSH_PIECE_SIZE - 1) / HOST_FLUSH_PIECE_SIZE;
+    src->pending_pieces = pieces;
+    for (size_t offset = 0; offset < src->size; offset += HOST_FLUSH_PIECE_SIZE)
+        flush_q.push(new mem_region_t(src, offset, std::min(HOST_FLUSH_PIECE_SIZE, src->size - offset)));
+}
+
+void host_tier_t::stage(mem_region_t *src) {
+    // Copy a host tensor into the cache so the caller can modify it as soon as this returns
+    mem_region_t* dest = new mem_region_t(src, tier_type_);
+    mem_pool->allocate(dest);
+    if (dest->ptr == nullptr) {
+        delete dest;
+        return;
+    }
+    std::memcpy(dest->ptr, src->ptr, src->size);
+    flush(dest);
 }
 
 void host_tier_t::fetch(mem_region_t *src) {
@@ -32,28 +53,50 @@ void host_tier_t::wait_for_completion() {
     flush_q.wait_for_completion();
 };
 
+void host_tier_t::wait_for_fetch() {
+    fetch_q.wait_for_completion();
+};
+
+void host_tier_t::write_(mem_region_t* src) {
+    DBG("[HOST_TIER] Flushing from host to file " << src->uid << " at file_offset " << src->file_start_offset << " at " << src->path << " tensor of size " << src->size);
+    // Regions and pieces of one checkpoint file are written concurrently, each at its own offset
+    int fd = open(src->path.c_str(), O_WRONLY | O_CREAT, 0644);
+    if (fd < 0)
+        throw std::runtime_error("cannot open " + src->path + ": " + std::strerror(errno));
+    size_t written = 0;
+    while (written < src->size) {
+        ssize_t n = pwrite(fd, src->ptr + written, src->size - written, src->file_start_offset + written);
+        if (n < 0 && errno == EINTR)
+            continue;
+        if (n <= 0) {
+            close(fd);
+            throw std::runtime_error("write to " + src->path + " failed: " + std::strerror(errno));
+        }
+        written += n;
+    }
+    close(fd);
+}
+
 void host_tier_t::flush_io_() {
     checkCuda(cudaSetDevice(gpu_id_));
     while(is_active) {
-        bool res = flush_q.wait_for_item();
-        if (res == false || is_active == false)
+        mem_region_t* src = flush_q.take();
+        if (src == nullptr || is_active == false)
             return;
-        mem_region_t* src = flush_q.get_front();
-        DBG("[HOST_TIER] Flushing from host to file " << src->uid << " at file_offset " << src->file_start_offset << " at " << src->path << " tensor of size " << src->size);
         try {
-            if (!std::filesystem::exists(src->path)) {
-                std::ofstream createFile(src->path, std::ios::binary);
-                createFile.close();
+            write_(src);
+            mem_region_t* region = src->parent;
+            if (region == nullptr) {
+                mem_pool->deallocate(src);
+                delete src;
+            } else {
+                delete src;
+                if (--region->pending_pieces == 0) {
+                    mem_pool->deallocate(region);
+                    delete region;
+                }
             }
-            std::ofstream f;            
-            f.exceptions(std::ofstream::failbit | std::ofstream::badbit);
-            f.open(src->path, std::ios::in | std::ios::out | std::ios::binary);
-            f.seekp(src->file_start_offset);
-            f.write(src->ptr, src->size);
-            f.flush();      // This is for consistency guarantee.
-            f.close();
-            mem_pool->deallocate(src);
-            flush_q.pop();
+            flush_q.done();
         } catch (const std::exception& ex) {
             FATAL("[HostFlush] Got exception " << ex.what());
         }
@@ -77,6 +120,7 @@ void host_tier_t::fetch_io_() {
             f.seekg(src->file_start_offset);
             f.read(src->ptr, src->size);
             f.close();
+            delete src;
             fetch_q.pop();
         } catch (const std::exception& ex) {
             FATAL("[HostFetch] Got exception " << ex.what());
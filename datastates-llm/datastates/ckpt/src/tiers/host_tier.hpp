@@ -3,10 +3,19 @@
 
 #include "base_tier.hpp"
 #include <fstream>
-#include <filesystem>
+#include <algorithm>
+#include <cerrno>
+#include <cstring>
+#include <stdexcept>
+#include <fcntl.h>
+#include <unistd.h>
+
+// Regions larger than this are split so several flush threads write them in parallel
+#define HOST_FLUSH_PIECE_SIZE (64UL << 20)
 
 class host_tier_t : public base_tier_t {
     char* start_ptr_ = nullptr;
+    void write_(mem_region_t* m);
 public:
     host_tier_t(int gpu_id, unsigned int num_threads, size_t total_size);
     ~host_tier_t() {
@@ -16,10 +25,12 @@ public:
         fetch_q.set_inactive();
     };
     void flush(mem_region_t* m);
+    void stage(mem_region_t* m);
     void fetch(mem_region_t* m);
     void flush_io_();
     void fetch_io_();
     void wait_for_completion();
+    void wait_for_fetch();
 };
 
 #endif // __DATASTATES_HOST_TIER_HPP
\ No newline at end of file
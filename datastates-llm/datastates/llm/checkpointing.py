@@ -8,29 +8,34 @@ from typing import Union
 import pickle
 import json
 import ctypes
+import mmap
 import numpy as np
 from datastates.ckpt import CkptEngine
-from .helper import parse_config, get_checkpoint_version, HOST_CACHE_SIZE, CKPT_PARSER_THREADS
+from .helper import parse_config, get_checkpoint_version, HOST_CACHE_SIZE, CKPT_PARSER_THREADS, COPY_THREADS, \
+    FLUSH_THREADS
 from datastates.utils import get_logger
 
 
 SIZE_UINT64 = ctypes.sizeof(ctypes.c_uint64)
 KEY_SEPARATOR = "|"
+MADV_POPULATE_READ = getattr(mmap, "MADV_POPULATE_READ", 22)
+LOAD_CHUNK_BYTES = 64 << 20                 # Unit of work for the parser threads when loading
 
 
 class Checkpointing:
     def __init__(self, runtime_config={}, rank=0) -> None:
         try:
-            if not torch.cuda.is_available():
-                raise RuntimeError("[DataStates.llm] CUDA is not available. Make sure CUDA drivers are installed and GPU is accessible.")
-            
+            # Without CUDA the engine falls back to its pure Python implementation
             self.rank           = int(rank)
             datastates_config   = parse_config(runtime_config)
             host_cache_size     = int(datastates_config[HOST_CACHE_SIZE]*(1<<30))       # From GB to Bytes
-            cuda_device         = int(torch.cuda.current_device())
+            cuda_device         = int(torch.cuda.current_device()) if torch.cuda.is_available() else -1
             concurrent_parser_threads = int(datastates_config[CKPT_PARSER_THREADS])
-            self.ckpt_engine = CkptEngine(host_cache_size, cuda_device, self.rank)   
+            self.ckpt_engine = CkptEngine(host_cache_size, cuda_device, self.rank,
+                                          copy_threads=int(datastates_config[COPY_THREADS]),
+                                          flush_threads=int(datastates_config[FLUSH_THREADS]))
             self.executor = ThreadPoolExecutor(max_workers=concurrent_parser_threads)
+            self.pending_saves = []
             self.logger = get_logger(__name__)
             self.last_ckpt_version = -1
 
@@ -99,6 +104,11 @@ class Checkpointing:
             for _, v in async_copies.items():
                 v["file_offset"] += metadata_size
                 async_ckpt_list.append((version, v["tensor"], v["file_offset"], path))
+            # The header goes first in the file and the pickled lean state dict after the last tensor
+            metadata = torch.frombuffer(bytearray(header_size + header), dtype=torch.uint8)
+            async_ckpt_list.append((version, metadata, 0, path))
+            lean_state_dict = torch.frombuffer(bytearray(lean_state_dict), dtype=torch.uint8)
+            async_ckpt_list.append((version, lean_state_dict, metadata_size + _start_tensor_offset, path))
             
             self.ckpt_engine.async_save(async_ckpt_list)
             
@@ -122,7 +132,7 @@ class Checkpointing:
                 raise Exception(f"[DataStates.llm] state_dict given to checkpoint must be dictionary. Passed {type(state_dict)} instead for {path}.")
 
             # print('save, ')
-            self.executor.submit(self.save_background, state_dict, path)
+            self.pending_saves.append(self.executor.submit(self.save_background, state_dict, path))
             # 
             # self.save_background(state_dict, path)
             # 
@@ -131,19 +141,68 @@ class Checkpointing:
             self.logger.error(f"[DataStates.llm][ERROR] Could not save {path}, exception: {exc}, data: {state_dict}")
             sys.exit(-1)
             
-    def load(self, path: str, map_location=None):
+    def _read_header(self, mm):
+        header_size = int.from_bytes(mm[:SIZE_UINT64], 'little')
+        metadata_size = header_size + SIZE_UINT64
+        header = json.loads(mm[SIZE_UINT64:metadata_size])
+        [start_offset, end_offset] = np.add(header["datastates_metadata"]["data_offsets"], metadata_size)
+        del(header["datastates_metadata"])
+        data = pickle.loads(mm[start_offset:end_offset])
+        return header, data, metadata_size
+
+    def _prefault(self, fd, mm, ranges):
+        # Map the tensor bytes in from the parser threads, so first use does not fault
+        chunk = LOAD_CHUNK_BYTES
+
+        def _warm(start, end):
+            page_start = start - start % mmap.PAGESIZE
+            try:
+                # Reads the pages and maps them in one call, without a copy (Linux 5.14+)
+                mm.madvise(MADV_POPULATE_READ, page_start, end - page_start)
+            except OSError:
+                # Older kernels: read the range into the page cache; pread releases the GIL
+                scratch = bytearray(end - start)
+                os.preadv(fd, [scratch], start)
+
+        pieces = [(offset, min(offset + chunk, end)) for start, end in ranges for offset in range(start, end, chunk)]
+        for future in [self.executor.submit(_warm, start, end) for start, end in pieces]:
+            future.result()
+
+    def _restore(self, restore_list):
+        # Restore host tensors in place from the parser threads, large tensors split in byte ranges
+        chunk = LOAD_CHUNK_BYTES
+        pieces = []
+        for version, tensor, file_offset, path in restore_list:
+            flat = tensor.reshape(-1).view(torch.uint8)
+            for offset in range(0, flat.numel(), chunk):
+                piece = flat.narrow(0, offset, min(chunk, flat.numel() - offset))
+                pieces.append((version, piece, file_offset + offset, path))
+        for future in [self.executor.submit(self.ckpt_engine.load, [piece]) for piece in pieces]:
+            future.result()
+
+    def load(self, path: str, map_location=None, into=None, prefault=False):
+        """
+        Load a checkpoint written by `save`, with tensors as views of one memory mapping of the file.
+
+        Nothing is copied: pages are read in as the tensors are first touched,
+        or up front by the parser threads with `prefault=True`. The mapping is
+        private, so writing to a tensor never changes the file. `into` is a
+        state dict of preallocated tensors (e.g. the model's own): every tensor
+        it has a match for is restored in place instead, through the engine's
+        restore_tensor from the parser threads for host tensors and as one
+        host-to-device copy otherwise, and is returned in the loaded state.
+        """
         try:
             version = get_checkpoint_version(path, self.last_ckpt_version)
-            f = open(path, 'rb')
-            f.seek(0)
-            header_size_bytes = f.read(SIZE_UINT64)
-            header_size = int.from_bytes(header_size_bytes, 'little')
-            metadata_size = header_size + SIZE_UINT64
-            header = json.loads(f.read(header_size))
-            [start_offset, end_offset] = np.add(header["datastates_metadata"]["data_offsets"], metadata_size)
-            del(header["datastates_metadata"])
-            f.seek(start_offset)
-            data = pickle.loads(f.read(end_offset-start_offset))
+            with open(path, 'rb') as f:
+                fd = os.dup(f.fileno())
+            try:
+                mm = mmap.mmap(fd, 0, access=mmap.ACCESS_COPY)
+                header, data, metadata_size = self._read_header(mm)
+                if prefault:
+                    self._prefault(fd, mm, [tuple(int(o) for o in np.add(v["data_offsets"], metadata_size)) for v in header.values()])
+            finally:
+                os.close(fd)
 
             try:
                 restore_list = []
@@ -157,22 +216,40 @@ class Checkpointing:
 
                     pre_dest = data
                     dest = data
+                    target = into
                     while len(split_k):
                         sub_k = split_k.popleft()
                         if sub_k.isdigit():
                             sub_k = int(sub_k) 
                         pre_dest = dest
                         dest = dest[sub_k]
+                        try:
+                            target = target[sub_k] if target is not None else None
+                        except (KeyError, IndexError, TypeError):
+                            target = None
                     if dest != f"TENSOR{KEY_SEPARATOR}{k}":
                         raise Exception(f"[DataStates.llm] The key in header {k} does not match key at location {dest}")
 
-                    # tensor_restored = torch.zeros(size=tuple(shape), dtype=getattr(torch, dtype))
-                    # restore_list.append((version, tensor_restored, start_offset, path))
-                    f.seek(start_offset)
-                    buffer = f.read(end_offset-start_offset)
-                    tensor_restored = torch.frombuffer(buffer, dtype=getattr(torch, dtype)).reshape(tuple(shape))
+                    dtype = getattr(torch, dtype)
+                    nbytes = int(end_offset - start_offset)
+                    if nbytes == 0:
+                        tensor_restored = torch.empty(tuple(shape), dtype=dtype)
+                    else:
+                        tensor_restored = torch.frombuffer(mm, dtype=dtype, count=nbytes // dtype.itemsize,
+                                                           offset=int(start_offset)).reshape(tuple(shape))
+                    if torch.is_tensor(target) and target.shape == tensor_restored.shape and target.dtype == dtype:
+                        if target.device.type == 'cpu' and target.is_contiguous() and nbytes > 0:
+                            restore_list.append((version, target, int(start_offset), path))
+                        else:
+                            target.copy_(tensor_restored, non_blocking=True)
+                        tensor_restored = target
+                    elif map_location is not None:
+                        tensor_restored = tensor_restored.to(map_location)
                     pre_dest[sub_k] = tensor_restored
-                # self.ckpt_engine.load(restore_list)
+                if len(restore_list):
+                    self._restore(restore_list)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
             except Exception as exc:
                 raise Exception(f"[DataStates.llm] Got error with tensor loading {dtype}, {shape}, {exc}")
             self.logger.info(f"[DataStates.llm] Loaded checkpoint from {path}.")
@@ -187,6 +264,14 @@ class Checkpointing:
         self.last_ckpt_version += 1
         return True
 
+    def wait_for_flush(self):
+        # Blocks until the checkpoint is in its files, not just in the host cache
+        for future in self.pending_saves:
+            future.result()
+        self.pending_saves = []
+        self.wait()
+        self.ckpt_engine.wait_for_flush()
+
     def wait(self):
         try:
             t = time.time()
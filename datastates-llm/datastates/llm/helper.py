@@ -5,6 +5,10 @@ HOST_CACHE_SIZE="host_cache_size"
 HOST_CACHE_SIZE_DEFAULT=0
 CKPT_PARSER_THREADS="parser_threads"
 CKPT_PARSER_THREADS_DEFAULT=4
+COPY_THREADS="copy_threads"            # Device-to-host copy threads of the GPU tier
+COPY_THREADS_DEFAULT=1
+FLUSH_THREADS="flush_threads"          # File write threads of the host tier
+FLUSH_THREADS_DEFAULT=4
 FAST_CACHE_INIT="fast_cache_init"
 FAST_CACHE_INIT_DEFAULT=False
 PIN_HOST_CACHE="pin_host_cache"
@@ -29,6 +33,8 @@ def parse_config(config) -> dict:
     result = {
         HOST_CACHE_SIZE: HOST_CACHE_SIZE_DEFAULT,
         CKPT_PARSER_THREADS: CKPT_PARSER_THREADS_DEFAULT,
+        COPY_THREADS: COPY_THREADS_DEFAULT,
+        FLUSH_THREADS: FLUSH_THREADS_DEFAULT,
         # In the future, we can give option to do async 
         # memset and allow unpinned host memory
         # FAST_CACHE_INIT: FAST_CACHE_INIT_DEFAULT,
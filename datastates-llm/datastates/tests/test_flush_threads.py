@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+import time
+import torch
+from datastates.llm import Checkpointing
+
+
+def test_flush_thread_scaling(ckpt_dir=None, thread_counts=(1, 2, 4, 8), nbytes=(256 << 20), host_cache_size=0.5,
+                              tensor_bytes=(64 << 20)):
+    # Point ckpt_dir at the NVMe to measure; the checkpoint should not fit in the page cache for clean numbers
+    ckpt_dir = ckpt_dir or tempfile.mkdtemp()
+    device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
+    tensor_numel = tensor_bytes // 4
+    state_dict = {f"layer{i}": torch.randn(tensor_numel, device=device) for i in range(max(1, nbytes // tensor_bytes))}
+    total_bytes = sum(v.numel() * v.element_size() for v in state_dict.values())
+
+    results = {}
+    for flush_threads in thread_counts:
+        config = {"host_cache_size": host_cache_size, "parser_threads": 2, "flush_threads": flush_threads}
+        ckpt_engine = Checkpointing(runtime_config=config, rank=0)
+        ckpt_path = os.path.join(ckpt_dir, f"datastates-flush-{flush_threads}.pt")
+        t = time.time()
+        ckpt_engine.save(state_dict=state_dict, path=ckpt_path)
+        ckpt_engine.wait_for_flush()
+        seconds = time.time() - t
+        results[flush_threads] = total_bytes / seconds
+        print(f"{flush_threads} flush threads: {total_bytes / (1 << 30):.1f} GB in {seconds:.3f}s "
+              f"({results[flush_threads] / 1e9:.2f} GB/s)")
+        # Pieces written by different threads must land at their own offsets
+        loaded = ckpt_engine.load(ckpt_path)
+        assert all(torch.equal(loaded[k], v.cpu()) for k, v in state_dict.items()), f"{flush_threads} flush threads"
+        del loaded, ckpt_engine
+        os.remove(ckpt_path)
+    return results
+
+
+if __name__ == "__main__":
+    # The benchmark run: 4 GB in 256 MB tensors by default
+    test_flush_thread_scaling(sys.argv[1] if len(sys.argv) > 1 else None,
+                              nbytes=int(float(sys.argv[2]) * (1 << 30)) if len(sys.argv) > 2 else (4 << 30),
+                              host_cache_size=2,
+                              tensor_bytes=(256 << 20))
@@ -0,0 +1,80 @@
+import ctypes
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+import torch
+from datastates.llm import Checkpointing
+
+SIZE_UINT64 = ctypes.sizeof(ctypes.c_uint64)
+
+
+def _evict(path):
+    # Drop the file from the page cache so every loader starts cold
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _load_seek_read(path):
+    # The previous loader: one seek + read + copy per tensor
+    with open(path, 'rb') as f:
+        header_size = int.from_bytes(f.read(SIZE_UINT64), 'little')
+        metadata_size = header_size + SIZE_UINT64
+        header = json.loads(f.read(header_size))
+        [start, end] = header.pop("datastates_metadata")["data_offsets"]
+        f.seek(metadata_size + start)
+        data = pickle.loads(f.read(end - start))
+        for k, v in header.items():
+            [start, end] = v["data_offsets"]
+            f.seek(metadata_size + start)
+            dtype = getattr(torch, v["dtype"].replace('torch.', ''))
+            data[k] = torch.frombuffer(f.read(end - start), dtype=dtype).reshape(v["shape"])
+    return data
+
+
+def _touch(state_dict):
+    # Lazily mapped tensors are only read once used
+    return sum(float(v.view(-1)[::4096].sum()) for v in state_dict.values() if torch.is_tensor(v))
+
+
+def test_mmap_load(total_bytes=(256 << 20), tensor_bytes=(64 << 20), parser_threads=8):
+    ckpt_path = os.path.join(tempfile.mkdtemp(), "datastates-mmap.pt")
+    ckpt_engine = Checkpointing(runtime_config={"host_cache_size": 1, "parser_threads": parser_threads}, rank=0)
+    state_dict = {f"layer{i}": torch.randn(tensor_bytes // 4) for i in range(max(1, total_bytes // tensor_bytes))}
+    state_dict["step"] = 10
+    ckpt_engine.save(state_dict=state_dict, path=ckpt_path)
+    ckpt_engine.wait_for_flush()
+    nbytes = os.path.getsize(ckpt_path)
+
+    preallocated = {k: torch.empty_like(v) for k, v in state_dict.items() if torch.is_tensor(v)}
+    loaders = {
+        "seek+read": lambda: _load_seek_read(ckpt_path),
+        "mmap": lambda: ckpt_engine.load(ckpt_path),
+        "mmap+prefault": lambda: ckpt_engine.load(ckpt_path, prefault=True),
+        "into preallocated": lambda: ckpt_engine.load(ckpt_path, into=preallocated),
+    }
+    for name, loader in loaders.items():
+        _evict(ckpt_path)
+        t = time.time()
+        loaded = loader()
+        returned = time.time() - t
+        _touch(loaded)
+        seconds = time.time() - t
+        print(f"{name}: returned in {returned:.3f}s, usable in {seconds:.3f}s ({nbytes / seconds / 1e9:.2f} GB/s)")
+        assert loaded["step"] == 10
+        assert all(torch.equal(loaded[k], v) for k, v in state_dict.items() if torch.is_tensor(v)), name
+        del loaded
+
+    assert all(torch.equal(preallocated[k], state_dict[k]) for k in preallocated)
+    os.remove(ckpt_path)
+
+
+if __name__ == "__main__":
+    # The benchmark run: 4 GB by default, more than the page cache should hold for cold loads
+    test_mmap_load(int(float(sys.argv[1]) * (1 << 30)) if len(sys.argv) > 1 else (4 << 30))
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import time
+import torch
+from datastates.ckpt.py_engine import HostCachePool, PyCkptHandle
+from datastates.llm import Checkpointing
+
+
+def test_host_cache_pool():
+    pool = HostCachePool(100)
+    a = pool.allocate(40)
+    b = pool.allocate(40)
+    pool.deallocate(a, 40)
+    # Does not fit at the end, wraps to the start of the buffer
+    c = pool.allocate(30)
+    assert (a, b, c) == (0, 40, 0), (a, b, c)
+    pool.deallocate(b, 40)
+    d = pool.allocate(50)
+    assert d == 30, d
+    print("Host cache pool wraps around correctly")
+
+
+def test_py_engine_roundtrip():
+    ckpt_path = os.path.join(tempfile.mkdtemp(), "datastates-py-ckpt.pt")
+    # A cache smaller than the checkpoint forces regions to be recycled while flushing
+    handle = PyCkptHandle(host_cache_size=(1 << 20), gpu_device_id=-1, rank=0)
+    tensors = [torch.randn(256, 256) for _ in range(8)]
+    tensor_bytes = tensors[0].numel() * tensors[0].element_size()
+    for i, tensor in enumerate(tensors):
+        handle.ckpt_tensor(1, tensor, tensor_bytes, i * tensor_bytes, ckpt_path)
+    handle.wait()
+    handle.shutdown()
+
+    for i, tensor in enumerate(tensors):
+        restored = torch.zeros_like(tensor)
+        handle.restore_tensor(1, restored, tensor_bytes, i * tensor_bytes, ckpt_path)
+        assert torch.equal(restored, tensor), f"tensor {i} does not match"
+    print("Python engine round trip matches")
+
+
+def test_checkpointing_cpu():
+    ckpt_path = os.path.join(tempfile.mkdtemp(), "datastates-ckpt.pt")
+    ckpt_engine = Checkpointing(runtime_config={"host_cache_size": 1, "parser_threads": 2}, rank=0)
+    state_dict = {f"layer{i}": torch.randn(1024, 1024) for i in range(64)}
+    state_dict["step"] = 10
+
+    t = time.time()
+    ckpt_engine.save(state_dict=state_dict, path=ckpt_path)
+    ckpt_engine.wait_for_flush()
+    seconds = time.time() - t
+    nbytes = sum(v.numel() * v.element_size() for v in state_dict.values() if torch.is_tensor(v))
+    print(f"Checkpointed {nbytes / (1 << 20):.0f} MB in {seconds:.3f}s ({nbytes / seconds / 1e9:.2f} GB/s)")
+
+    loaded = ckpt_engine.load(ckpt_path)
+    assert loaded["step"] == 10
+    assert all(torch.equal(loaded[k], v) for k, v in state_dict.items() if torch.is_tensor(v))
+    print("Checkpoint loaded back successfully")
+
+
+if __name__ == "__main__":
+    test_host_cache_pool()
+    test_py_engine_roundtrip()
+    test_checkpointing_cpu()
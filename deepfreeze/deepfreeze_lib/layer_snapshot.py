@@ -0,0 +1,217 @@
+import time
+
+import torch
+
+_ALIGNMENT = 16
+
+
+def _align(nbytes):
+    return (nbytes + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _host_buffer(tensors):
+    # One pinned buffer per layer, a view per tensor; sizes come from the partitions themselves
+    offsets = []
+    nbytes = 0
+    for tensor in tensors:
+        offsets.append(nbytes)
+        nbytes += _align(tensor.numel() * tensor.element_size())
+    flat = torch.empty(nbytes, dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+    return [
+        flat[offset:offset + tensor.numel() * tensor.element_size()].view(tensor.dtype)
+        for offset, tensor in zip(offsets, tensors)
+    ]
+
+
+class _Layer:
+
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+        self.trainable = sum(1 for param in params if param.requires_grad)
+        self.grads_ready = 0
+        # Hook events per iteration, and how many of them the trace says there are
+        self.touches = 0
+        self.last_touch = None
+        self.copied = False
+
+    def partitions(self):
+        # The rank's ZeRO-3 partition of each parameter, trimmed of padding
+        return [param.ds_tensor.view(-1)[:param.partition_numel()] for param in self.params]
+
+
+class LayerSnapshotter:
+    """
+    Snapshots ZeRO-3 partitions layer by layer, each as soon as the iteration has last touched it.
+
+    A snapshot of version v holds the parameter partitions produced by
+    step v and the Adam moments of that step. The moments of a sub group are
+    copied right after the sub group's update (`snapshot_sub_group`). A
+    layer's partition is copied from the forward hook or gradient-ready hook
+    that is its last touch before the next step, as learned from the order
+    of the hook events in the first traced iteration; layers the trace
+    never reached are copied by `complete`. Copies run on a side stream and
+    are tracked with events, so they spread over the iteration instead of
+    stalling it. Two host slots are alternated, so the last complete
+    snapshot stays readable while the next one is being taken.
+    """
+
+    def __init__(self, module, stream=None):
+        self.use_cuda = torch.cuda.is_available()
+        self.stream = stream if stream is not None else (torch.cuda.Stream() if self.use_cuda else None)
+        self.layers = []
+        self.param_to_layer = {}
+        seen = set()
+        for name, submodule in module.named_modules():
+            # Tied parameters belong to the first module that holds them
+            params = [p for p in submodule.parameters(recurse=False) if id(p) not in seen and hasattr(p, 'ds_tensor')]
+            if not params:
+                continue
+            seen.update(id(p) for p in params)
+            layer = _Layer(name, params)
+            for param in params:
+                self.param_to_layer[id(param)] = layer
+            self.layers.append(layer)
+
+        self.hooks = []
+        for name, submodule in module.named_modules():
+            params = [p for p in submodule.parameters(recurse=False) if id(p) in self.param_to_layer]
+            if params:
+                self.hooks.append(submodule.register_forward_hook(self._make_forward_hook(params)))
+
+        self.traced = False
+        self.trace = []
+        self.order = []
+        # Two host slots, each {layer name: [tensors]} and {sub group: (exp_avg, exp_avg_sq)}
+        self.slots = [({}, {}), ({}, {})]
+        self.version = None
+        self.latest = None
+        self.events = []
+        self.stats = {"hook_bytes": 0, "optimizer_bytes": 0, "flush_bytes": 0, "wait_seconds": 0.0}
+
+    def remove_hooks(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    def _make_forward_hook(self, params):
+        layers = []
+        for param in params:
+            layer = self.param_to_layer[id(param)]
+            if layer not in layers:
+                layers.append(layer)
+
+        def forward_hook(module, inputs, outputs):
+            for layer in layers:
+                self._touch(layer)
+
+        return forward_hook
+
+    def grad_ready(self, param):
+        """Called from the gradient-ready hook of `param`; the layer is touched once all its gradients are in."""
+        layer = self.param_to_layer.get(id(param))
+        if layer is None:
+            return
+        layer.grads_ready += 1
+        if layer.grads_ready == layer.trainable:
+            layer.grads_ready = 0
+            self._touch(layer)
+
+    def _touch(self, layer):
+        if self.version is None or layer.copied:
+            return
+        layer.touches += 1
+        if not self.traced:
+            self.trace.append(layer)
+        elif layer.touches == layer.last_touch:
+            self._copy_layer(layer, "hook_bytes")
+
+    def _issue(self, pairs, stat):
+        if not pairs:
+            return
+        if self.use_cuda:
+            # The sources were last written on the compute stream
+            self.stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.stream):
+                for dst, src in pairs:
+                    dst.copy_(src, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            self.events.append(event)
+        else:
+            for dst, src in pairs:
+                dst.copy_(src)
+        self.stats[stat] += sum(src.numel() * src.element_size() for _, src in pairs)
+
+    def _copy_layer(self, layer, stat):
+        layer.copied = True
+        partitions = layer.partitions()
+        slot = self.slots[self.version % 2][0]
+        if layer.name not in slot:
+            slot[layer.name] = _host_buffer(partitions)
+        self._issue(list(zip(slot[layer.name], partitions)), stat)
+
+    def start(self, version):
+        """Begin the snapshot of the state step `version` is about to produce."""
+        self.version = version
+        self.stats = {"hook_bytes": 0, "optimizer_bytes": 0, "flush_bytes": 0, "wait_seconds": 0.0}
+        for layer in self.layers:
+            layer.touches = 0
+            layer.grads_ready = 0
+            layer.copied = False
+
+    def snapshot_sub_group(self, sub_group_id, exp_avg, exp_avg_sq):
+        """Copy the moments of a sub group right after its optimizer update."""
+        if self.version is None:
+            return
+        sources = [exp_avg.view(-1), exp_avg_sq.view(-1)]
+        slot = self.slots[self.version % 2][1]
+        if sub_group_id not in slot:
+            slot[sub_group_id] = _host_buffer(sources)
+        self._issue(list(zip(slot[sub_group_id], sources)), "optimizer_bytes")
+
+    def complete(self):
+        """
+        Finish the running snapshot before the next step overwrites its sources.
+
+        Copies the layers no hook has copied yet, waits for every copy and
+        makes the snapshot the latest one. The first call fixes the layer
+        order from the trace of the iteration it closes.
+        """
+        if self.version is None:
+            return None
+        for layer in self.layers:
+            if not layer.copied:
+                self._copy_layer(layer, "flush_bytes")
+        start = time.time()
+        for event in self.events:
+            event.synchronize()
+        self.events = []
+        self.stats["wait_seconds"] = time.time() - start
+
+        if not self.traced:
+            for layer in self.layers:
+                layer.last_touch = layer.touches if layer.touches else None
+            # Layers in the order of their last touch
+            last = {}
+            for index, layer in enumerate(self.trace):
+                last[layer.name] = index
+            self.order = sorted(last, key=last.get)
+            self.trace = []
+            self.traced = True
+        self.latest = self.version
+        self.version = None
+        return self.latest
+
+    def snapshot(self):
+        """(version, {layer name: [partition tensors]}, {sub group: [exp_avg, exp_avg_sq]}) of the latest snapshot."""
+        if self.latest is None:
+            return None, {}, {}
+        layers, moments = self.slots[self.latest % 2]
+        return self.latest, layers, moments
+
+    def format_stats(self):
+        stats = self.stats
+        return (f"layer order of {len(self.order)} layers; hooks {stats['hook_bytes'] / 1e9:.3f} GB, "
+                f"optimizer {stats['optimizer_bytes'] / 1e9:.3f} GB, at step {stats['flush_bytes'] / 1e9:.3f} GB, "
+                f"wait {stats['wait_seconds']:.4f}s")
@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+MANIFEST_NAME = 'manifest.json'
+SHARD_BYTES = 256 * 1024 * 1024
+WRITER_THREADS = 8
+# Tensor offsets are aligned so every tensor can be viewed in place from the loaded buffer
+_ALIGNMENT = 64
+
+
+def snapshot_dir(save_dir, rank, tag):
+    return os.path.join(save_dir, f"ckpt_rank{rank}_{tag}")
+
+
+def _align(nbytes):
+    return (nbytes + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _byte_view(tensor):
+    # Raw bytes of a CPU tensor, whatever its dtype
+    return memoryview(tensor.detach().contiguous().reshape(-1).view(torch.uint8).numpy())
+
+
+def _layout(tensors, shard_bytes):
+    entries = []
+    offset = 0
+    for tensor in tensors:
+        nbytes = tensor.numel() * tensor.element_size()
+        entries.append({
+            "dtype": str(tensor.dtype).split('.')[-1],
+            "shape": list(tensor.shape),
+            "offset": offset,
+            "nbytes": nbytes,
+        })
+        offset = _align(offset + nbytes)
+    shards = [(start, min(shard_bytes, offset - start)) for start in range(0, offset, shard_bytes)]
+    return entries, shards, offset
+
+
+def _shard_pieces(tensors, entries, start, nbytes):
+    # Byte ranges of the tensors that fall into [start, start + nbytes), with the padding between them
+    end = start + nbytes
+    position = start
+    for tensor, entry in zip(tensors, entries):
+        lo = max(entry["offset"], start)
+        hi = min(entry["offset"] + entry["nbytes"], end)
+        if lo >= hi:
+            continue
+        if lo > position:
+            yield bytes(lo - position)
+        yield _byte_view(tensor)[lo - entry["offset"]:hi - entry["offset"]]
+        position = hi
+    if position < end:
+        yield bytes(end - position)
+
+
+def _write_shard(path, pieces):
+    fd = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o644)
+    try:
+        for piece in pieces:
+            written = 0
+            while written < len(piece):
+                written += os.write(fd, piece[written:])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def serialize_snapshot(tensors, path, tag=0, shard_bytes=SHARD_BYTES, num_threads=WRITER_THREADS):
+    """
+    Write CPU `tensors` as raw bytes into fixed-size shard files under the directory `path`.
+
+    The tensors are laid out back to back (64-byte aligned) and the layout is
+    cut into `shard_bytes` shards, written concurrently by `num_threads`
+    threads; os.write releases the GIL, so the threads overlap their I/O.
+    The manifest is written last, so a directory without one is incomplete.
+    Returns the manifest.
+    """
+    tensors = list(tensors)
+    entries, shards, total = _layout(tensors, shard_bytes)
+    os.makedirs(path, exist_ok=True)
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    start = time.time()
+    files = [f"shard_{k:05d}.bin" for k in range(len(shards))]
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        futures = [
+            pool.submit(_write_shard, os.path.join(path, name), list(_shard_pieces(tensors, entries, offset, nbytes)))
+            for name, (offset, nbytes) in zip(files, shards)
+        ]
+        for future in futures:
+            future.result()
+    seconds = time.time() - start
+
+    manifest = {
+        "tag": tag,
+        "nbytes": total,
+        "shard_bytes": shard_bytes,
+        "shards": [{"file": name, "offset": offset, "nbytes": nbytes} for name, (offset, nbytes) in zip(files, shards)],
+        "tensors": entries,
+        "threads": num_threads,
+        "seconds": seconds,
+    }
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+def _read_shard(path, view):
+    with open(path, 'rb', buffering=0) as f:
+        read = 0
+        while read < len(view):
+            n = f.readinto(view[read:])
+            if not n:
+                raise RuntimeError(f"{path} is truncated: {read} of {len(view)} bytes")
+            read += n
+
+
+def load_snapshot(path, num_threads=WRITER_THREADS):
+    """
+    Read a snapshot written by `serialize_snapshot` back into a list of CPU tensors.
+
+    Every shard is read by a pool thread straight into its place in one
+    buffer; the tensors are views into that buffer.
+    """
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    flat = torch.empty(manifest["nbytes"], dtype=torch.uint8)
+    view = memoryview(flat.numpy())
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        futures = [
+            pool.submit(_read_shard, os.path.join(path, shard["file"]),
+                        view[shard["offset"]:shard["offset"] + shard["nbytes"]]) for shard in manifest["shards"]
+        ]
+        for future in futures:
+            future.result()
+    tensors = []
+    for entry in manifest["tensors"]:
+        data = flat[entry["offset"]:entry["offset"] + entry["nbytes"]]
+        tensors.append(data.view(getattr(torch, entry["dtype"])).view(entry["shape"]))
+    return tensors, manifest
+
+
+def benchmark_threads(save_dir, total_bytes=4 << 30, tensor_bytes=64 << 20, shard_bytes=SHARD_BYTES,
+                      thread_counts=(1, 2, 4, 8, 16)):
+    """Write throughput of `serialize_snapshot` on the disk holding `save_dir`, per thread count."""
+    tensors = [torch.randn(tensor_bytes // 2).half() for _ in range(max(1, total_bytes // tensor_bytes))]
+    results = {}
+    for num_threads in thread_counts:
+        path = os.path.join(save_dir, f"shard_benchmark_{num_threads}")
+        manifest = serialize_snapshot(tensors, path, shard_bytes=shard_bytes, num_threads=num_threads)
+        results[num_threads] = manifest["nbytes"] / manifest["seconds"]
+        print(f"{num_threads} threads: {results[num_threads] / 1e9:.2f} GB/s")
+        if num_threads == thread_counts[0]:
+            loaded, _ = load_snapshot(path, num_threads)
+            assert all(torch.equal(a, b) for a, b in zip(tensors, loaded)), "snapshot does not round-trip"
+        shutil.rmtree(path)
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    benchmark_threads(sys.argv[1] if len(sys.argv) > 1 else '.',
+                      total_bytes=int(float(sys.argv[2]) * (1 << 30)) if len(sys.argv) > 2 else (4 << 30))
@@ -37,6 +37,8 @@ import torch.multiprocessing as mp
 import time
 import threading 
 from collections import deque
+from .layer_snapshot import LayerSnapshotter
+from .shard_writer import serialize_snapshot, snapshot_dir, SHARD_BYTES, WRITER_THREADS
 
 # Toggle this to true to enable correctness test
 # with gradient partitioning and without
@@ -78,12 +80,19 @@ def move_to_cpu(tensor_list):
     for tensor in tensor_list:
         tensor.data = tensor.data.cpu()
 
-def save_ckpt_to_disk(queue, rank, save_dir):
+def save_ckpt_to_disk(queue, rank, save_dir, num_threads=WRITER_THREADS, shard_bytes=SHARD_BYTES):
+    # Each item is (tag, tensors) or just the tensors; None stops the process
     while True:
-        cpu_tensor_array = queue.get()
+        item = queue.get()
+        if item is None:
+            break
+        tag, cpu_tensor_array = item if isinstance(item, tuple) else (0, item)
         print("start to save ckpt to disk")
         sys.stdout.flush()
-        torch.save(cpu_tensor_array, save_dir + "ckpt_" + "rank" + str(rank) + ".pt")
+        manifest = serialize_snapshot(cpu_tensor_array, snapshot_dir(save_dir, rank, tag), tag=tag,
+                                      shard_bytes=shard_bytes, num_threads=num_threads)
+        print("saved {} bytes in {} shards, {:.2f} GB/s".format(manifest["nbytes"], len(manifest["shards"]),
+                                                                 manifest["nbytes"] / manifest["seconds"] / 1e9))
     
 
 @contextmanager
@@ -460,9 +469,8 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         self.save_ckpt_in_memory_thread = None
         
         self.module_state_backup = {}
-        self.cuda_stream_module_dict = {}
-        self.cuda_stream_optimizer_dict_avg={}
-        self.cuda_stream_optimizer_dict_avg_sq={}
+        # Layer partitions and moments are copied from the hooks, each right after its last touch
+        self.layer_snapshot = LayerSnapshotter(self.module)
         
         self.queue = mp.Queue()
         self.cpu_tensor_array= deque()
@@ -470,74 +478,25 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         # self.save_ckpt_to_disk_process = mp.Process(target=save_ckpt_to_disk, args=(self.queue, dist.get_rank(), "/data/ckpt/"))
         # self.save_ckpt_to_disk_process.start()
             
-    def save_ckpt_in_memory(self, rank, module_state_dict, optimizer_state_dict):
-        torch.cuda.set_device(rank)
-
-        # if self.cuda_stream_module_dict == {} or self.cuda_stream_optimizer_dict_avg=={} or self.cuda_stream_optimizer_dict_avg_sq=={}:
-        #     for key, value in module_state_dict.items():
-        #         self.cuda_stream_module_dict[key]=torch.cuda.Stream()
-                
-        #     for tensor, momentum in optimizer_state_dict.items():
-        #         self.cuda_stream_optimizer_dict_avg[tensor] =torch.cuda.Stream()
-        #         self.cuda_stream_optimizer_dict_avg_sq[tensor] =torch.cuda.Stream()
-                
+    def save_ckpt_in_memory(self, rank, module_state_dict=None, optimizer_state_dict=None):
+        """Publish the latest complete layer-wise snapshot as `cpu_tensor_array`."""
+        version, layers, moments = self.layer_snapshot.snapshot()
+        if version is None:
+            return
         cpu_tensor_array = deque()
-        
-        stream= torch.cuda.Stream()
-        numel = 0
-        for key, tensor in module_state_dict.items():
-            
-            numel+=tensor.numel()
-            # self.cuda_stream_module_dict[key].synchronize()
-            with torch.cuda.stream(stream):
-                cpu_tensor = tensor.to('cpu', non_blocking=True)
-            stream.synchronize()
-            cpu_tensor_array.append(cpu_tensor)
-        
-        for key, tensor in module_state_dict.items():
-            
-            numel+=tensor.numel()
-            # self.cuda_stream_module_dict[key].synchronize()
-            with torch.cuda.stream(stream):
-                cpu_tensor = tensor.to('cpu', non_blocking=True)
-            stream.synchronize()
-            cpu_tensor_array.append(cpu_tensor)
-        
-        for key, tensor in module_state_dict.items():
-            if numel >= 3327956992:
-                break
-            numel+=tensor.numel()
-            # self.cuda_stream_module_dict[key].synchronize()
-            with torch.cuda.stream(stream):
-                cpu_tensor = tensor.to('cpu', non_blocking=True)
-            stream.synchronize()
-            cpu_tensor_array.append(cpu_tensor)
-            
-        if dist.get_rank()==0:
-            print('module numel = ', numel)
-        numel = 0
-        for tensor, momentum in optimizer_state_dict.items():
-            
-            # self.cuda_stream_optimizer_dict_avg[tensor].synchronize()
-            with torch.cuda.stream(stream):
-                cpu_tensor = momentum['exp_avg'].to('cpu', non_blocking=True)
-            stream.synchronize()
-            cpu_tensor_array.append(cpu_tensor)
-            
-            numel+=cpu_tensor.numel()
-            
-            # self.cuda_stream_optimizer_dict_avg_sq[tensor].synchronize()
-            with torch.cuda.stream(stream): 
-                cpu_tensor = momentum['exp_avg_sq'].to('cpu', non_blocking=True)
-            stream.synchronize()
-            cpu_tensor_array.append(cpu_tensor)
-            numel+=cpu_tensor.numel()
-        
-        if dist.get_rank()==0:
-            print('optimizer  numel = ', numel)
-        
+        for name in self.layer_snapshot.order or layers.keys():
+            cpu_tensor_array.extend(layers[name])
+        for sub_group_id in sorted(moments):
+            cpu_tensor_array.extend(moments[sub_group_id])
+        if dist.get_rank() == 0 and version % 10 == 0:
+            print(f"snapshot {version}: " + self.layer_snapshot.format_stats())
         self.cpu_tensor_array = cpu_tensor_array
 
+    def _snapshot_sub_group(self, sub_group_id):
+        state = self.optimizer.state.get(self.fp32_partitioned_groups_flat[sub_group_id])
+        if state and 'exp_avg' in state:
+            self.layer_snapshot.snapshot_sub_group(sub_group_id, state['exp_avg'], state['exp_avg_sq'])
+
     def destroy(self):
         self.parameter_offload.destroy()
         for hook in self._grad_acc_hooks:
@@ -545,6 +504,7 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         for hook in self._leaf_module_hooks:
             hook.remove()
         print_rank_0("Removed grad acc hooks", force=False)
+        self.layer_snapshot.remove_hooks()
         del self.__ipg_bucket_flat_buffer
    
 
@@ -1625,6 +1585,7 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
     def reduce_ready_partitions_and_remove_grads(self, param):
         #print_rank_0(f"Backward {debug_param2name_id_shape(param)}", force=True)
         self.reduce_independent_p_g_buckets_and_remove_grads(param)
+        self.layer_snapshot.grad_ready(param)
 
     def zero_reduced_gradients(self, partition_id, i):
 
@@ -2161,13 +2122,9 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         """
         if self.save_ckpt_in_memory_thread != None:
             self.save_ckpt_in_memory_thread.join()
-            
-            for module_stream in self.cuda_stream_module_dict.values():
-                module_stream.synchronize()
-            for optimizer_stream in self.cuda_stream_optimizer_dict_avg.values():
-                optimizer_stream.synchronize()
-            for optimizer_stream in self.cuda_stream_optimizer_dict_avg_sq.values():
-                optimizer_stream.synchronize()
+
+        # The snapshot of the previous step must be out before this step overwrites its sources
+        self.layer_snapshot.complete()
                 
             # if self.step_count == 40:
             #     self.queue.put(self.cpu_tensor_array)
@@ -2192,6 +2149,8 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         timer_names.add(OPTIMIZER_STEP_TIMER)
         self.timers(OPTIMIZER_STEP_TIMER).start()
 
+        self.layer_snapshot.start(self.step_count)
+
         #update parameters one sub group at a time
         for sub_group_id, group in enumerate(self.fp16_groups):
 
@@ -2204,6 +2163,9 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
             #apply the optimizer step on the sub group and copy fp32 parameters to fp16
             self._optimizer_step(sub_group_id)
 
+            #snapshot the updated moments before they are released or swapped out
+            self._snapshot_sub_group(sub_group_id)
+
             #put fp16 parameters in appropriate location
             self._reassign_or_swap_out_partitioned_parameters(sub_group_id)
 
@@ -2359,8 +2321,6 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
     def backward(self, loss, retain_graph=False):
         
         self.step_count += 1
-        if self.step_count == 2:
-            self.module_state_backup = {k: v.clone().to(v.device) for k, v in self.module.state_dict().items()}
 
         """
         :attr:`backward` performs the following steps:
@@ -0,0 +1,225 @@
+import time
+from collections import deque
+import torch
+
+
+class _LayerTimer:
+    """Forward time of one layer, measured with CUDA events or the host clock."""
+
+    def __init__(self, use_cuda):
+        self.use_cuda = use_cuda
+        self.start = None
+        self.end = None
+
+    def record_start(self):
+        if self.use_cuda:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            self.start = time.perf_counter()
+
+    def record_end(self):
+        if self.start is None:
+            return
+        if self.use_cuda:
+            self.end = torch.cuda.Event(enable_timing=True)
+            self.end.record()
+        else:
+            self.end = time.perf_counter()
+
+    def elapsed(self):
+        """Seconds between the start and end of the last forward, None if incomplete."""
+        if self.start is None or self.end is None:
+            return None
+        if self.use_cuda:
+            self.end.synchronize()
+            elapsed = self.start.elapsed_time(self.end) / 1000.0
+        else:
+            elapsed = self.end - self.start
+        self.start = self.end = None
+        return elapsed
+
+
+class LayerCopyScheduler:
+    """
+    Spreads device-to-host copies over the forward pass of the next iteration.
+
+    The copy work is split into chunks. Each layer's forward pre-hook issues
+    only as many bytes as fit in that layer's measured forward time at the
+    measured copy bandwidth, so copies stay inside the layer's compute time.
+    Work that did not fit is issued by `finish`.
+    """
+
+    def __init__(self, module, chunk_bytes=4 << 20, safety=0.8, initial_bandwidth=10e9, ema=0.9, stream=None):
+        self.use_cuda = torch.cuda.is_available()
+        self.chunk_bytes = chunk_bytes
+        self.safety = safety
+        self.ema = ema
+        self.bandwidth = initial_bandwidth
+
+        if self.use_cuda and stream is None:
+            stream = torch.cuda.Stream()
+        self.stream = stream if self.use_cuda else None
+        self.ready_event = None
+        self.copy_start = None
+        self.copy_end = None
+        self.copied_bytes = 0
+
+        self.pending = deque()
+        self.active = False
+
+        # Per layer: forward time with and without copies, and bytes issued
+        self.layers = []
+        self.timers = []
+        self.base_time = []
+        self.copy_time = []
+        self.issued_bytes = []
+        self.iteration_bytes = []
+        self.overrun_bytes = 0
+
+        self.hooks = []
+        for name, layer in module.named_modules():
+            if not any(True for _ in layer.parameters(recurse=False)):
+                continue
+            layer_id = len(self.layers)
+            self.layers.append(name)
+            self.timers.append(_LayerTimer(self.use_cuda))
+            self.base_time.append(None)
+            self.copy_time.append(None)
+            self.issued_bytes.append(0)
+            self.iteration_bytes.append(0)
+            self.hooks.append(layer.register_forward_pre_hook(self._make_pre_hook(layer_id)))
+            self.hooks.append(layer.register_forward_hook(self._make_post_hook(layer_id)))
+
+    def remove_hooks(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    def plan(self, copies):
+        """Queue (src, dst) tensor pairs to be copied during the next forward pass."""
+        for src, dst in copies:
+            src = src.reshape(-1)
+            dst = dst.reshape(-1)
+            chunk_numel = max(1, self.chunk_bytes // src.element_size())
+            for start in range(0, src.numel(), chunk_numel):
+                numel = min(chunk_numel, src.numel() - start)
+                self.pending.append((src.narrow(0, start, numel), dst.narrow(0, start, numel)))
+
+        if self.use_cuda:
+            # The sources were produced by the optimizer step on the current stream
+            self.ready_event = torch.cuda.Event()
+            self.ready_event.record()
+        self.active = len(self.pending) > 0
+        for layer_id in range(len(self.layers)):
+            self.iteration_bytes[layer_id] = 0
+        self.overrun_bytes = 0
+
+    def _issue(self, budget_bytes):
+        issued = 0
+        if not self.pending:
+            return issued
+        if self.use_cuda:
+            with torch.cuda.stream(self.stream):
+                if self.ready_event is not None:
+                    self.stream.wait_event(self.ready_event)
+                    self.ready_event = None
+                if self.copy_start is None:
+                    self.copy_start = torch.cuda.Event(enable_timing=True)
+                    self.copy_start.record(self.stream)
+                while self.pending and issued < budget_bytes:
+                    src, dst = self.pending.popleft()
+                    dst.copy_(src, non_blocking=True)
+                    issued += src.numel() * src.element_size()
+                self.copy_end = torch.cuda.Event(enable_timing=True)
+                self.copy_end.record(self.stream)
+        else:
+            if self.copy_start is None:
+                self.copy_start = time.perf_counter()
+            while self.pending and issued < budget_bytes:
+                src, dst = self.pending.popleft()
+                dst.copy_(src)
+                issued += src.numel() * src.element_size()
+            self.copy_end = time.perf_counter()
+        self.copied_bytes += issued
+        return issued
+
+    def _make_pre_hook(self, layer_id):
+
+        def pre_hook(module, inputs):
+            self.timers[layer_id].record_start()
+            # Layers are timed once before copies are issued from their hooks
+            if not self.active or (self.copy_time[layer_id] is None and self.base_time[layer_id] is None):
+                return
+            layer_time = self.base_time[layer_id] if self.base_time[layer_id] is not None else self.copy_time[layer_id]
+            budget = layer_time * self.safety * self.bandwidth
+            issued = self._issue(budget)
+            self.iteration_bytes[layer_id] += issued
+            self.issued_bytes[layer_id] += issued
+
+        return pre_hook
+
+    def _make_post_hook(self, layer_id):
+
+        def post_hook(module, inputs, outputs):
+            self.timers[layer_id].record_end()
+
+        return post_hook
+
+    def _update(self, values, layer_id, sample):
+        if values[layer_id] is None:
+            values[layer_id] = sample
+        else:
+            values[layer_id] = self.ema * values[layer_id] + (1 - self.ema) * sample
+
+    def finish(self):
+        """Issue whatever did not fit, wait for the copies and update the measurements."""
+        self.overrun_bytes = sum(src.numel() * src.element_size() for src, _ in self.pending)
+        self._issue(float('inf'))
+
+        if self.copy_end is not None:
+            if self.use_cuda:
+                self.copy_end.synchronize()
+                elapsed = self.copy_start.elapsed_time(self.copy_end) / 1000.0
+            else:
+                elapsed = self.copy_end - self.copy_start
+            if elapsed > 0 and self.copied_bytes > 0:
+                self.bandwidth = self.ema * self.bandwidth + (1 - self.ema) * (self.copied_bytes / elapsed)
+
+        for layer_id, timer in enumerate(self.timers):
+            elapsed = timer.elapsed()
+            if elapsed is None:
+                continue
+            if self.iteration_bytes[layer_id] > 0:
+                self._update(self.copy_time, layer_id, elapsed)
+            else:
+                self._update(self.base_time, layer_id, elapsed)
+
+        self.copy_start = self.copy_end = None
+        self.copied_bytes = 0
+        self.active = False
+
+    def report(self):
+        """Per layer forward time without/with copies, the difference and the bytes issued."""
+        rows = []
+        for layer_id, name in enumerate(self.layers):
+            base = self.base_time[layer_id]
+            with_copy = self.copy_time[layer_id]
+            delta = with_copy - base if base is not None and with_copy is not None else None
+            rows.append({
+                "layer": name,
+                "base_ms": base * 1000.0 if base is not None else None,
+                "copy_ms": with_copy * 1000.0 if with_copy is not None else None,
+                "delta_ms": delta * 1000.0 if delta is not None else None,
+                "issued_bytes": self.issued_bytes[layer_id],
+            })
+        return rows
+
+    def format_report(self):
+        lines = [f"copy bandwidth {self.bandwidth / 1e9:.2f} GB/s, last overrun {self.overrun_bytes} bytes"]
+        for row in self.report():
+            if row["issued_bytes"] == 0:
+                continue
+            lines.append(f"{row['layer']}: base {row['base_ms']} ms, with copies {row['copy_ms']} ms, "
+                         f"delta {row['delta_ms']} ms, {row['issued_bytes']} bytes")
+        return "\n".join(lines)
@@ -2765,7 +2765,8 @@ class DeepSpeedEngine(Module):
                         load_optimizer_states=True,
                         load_lr_scheduler_states=True,
                         load_module_only=False,
-                        custom_load_fn=None):
+                        custom_load_fn=None,
+                        load_from_shared_memory=False):
         """
         Load training checkpoint
 
@@ -2777,11 +2778,15 @@ class DeepSpeedEngine(Module):
             load_lr_scheduler_states: Optional. Boolean to add the learning rate scheduler states from Checkpoint.
             load_module_only: Optional. Boolean to load only the model weights from the checkpoint. Ex. warmstarting.
             custom_load_fn: Optional. Custom model load function.
+            load_from_shared_memory: Optional. Boolean to first try a warm restart from the DelayCheck snapshot
+                left in the node's shared memory or held by peer replicas, falling back to ``load_dir`` if it
+                is missing or inconsistent. Ignored when ``tag`` names a checkpoint on disk.
 
         Returns:
             A tuple of ``load_path`` and ``client_state``.
             *``load_path``: Path of the loaded checkpoint. ``None`` if loading the checkpoint failed.
             *``client_state``: State dictionary used for loading required training states in the client code.
+              After a warm restart it holds the step counters of the restored snapshot.
 
         Important: under ZeRO3, one cannot load checkpoint with ``engine.load_checkpoint()`` right
         after ``engine.save_checkpoint()``. It is because ``engine.module`` is partitioned, and
@@ -2790,6 +2795,17 @@ class DeepSpeedEngine(Module):
 
         """
 
+        if load_from_shared_memory and tag is None and load_optimizer_states and not load_module_only:
+            version = self._load_shared_memory_snapshot(load_lr_scheduler_states=load_lr_scheduler_states)
+            if version is not None:
+                client_state = {
+                    'iteration': version,
+                    'global_steps': self.global_steps,
+                    'global_samples': self.global_samples,
+                    'skipped_steps': self.skipped_steps
+                }
+                return f"shm://{version}", client_state
+
         if tag is None:
             latest_tag = "latest_universal" if self.load_universal_checkpoint() else "latest"
             latest_path = os.path.join(load_dir, latest_tag)
@@ -2984,6 +3000,36 @@ class DeepSpeedEngine(Module):
 
         return load_path, client_state
 
+    def _load_shared_memory_snapshot(self, load_lr_scheduler_states=True):
+        # Only the DelayCheck ZeRO-3 optimizer keeps snapshots in shared memory
+        if not hasattr(self.optimizer, 'restore_from_shared_memory'):
+            return None
+        ranks_per_node = int(os.environ.get('LOCAL_WORLD_SIZE', get_accelerator().device_count()))
+        version = self.optimizer.restore_from_shared_memory(dist.get_local_rank(), ranks_per_node)
+        if version is None:
+            # A replaced node has no node-local snapshot, its buddies still hold replicas
+            log_dist("No usable DelayCheck snapshot in shared memory, trying peer replicas", ranks=[0])
+            version = self.optimizer.restore_from_peer()
+        if version is None:
+            log_dist("No usable DelayCheck peer replicas, loading from disk", ranks=[0])
+            return None
+        self.global_steps = version
+        self.global_samples = version * self.train_batch_size()
+        self.skipped_steps = 0
+        if load_lr_scheduler_states and self.lr_scheduler is not None:
+            self._fast_forward_lr_scheduler(version)
+        return version
+
+    def _fast_forward_lr_scheduler(self, steps):
+        # Snapshots do not hold the scheduler, replay the once-per-step schedule instead
+        if hasattr(self.lr_scheduler, 'last_batch_iteration'):
+            # DeepSpeed schedulers jump straight to a batch iteration
+            self.lr_scheduler.step(last_batch_iteration=steps - 1)
+        else:
+            for _ in range(steps):
+                self.lr_scheduler.step()
+        log_dist(f"Fast-forwarded the lr scheduler to step {steps}", ranks=[0])
+
     def _load_zero_checkpoint(self, load_dir, tag, load_optimizer_states=True):
 
         load_serial = None
@@ -0,0 +1,189 @@
+import math
+
+# "delaycheck" section of the DeepSpeed config read by CheckpointIntervalTuner.from_config
+DELAYCHECK_CONFIG = 'delaycheck'
+MTBF = 'mtbf'
+NODE_MTBF = 'node_mtbf'
+DISK_BANDWIDTH = 'disk_bandwidth'
+SNAPSHOT_INTERVAL = 'snapshot_interval'
+FLUSH_INTERVAL = 'flush_interval'
+DRIFT = 'retune_drift'
+
+MTBF_DEFAULT = 24 * 3600.0
+DISK_BANDWIDTH_DEFAULT = 1e9
+SNAPSHOT_INTERVAL_DEFAULT = 1
+FLUSH_INTERVAL_DEFAULT = 10
+DRIFT_DEFAULT = 0.2
+
+
+def _config_dict(ds_config):
+    if isinstance(ds_config, dict):
+        return ds_config
+    return getattr(ds_config, '_param_dict', None) or {}
+
+
+def daly_interval(cost, mtbf):
+    """Daly's higher-order estimate of the optimal time between checkpoints of cost `cost`."""
+    if cost <= 0:
+        return 0.0
+    if cost >= 2 * mtbf:
+        return mtbf
+    ratio = cost / (2 * mtbf)
+    return math.sqrt(2 * cost * mtbf) * (1 + math.sqrt(ratio) / 3 + ratio / 9) - cost
+
+
+def wasted_fraction(cost, interval, mtbf):
+    """First-order fraction of time lost to checkpointing plus expected rework after a failure."""
+    if interval <= 0:
+        return 0.0
+    return cost / (interval + cost) + (interval + cost) / (2 * mtbf)
+
+
+class _Ema:
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, sample):
+        if self.value is None:
+            self.value = sample
+        else:
+            self.value = (1 - self.alpha) * self.value + self.alpha * sample
+        return self.value
+
+
+class CheckpointIntervalTuner:
+    """
+    Picks the in-memory snapshot interval and the on-disk flush interval.
+
+    In-memory snapshots protect against failures that leave the node up
+    (rate 1/mtbf), disk flushes against losing the node (rate 1/node_mtbf).
+    Both intervals come from Daly's model using the measured blocking cost of
+    a snapshot, the measured disk bandwidth and the measured iteration time,
+    and are expressed in iterations. The flush interval is a multiple of the
+    snapshot interval since only committed snapshots are flushed. The model
+    is re-evaluated when a measurement drifts by more than `drift` from the
+    value used for the last decision.
+    """
+
+    def __init__(self,
+                 mtbf=MTBF_DEFAULT,
+                 node_mtbf=None,
+                 disk_bandwidth=DISK_BANDWIDTH_DEFAULT,
+                 snapshot_interval=SNAPSHOT_INTERVAL_DEFAULT,
+                 flush_interval=FLUSH_INTERVAL_DEFAULT,
+                 drift=DRIFT_DEFAULT):
+        self.mtbf = float(mtbf)
+        self.node_mtbf = float(node_mtbf) if node_mtbf is not None else self.mtbf
+        self.drift = drift
+
+        self.iteration_time = _Ema()
+        self.snapshot_cost = _Ema()
+        self.disk_bandwidth = _Ema()
+        self.disk_bandwidth.value = float(disk_bandwidth)
+        self.snapshot_nbytes = 0
+
+        self.snapshot_interval = int(snapshot_interval)
+        self.flush_interval = int(flush_interval)
+        self.snapshot_waste = None
+        self.flush_waste = None
+        # Measurements the current intervals were chosen from
+        self.tuned_on = None
+
+    @classmethod
+    def from_config(cls, ds_config):
+        section = _config_dict(ds_config).get(DELAYCHECK_CONFIG, {})
+        return cls(mtbf=section.get(MTBF, MTBF_DEFAULT),
+                   node_mtbf=section.get(NODE_MTBF),
+                   disk_bandwidth=section.get(DISK_BANDWIDTH, DISK_BANDWIDTH_DEFAULT),
+                   snapshot_interval=section.get(SNAPSHOT_INTERVAL, SNAPSHOT_INTERVAL_DEFAULT),
+                   flush_interval=section.get(FLUSH_INTERVAL, FLUSH_INTERVAL_DEFAULT),
+                   drift=section.get(DRIFT, DRIFT_DEFAULT))
+
+    def snapshot_due(self, iteration):
+        return iteration % self.snapshot_interval == 0
+
+    def flush_due(self, iteration):
+        return iteration > 0 and iteration % self.flush_interval == 0
+
+    def record_iteration(self, seconds):
+        self.iteration_time.update(seconds)
+
+    def record_snapshot(self, seconds, nbytes=None):
+        self.snapshot_cost.update(seconds)
+        if nbytes is not None:
+            self.snapshot_nbytes = nbytes
+
+    def record_flush(self, nbytes, seconds):
+        if seconds > 0 and nbytes > 0:
+            self.disk_bandwidth.update(nbytes / seconds)
+            self.snapshot_nbytes = nbytes
+
+    def measured(self):
+        """Raw measurements as floats (-1 when missing), for agreeing on them across ranks."""
+        return [
+            self.iteration_time.value if self.iteration_time.value is not None else -1.0,
+            self.snapshot_cost.value if self.snapshot_cost.value is not None else -1.0,
+            float(self.snapshot_nbytes),
+            self.disk_bandwidth.value,
+        ]
+
+    def set_measured(self, values):
+        iteration_time, snapshot_cost, snapshot_nbytes, disk_bandwidth = values
+        self.iteration_time.value = iteration_time if iteration_time >= 0 else None
+        self.snapshot_cost.value = snapshot_cost if snapshot_cost >= 0 else None
+        self.snapshot_nbytes = int(snapshot_nbytes)
+        self.disk_bandwidth.value = disk_bandwidth
+
+    @property
+    def flush_cost(self):
+        return self.snapshot_nbytes / self.disk_bandwidth.value
+
+    def _measurements(self):
+        return (self.iteration_time.value, self.snapshot_cost.value, self.flush_cost)
+
+    def _drifted(self):
+        if self.tuned_on is None:
+            return True
+        for current, tuned in zip(self._measurements(), self.tuned_on):
+            if tuned is None or current is None:
+                if tuned != current:
+                    return True
+            elif abs(current - tuned) > self.drift * max(abs(tuned), 1e-9):
+                return True
+        return False
+
+    def maybe_retune(self):
+        """Recompute the intervals if the measurements moved; True if an interval changed."""
+        if self.iteration_time.value is None or self.snapshot_cost.value is None:
+            return False
+        if not self._drifted():
+            return False
+        iteration_time = max(self.iteration_time.value, 1e-6)
+
+        snapshot_seconds = daly_interval(self.snapshot_cost.value, self.mtbf)
+        snapshot_interval = max(1, int(round(snapshot_seconds / iteration_time)))
+
+        flush_seconds = daly_interval(self.flush_cost, self.node_mtbf)
+        flush_interval = max(1, int(round(flush_seconds / iteration_time)))
+        flush_interval = max(snapshot_interval,
+                             int(math.ceil(flush_interval / snapshot_interval)) * snapshot_interval)
+
+        self.snapshot_waste = wasted_fraction(self.snapshot_cost.value, snapshot_interval * iteration_time, self.mtbf)
+        self.flush_waste = wasted_fraction(self.flush_cost, flush_interval * iteration_time, self.node_mtbf)
+        self.tuned_on = self._measurements()
+
+        changed = (snapshot_interval, flush_interval) != (self.snapshot_interval, self.flush_interval)
+        self.snapshot_interval = snapshot_interval
+        self.flush_interval = flush_interval
+        return changed
+
+    def describe(self):
+        iteration_time, snapshot_cost, flush_cost = self._measurements()
+        waste = lambda value: f"{value * 100:.3f}%" if value is not None else "n/a"
+        fmt = lambda value: f"{value:.4f}s" if value is not None else "n/a"
+        return (f"snapshot every {self.snapshot_interval} iterations, flush every {self.flush_interval} iterations; "
+                f"iteration {fmt(iteration_time)}, snapshot cost {fmt(snapshot_cost)}, flush cost {fmt(flush_cost)} "
+                f"({self.disk_bandwidth.value / 1e6:.1f} MB/s); expected waste: in-memory {waste(self.snapshot_waste)}, "
+                f"disk {waste(self.flush_waste)}")
@@ -0,0 +1,201 @@
+import json
+import multiprocessing as mp
+import os
+import queue
+import time
+
+from .shm_arena import ALIGNMENT, SharedMemoryArena, align_up
+
+INDEX_SUFFIX = '.index.json'
+CHUNK_BYTES = 64 << 20
+MAX_RETRIES = 3
+
+
+def node_file_path(save_dir, node_id):
+    return os.path.join(save_dir, f"delaycheck_node{node_id}.ckpt")
+
+
+def node_file_layout(arenas):
+    """File offset of every (buffer, local rank) region, each aligned to ALIGNMENT."""
+    layout = []
+    offset = 0
+    for name, arena in arenas.items():
+        for rank in range(arena.num_ranks):
+            _, numel, _ = arena.entry(rank)
+            nbytes = numel * arena.itemsize
+            layout.append((name, rank, offset, numel, nbytes))
+            offset = align_up(offset + nbytes, ALIGNMENT)
+    return layout, offset
+
+
+def _write_region(fd, buf, src_offset, nbytes, file_offset, chunk_bytes):
+    view = buf[src_offset:src_offset + nbytes]
+    written = 0
+    while written < nbytes:
+        written += os.pwrite(fd, view[written:written + chunk_bytes], file_offset + written)
+    view.release()
+
+
+def _preallocate(path, total_bytes):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    if os.fstat(fd).st_size != total_bytes:
+        os.ftruncate(fd, total_bytes)
+        if hasattr(os, 'posix_fallocate') and total_bytes > 0:
+            os.posix_fallocate(fd, 0, total_bytes)
+    return fd
+
+
+def _wait_for_version(arenas, version, timeout):
+    deadline = time.time() + timeout
+    while True:
+        if all(arena.rank_version(rank) >= version for arena in arenas.values() for rank in range(arena.num_ranks)):
+            return True
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+
+
+def flush_node_file(arenas, path, node_id, version, chunk_bytes=CHUNK_BYTES):
+    """
+    Write every local rank's region of `arenas` into the node file at `path`.
+
+    The file is preallocated once and rewritten in place with large sequential
+    writes. The index is removed before the data is touched and rewritten
+    atomically after an fsync, so a file without an index is never trusted.
+    A region that a rank republished while it was being written is retried;
+    returns the index, or raises RuntimeError if a region stayed torn. A
+    region still being copied into (version -1) is left out of the index.
+    """
+    layout, total_bytes = node_file_layout(arenas)
+    index_path = path + INDEX_SUFFIX
+    if os.path.exists(index_path):
+        os.unlink(index_path)
+
+    start = time.time()
+    fd = _preallocate(path, total_bytes)
+    regions = []
+    skipped = []
+    nbytes_written = 0
+    try:
+        for name, rank, file_offset, numel, nbytes in layout:
+            arena = arenas[name]
+            src_offset = arena.entry(rank)[0]
+            for _ in range(MAX_RETRIES):
+                region_version = arena.rank_version(rank)
+                if region_version < 0:
+                    # The rank is copying into the region
+                    time.sleep(0.01)
+                    continue
+                _write_region(fd, arena.shm.buf, src_offset, nbytes, file_offset, chunk_bytes)
+                if arena.rank_version(rank) == region_version:
+                    break
+            else:
+                if region_version < 0:
+                    skipped.append({"buffer": name, "local_rank": rank})
+                    continue
+                raise RuntimeError(f"region {name}[{rank}] kept changing while it was written")
+            nbytes_written += nbytes
+            regions.append({
+                "buffer": name,
+                "local_rank": rank,
+                "dtype": str(arena.dtype),
+                "numel": numel,
+                "offset": file_offset,
+                "nbytes": nbytes,
+                "version": region_version,
+            })
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    seconds = time.time() - start
+
+    index = {
+        "node": node_id,
+        "version": version,
+        "file": os.path.basename(path),
+        "alignment": ALIGNMENT,
+        "total_bytes": total_bytes,
+        "regions": regions,
+        "skipped": skipped,
+        "nbytes": nbytes_written,
+        "seconds": seconds,
+        "mb_per_s": nbytes_written / seconds / 1e6 if seconds > 0 else 0.0,
+    }
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, index_path)
+    return index
+
+
+def _aggregator_main(arena_specs, save_dir, node_id, requests, results, timeout):
+    arenas = None
+    path = node_file_path(save_dir, node_id)
+    os.makedirs(save_dir, exist_ok=True)
+    while True:
+        version = requests.get()
+        if version is None:
+            break
+        try:
+            if arenas is None:
+                arenas = {name: SharedMemoryArena.attach(shm_name, dtype) for name, shm_name, dtype in arena_specs}
+            if not _wait_for_version(arenas, version, timeout):
+                raise RuntimeError(f"local ranks did not publish version {version} within {timeout}s")
+            index = flush_node_file(arenas, path, node_id, version)
+            results.put({key: index[key] for key in ("version", "nbytes", "seconds", "mb_per_s")})
+        except Exception as e:
+            results.put({"version": version, "error": str(e)})
+    if arenas is not None:
+        for arena in arenas.values():
+            arena.close()
+
+
+class NodeAggregator:
+    """
+    Per-node process that writes the node's shared-memory snapshot to one file.
+
+    Local ranks publish their committed snapshot into the node arenas and
+    local rank 0 calls `request(version)`. The aggregator waits until every
+    local rank's regions carry that version, writes them into a single
+    preallocated file with large aligned writes and reports the achieved
+    bandwidth through `poll`. No training process does any file I/O.
+    """
+
+    def __init__(self, arenas, save_dir, node_id, timeout=60.0):
+        ctx = mp.get_context('spawn')
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.path = node_file_path(save_dir, node_id)
+        arena_specs = [(name, arena.name, arena.dtype) for name, arena in arenas.items()]
+        self.process = ctx.Process(target=_aggregator_main,
+                                   args=(arena_specs, save_dir, node_id, self.requests, self.results, timeout),
+                                   name=f"delaycheck-aggregator-{node_id}",
+                                   daemon=True)
+        self.process.start()
+        self.pending = 0
+
+    def request(self, version):
+        self.requests.put(version)
+        self.pending += 1
+
+    def poll(self, block=False):
+        """Results of finished flushes: dicts with version, nbytes, seconds, mb_per_s or error."""
+        done = []
+        while self.pending > 0:
+            try:
+                done.append(self.results.get(block=block))
+            except queue.Empty:
+                break
+            self.pending -= 1
+        return done
+
+    def shutdown(self):
+        if self.process is None:
+            return []
+        done = self.poll(block=True)
+        self.requests.put(None)
+        self.process.join()
+        self.process = None
+        return done
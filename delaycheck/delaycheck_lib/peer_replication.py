@@ -0,0 +1,436 @@
+import os
+import pickle
+import queue
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+import torch
+import torch.distributed as dist
+
+from .interval_tuner import DELAYCHECK_CONFIG, _config_dict
+from .shm_arena import ALIGNMENT, _unlink, _untrack, align_up, job_prefix
+
+# Keys of the "delaycheck" config section
+PEER_REPLICAS = 'peer_replicas'
+PEER_INTERVAL = 'peer_interval'
+PEER_RATE_LIMIT = 'peer_rate_limit'
+PEER_CHUNK_BYTES = 'peer_chunk_bytes'
+
+PEER_INTERVAL_DEFAULT = 10
+PEER_CHUNK_BYTES_DEFAULT = 16 << 20
+
+# Offsets inside a packed snapshot are aligned so every tensor can be viewed in place
+_PACK_ALIGNMENT = 8
+
+REPLICA_MAGIC = b'DCKR'
+# magic, generation (-1 while being received into), metadata bytes, data bytes
+_REPLICA_HEADER = struct.Struct('<4sqQQ')
+
+
+def _align(nbytes):
+    return (nbytes + _PACK_ALIGNMENT - 1) // _PACK_ALIGNMENT * _PACK_ALIGNMENT
+
+
+def _as_bytes(tensor):
+    return tensor.reshape(-1).view(torch.uint8)
+
+
+def packed_nbytes(snapshot):
+    return sum(_align(t.numel() * t.element_size()) for t in snapshot.model + snapshot.exp_avg + snapshot.exp_avg_sq)
+
+
+def pack_snapshot(snapshot, out):
+    """Copy a committed snapshot into the flat byte tensor `out`; returns the metadata to unpack it."""
+    offset = 0
+    for tensor in snapshot.model + snapshot.exp_avg + snapshot.exp_avg_sq:
+        nbytes = tensor.numel() * tensor.element_size()
+        out.narrow(0, offset, nbytes).copy_(_as_bytes(tensor))
+        offset += _align(nbytes)
+    return {
+        "version": snapshot.version,
+        "nbytes": offset,
+        "bucket_params": snapshot.bucket_params,
+        "model_numels": [t.numel() for t in snapshot.model],
+        "model_dtype": snapshot.model[0].dtype if snapshot.model else torch.float16,
+        "optimizer_numels": [t.numel() for t in snapshot.exp_avg],
+        "optimizer_dtype": snapshot.exp_avg[0].dtype if snapshot.exp_avg else torch.float32,
+    }
+
+
+class ReplicaSnapshot:
+    """A snapshot held on behalf of another rank, with the attributes of CommittedSnapshot."""
+
+    def __init__(self, meta, data):
+        self.version = meta["version"]
+        self.bucket_params = meta["bucket_params"]
+        offset = 0
+
+        def take(numel, dtype):
+            nonlocal offset
+            nbytes = numel * torch.tensor([], dtype=dtype).element_size()
+            view = data.narrow(0, offset, nbytes).view(dtype)
+            offset += _align(nbytes)
+            return view
+
+        self.model = [take(numel, meta["model_dtype"]) for numel in meta["model_numels"]]
+        self.exp_avg = [take(numel, meta["optimizer_dtype"]) for numel in meta["optimizer_numels"]]
+        self.exp_avg_sq = [take(numel, meta["optimizer_dtype"]) for numel in meta["optimizer_numels"]]
+
+
+def _close_segment(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # Replica views still reference the mapping, it goes away with the process
+        pass
+
+
+class _ReplicaSlot:
+    """
+    Double buffer for the snapshots received from one source rank.
+
+    Each buffer is a shared-memory segment: a header, the pickled metadata and
+    the packed snapshot. A buffer is marked invalid while it is received into
+    and stamped with the next generation once complete. The segments are not
+    unlinked at exit, so after the job dies and restarts the replicator
+    attaches to them again and `current` is the latest complete replica.
+    """
+
+    def __init__(self, prefix):
+        self.names = [f"{prefix}{i}" for i in range(2)]
+        self.segments = [None, None]
+        self.current = None
+        self.generation = 0
+        self.index = 0
+        for i, name in enumerate(self.names):
+            try:
+                self.segments[i] = _untrack(shared_memory.SharedMemory(name=name))
+            except FileNotFoundError:
+                continue
+            loaded = self._load(i)
+            if loaded is not None and loaded[0] > self.generation:
+                self.generation, self.current = loaded[0], loaded[1:]
+                # Receive into the other buffer first
+                self.index = 1 - i
+
+    def _load(self, i):
+        shm = self.segments[i]
+        if shm.size < _REPLICA_HEADER.size:
+            return None
+        magic, generation, meta_bytes, data_bytes = _REPLICA_HEADER.unpack_from(shm.buf, 0)
+        if magic != REPLICA_MAGIC or generation <= 0:
+            return None
+        meta = pickle.loads(bytes(shm.buf[_REPLICA_HEADER.size:_REPLICA_HEADER.size + meta_bytes]))
+        return generation, meta, self._data(shm, meta_bytes, data_bytes)
+
+    @staticmethod
+    def _data(shm, meta_bytes, data_bytes):
+        if data_bytes == 0:
+            return torch.empty(0, dtype=torch.uint8)
+        offset = align_up(_REPLICA_HEADER.size + meta_bytes, ALIGNMENT)
+        return torch.frombuffer(shm.buf, dtype=torch.uint8, count=data_bytes, offset=offset)
+
+    def incoming(self, meta):
+        """Invalidate the spare buffer and return its data view, sized for the snapshot `meta` describes."""
+        payload = pickle.dumps(meta)
+        needed = align_up(_REPLICA_HEADER.size + len(payload), ALIGNMENT) + meta["nbytes"]
+        shm = self.segments[self.index]
+        if shm is None or shm.size < needed:
+            if shm is not None:
+                _close_segment(shm)
+                _unlink(shm)
+            shm = _untrack(shared_memory.SharedMemory(name=self.names[self.index], create=True, size=needed))
+            self.segments[self.index] = shm
+        _REPLICA_HEADER.pack_into(shm.buf, 0, REPLICA_MAGIC, -1, len(payload), meta["nbytes"])
+        shm.buf[_REPLICA_HEADER.size:_REPLICA_HEADER.size + len(payload)] = payload
+        return self._data(shm, len(payload), meta["nbytes"])
+
+    def publish(self, meta):
+        shm = self.segments[self.index]
+        self.generation += 1
+        _, _, meta_bytes, data_bytes = _REPLICA_HEADER.unpack_from(shm.buf, 0)
+        _REPLICA_HEADER.pack_into(shm.buf, 0, REPLICA_MAGIC, self.generation, meta_bytes, data_bytes)
+        self.current = (meta, self._data(shm, meta_bytes, data_bytes))
+        self.index = 1 - self.index
+
+    def destroy(self):
+        self.current = None
+        for shm in self.segments:
+            if shm is not None:
+                _close_segment(shm)
+                try:
+                    _unlink(shm)
+                except FileNotFoundError:
+                    pass
+        self.segments = [None, None]
+
+
+class PeerReplicator:
+    """
+    Replicates committed DelayCheck snapshots into buddy nodes' CPU memory.
+
+    Rank r sends to the rank at the same local position `k` nodes further
+    (k = 1..replicas) and holds the snapshots of the ranks `k` nodes before
+    it. Every round packs the committed snapshot into a staging buffer,
+    releasing the store right away, and streams it over a gloo group in
+    chunks, sleeping between chunks to stay under `rate_limit` bytes/s so
+    the transfer leaves room for ZeRO-3 collectives. Replicas are double
+    buffered: a partially received snapshot never replaces a complete one.
+    They are kept in shared memory named after `prefix`, which outlives the
+    job: when a node is lost and the job restarts, the buddies still hold
+    the snapshots and `recover` sends them to the replacement ranks.
+    `destroy` removes them on a clean shutdown.
+
+    Rounds are collective, so every rank must call `replicate` at the same
+    iterations. They run in order on a background thread.
+    """
+
+    def __init__(self,
+                 snapshot_store,
+                 ranks_per_node,
+                 replicas=1,
+                 rate_limit=None,
+                 chunk_bytes=PEER_CHUNK_BYTES_DEFAULT,
+                 prefix=None):
+        self.snapshot_store = snapshot_store
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.ranks_per_node = ranks_per_node
+        self.num_nodes = self.world_size // ranks_per_node
+        self.replicas = min(replicas, self.num_nodes - 1)
+        self.rate_limit = rate_limit
+        self.chunk_bytes = chunk_bytes
+
+        # Point-to-point traffic stays off the NCCL communicator used for training
+        self.group = dist.new_group(backend='gloo')
+
+        self.staging = torch.empty(0, dtype=torch.uint8)
+        prefix = job_prefix() if prefix is None else prefix
+        self.slots = {
+            self.source(k): _ReplicaSlot(f"{prefix}replica{self.rank}_of{self.source(k)}_")
+            for k in range(1, self.replicas + 1)
+        }
+
+        self.rounds = 0
+        self.bytes_sent = 0
+        self.send_time = 0.0
+        self.last_error = None
+
+        self.requests = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self._run, name="delaycheck-peer-replication", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_config(cls, ds_config, snapshot_store, ranks_per_node):
+        section = _config_dict(ds_config).get(DELAYCHECK_CONFIG, {})
+        return cls(snapshot_store,
+                   ranks_per_node,
+                   replicas=section.get(PEER_REPLICAS, 1),
+                   rate_limit=section.get(PEER_RATE_LIMIT),
+                   chunk_bytes=section.get(PEER_CHUNK_BYTES, PEER_CHUNK_BYTES_DEFAULT))
+
+    def target(self, k, rank=None):
+        rank = self.rank if rank is None else rank
+        return (rank + k * self.ranks_per_node) % self.world_size
+
+    def source(self, k, rank=None):
+        rank = self.rank if rank is None else rank
+        return (rank - k * self.ranks_per_node) % self.world_size
+
+    def replicate(self):
+        """Queue one replication round of the currently committed snapshot."""
+        if self.replicas > 0:
+            self.requests.put(True)
+
+    def drain(self):
+        self.requests.join()
+
+    def shutdown(self):
+        if self.thread is None:
+            return
+        self.requests.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def destroy(self):
+        """Stop replicating and remove the held replicas; call only on a clean shutdown."""
+        self.shutdown()
+        for slot in self.slots.values():
+            slot.destroy()
+
+    def replica(self, source_rank):
+        """The latest complete snapshot held for `source_rank`, or None."""
+        slot = self.slots.get(source_rank)
+        if slot is None or slot.current is None:
+            return None
+        return ReplicaSnapshot(*slot.current)
+
+    def stats(self):
+        return {
+            "rounds": self.rounds,
+            "bytes_sent": self.bytes_sent,
+            "send_time": self.send_time,
+            "held_versions": {src: slot.current[0]["version"] for src, slot in self.slots.items() if slot.current},
+            "last_error": self.last_error,
+        }
+
+    def _pack_local(self):
+        with self.snapshot_store.read() as snapshot:
+            if snapshot is None:
+                return {"version": -1, "nbytes": 0}
+            nbytes = packed_nbytes(snapshot)
+            if self.staging.numel() < nbytes:
+                self.staging = torch.empty(nbytes, dtype=torch.uint8)
+            return pack_snapshot(snapshot, self.staging)
+
+    def _exchange_meta(self, meta, dst, src):
+        payload = torch.frombuffer(bytearray(pickle.dumps(meta)), dtype=torch.uint8)
+        send_len = torch.tensor([payload.numel()], dtype=torch.int64)
+        recv_len = torch.empty(1, dtype=torch.int64)
+        ops = [dist.isend(send_len, dst, group=self.group), dist.irecv(recv_len, src, group=self.group)]
+        for op in ops:
+            op.wait()
+        recv_payload = torch.empty(int(recv_len.item()), dtype=torch.uint8)
+        ops = [dist.isend(payload, dst, group=self.group), dist.irecv(recv_payload, src, group=self.group)]
+        for op in ops:
+            op.wait()
+        return pickle.loads(recv_payload.numpy().tobytes())
+
+    def _stream(self, send, send_nbytes, dst, recv, recv_nbytes, src):
+        start = time.time()
+        sent = 0
+        offset = 0
+        while offset < max(send_nbytes, recv_nbytes):
+            ops = []
+            if offset < send_nbytes:
+                numel = min(self.chunk_bytes, send_nbytes - offset)
+                ops.append(dist.isend(send.narrow(0, offset, numel), dst, group=self.group))
+                sent += numel
+            if offset < recv_nbytes:
+                numel = min(self.chunk_bytes, recv_nbytes - offset)
+                ops.append(dist.irecv(recv.narrow(0, offset, numel), src, group=self.group))
+            for op in ops:
+                op.wait()
+            offset += self.chunk_bytes
+            if self.rate_limit:
+                # Token bucket: never run ahead of rate_limit bytes/s
+                ahead = sent / self.rate_limit - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return sent, time.time() - start
+
+    def _round(self):
+        meta = self._pack_local()
+        for k in range(1, self.replicas + 1):
+            dst, src = self.target(k), self.source(k)
+            recv_meta = self._exchange_meta(meta, dst, src)
+            slot = self.slots[src]
+            recv = slot.incoming(recv_meta)
+            sent, seconds = self._stream(self.staging, meta["nbytes"], dst, recv, recv_meta["nbytes"], src)
+            if recv_meta["version"] >= 0:
+                slot.publish(recv_meta)
+            self.bytes_sent += sent
+            self.send_time += seconds
+        self.rounds += 1
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            try:
+                if request is None:
+                    return
+                self._round()
+            except Exception as e:
+                self.last_error = str(e)
+            finally:
+                self.requests.task_done()
+
+    def recover(self, lost_ranks, k=1):
+        """
+        Send replicas back to the ranks in `lost_ranks` (collective).
+
+        Returns a ReplicaSnapshot on a lost rank whose buddy still holds its
+        snapshot, None everywhere else; a lost rank that gets None falls back
+        to the disk checkpoint. A buddy that holds nothing, e.g. one that was
+        replaced itself, answers with an empty snapshot. Replication must be
+        drained first.
+        """
+        lost_ranks = set(lost_ranks)
+        recovered = None
+        for lost in sorted(lost_ranks):
+            holder = self.target(k, lost)
+            if holder == lost:
+                continue
+            if self.rank == holder:
+                slot = self.slots.get(lost)
+                meta, data = slot.current if slot is not None and slot.current else ({"version": -1, "nbytes": 0}, None)
+                payload = torch.frombuffer(bytearray(pickle.dumps(meta)), dtype=torch.uint8)
+                dist.send(torch.tensor([payload.numel()], dtype=torch.int64), lost, group=self.group)
+                dist.send(payload, lost, group=self.group)
+                if meta["nbytes"] > 0:
+                    self._stream(data, meta["nbytes"], lost, None, 0, lost)
+            elif self.rank == lost:
+                length = torch.empty(1, dtype=torch.int64)
+                dist.recv(length, holder, group=self.group)
+                payload = torch.empty(int(length.item()), dtype=torch.uint8)
+                dist.recv(payload, holder, group=self.group)
+                meta = pickle.loads(payload.numpy().tobytes())
+                if meta["nbytes"] > 0:
+                    data = torch.empty(meta["nbytes"], dtype=torch.uint8)
+                    self._stream(None, 0, holder, data, meta["nbytes"], holder)
+                    recovered = ReplicaSnapshot(meta, data)
+        return recovered
+
+
+def benchmark_peer_recovery(numel=1 << 26, ranks_per_node=1, save_dir='./checkpoint/'):
+    """
+    Time recovering the last rank's snapshot from its buddy against reading it from disk.
+
+    Run with one process per rank, e.g.
+    torchrun --nnodes 1 --nproc_per_node 2 -m delaycheck_lib.peer_replication
+    """
+    from .snapshot_store import MODEL_PART, OPTIMIZER_PART, VersionedSnapshotStore
+
+    store = VersionedSnapshotStore([numel], [numel], pin_memory=False)
+    bank = store.begin(0)
+    bank.model.copy_from(torch.randn(numel).half(), 0, 0, non_blocking=False)
+    bank.bucket_params[0] = [(0, numel)]
+    bank.exp_avg[0].normal_()
+    bank.exp_avg_sq[0].normal_()
+    store.mark_written(MODEL_PART)
+    store.mark_written(OPTIMIZER_PART)
+    store.commit()
+
+    replicator = PeerReplicator(store, ranks_per_node)
+    replicator.replicate()
+    replicator.drain()
+
+    lost = dist.get_world_size() - 1
+    dist.barrier()
+    start = time.time()
+    recovered = replicator.recover([lost])
+    dist.barrier()
+    peer_time = time.time() - start
+
+    disk_time = None
+    if dist.get_rank() == lost:
+        os.makedirs(save_dir, exist_ok=True)
+        path = os.path.join(save_dir, f"peer_benchmark_rank{lost}.pt")
+        with store.read() as snapshot:
+            torch.save((snapshot.model, snapshot.exp_avg, snapshot.exp_avg_sq), path)
+        start = time.time()
+        torch.load(path)
+        disk_time = time.time() - start
+        os.remove(path)
+        ok = recovered is not None and torch.equal(recovered.exp_avg[0], bank.exp_avg[0])
+        print(f"rank {lost}: peer recovery {peer_time:.3f}s, disk recovery {disk_time:.3f}s, "
+              f"replica matches: {ok}, {replicator.stats()}")
+    replicator.destroy()
+    return peer_time, disk_time
+
+
+if __name__ == "__main__":
+    dist.init_process_group(backend='gloo')
+    benchmark_peer_recovery(ranks_per_node=int(os.environ.get('PEER_BENCH_RANKS_PER_NODE', 1)))
+    dist.destroy_process_group()
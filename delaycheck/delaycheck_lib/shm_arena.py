@@ -0,0 +1,242 @@
+import os
+import struct
+from multiprocessing import resource_tracker, shared_memory
+import torch
+
+ARENA_MAGIC = b'DCKA'
+ARENA_FORMAT_VERSION = 1
+ALIGNMENT = 4096
+
+# magic, format version, number of ranks, element size, committed version, data bytes
+_HEADER = struct.Struct('<4sIIIqQ')
+# offset, numel, version of one rank's region
+_ENTRY = struct.Struct('<QQq')
+
+_DTYPE_SIZE = {
+    torch.float16: 2,
+    torch.bfloat16: 2,
+    torch.float32: 4,
+}
+
+
+def _untrack(shm):
+    # The resource tracker would unlink the segment when this process dies,
+    # even on a crash where the node-local snapshot is still needed
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+def _unlink(shm):
+    # SharedMemory.unlink() unregisters from the tracker again, balance it first
+    resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+def job_prefix():
+    """
+    Default prefix of a job's segment names.
+
+    Unique per job on a node, since creating an arena replaces any segment of
+    the same name, and stable across restarts of that job so the warm restart
+    finds it: DELAYCHECK_RUN_ID if set, else the job's MASTER_PORT.
+    """
+    job = os.environ.get('DELAYCHECK_RUN_ID') or os.environ.get('MASTER_PORT', '0')
+    return f"delaycheck_{os.getuid()}_{job}_"
+
+
+def align_up(nbytes, alignment=ALIGNMENT):
+    return (nbytes + alignment - 1) // alignment * alignment
+
+
+def header_bytes(num_ranks):
+    return align_up(_HEADER.size + num_ranks * _ENTRY.size)
+
+
+def build_layout(rank_numels, dtype, alignment=ALIGNMENT):
+    """
+    Lay out one aligned region per local rank.
+
+    Returns (offsets, total_bytes) where offsets[i] is the byte offset of
+    rank i's region from the start of the segment.
+    """
+    itemsize = _DTYPE_SIZE[dtype]
+    offset = header_bytes(len(rank_numels))
+    offsets = []
+    for numel in rank_numels:
+        offsets.append(offset)
+        offset = align_up(offset + numel * itemsize, alignment)
+    return offsets, offset
+
+
+class SharedMemoryArena:
+    """
+    A shared-memory segment holding one aligned region per rank on the node.
+
+    The segment starts with a header and an offset table, so a process that
+    attaches to it finds every rank's region (and the committed version)
+    without knowing how the creator sized it. `close` only drops this
+    process's mapping; the creator unlinks the segment with `destroy` on a
+    clean shutdown. Nothing unlinks it at exit, so a run that dies, even on
+    an unhandled exception, leaves it in place for the warm restart.
+    """
+
+    def __init__(self, shm, dtype, owner):
+        self.shm = shm
+        self.dtype = dtype
+        self.owner = owner
+        self.closed = False
+
+        magic, fmt, num_ranks, itemsize, _, data_bytes = _HEADER.unpack_from(shm.buf, 0)
+        if magic != ARENA_MAGIC or fmt != ARENA_FORMAT_VERSION:
+            raise ValueError(f"shared memory segment {shm.name} is not a DelayCheck arena")
+        if itemsize != _DTYPE_SIZE[dtype]:
+            raise ValueError(f"arena {shm.name} holds {itemsize}-byte elements, expected {dtype}")
+        self.num_ranks = num_ranks
+        self.itemsize = itemsize
+        self.data_bytes = data_bytes
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @classmethod
+    def create(cls, name, rank_numels, dtype):
+        offsets, total_bytes = build_layout(rank_numels, dtype)
+        try:
+            # A segment left over by a crashed run of the same job is replaced
+            stale = _untrack(shared_memory.SharedMemory(name=name))
+            stale.close()
+            _unlink(stale)
+        except FileNotFoundError:
+            pass
+        shm = _untrack(shared_memory.SharedMemory(create=True, size=total_bytes, name=name))
+
+        _HEADER.pack_into(shm.buf, 0, ARENA_MAGIC, ARENA_FORMAT_VERSION, len(rank_numels), _DTYPE_SIZE[dtype], -1,
+                          total_bytes)
+        for i, (offset, numel) in enumerate(zip(offsets, rank_numels)):
+            _ENTRY.pack_into(shm.buf, _HEADER.size + i * _ENTRY.size, offset, numel, -1)
+        return cls(shm, dtype, owner=True)
+
+    @classmethod
+    def attach(cls, name, dtype):
+        shm = _untrack(shared_memory.SharedMemory(name=name))
+        return cls(shm, dtype, owner=False)
+
+    def entry(self, rank):
+        assert 0 <= rank < self.num_ranks, f"rank {rank} outside arena of {self.num_ranks} ranks"
+        return _ENTRY.unpack_from(self.shm.buf, _HEADER.size + rank * _ENTRY.size)
+
+    def offset_table(self):
+        return [self.entry(rank) for rank in range(self.num_ranks)]
+
+    def region(self, rank):
+        """Flat tensor view over `rank`'s region; no copy is made."""
+        offset, numel, _ = self.entry(rank)
+        if numel == 0:
+            return torch.empty(0, dtype=self.dtype)
+        return torch.frombuffer(self.shm.buf, dtype=self.dtype, count=numel, offset=offset)
+
+    def rank_version(self, rank):
+        return self.entry(rank)[2]
+
+    def set_rank_version(self, rank, version):
+        offset, numel, _ = self.entry(rank)
+        _ENTRY.pack_into(self.shm.buf, _HEADER.size + rank * _ENTRY.size, offset, numel, version)
+
+    @property
+    def committed_version(self):
+        return _HEADER.unpack_from(self.shm.buf, 0)[4]
+
+    def set_committed_version(self, version):
+        magic, fmt, num_ranks, itemsize, _, data_bytes = _HEADER.unpack_from(self.shm.buf, 0)
+        _HEADER.pack_into(self.shm.buf, 0, magic, fmt, num_ranks, itemsize, version, data_bytes)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.shm.close()
+        except BufferError:
+            # Tensor views still reference the mapping, it goes away with the process
+            pass
+
+    def destroy(self):
+        """Close the mapping and, in the creator, remove the segment; call only on a clean shutdown."""
+        self.close()
+        if self.owner:
+            self.owner = False
+            try:
+                _unlink(self.shm)
+            except FileNotFoundError:
+                pass
+
+
+MODEL_BUFFER = 'model_buffer'
+OPTIMIZER_BUFFER_AVG = 'optimizer_buffer_avg'
+OPTIMIZER_BUFFER_AVG_SQ = 'optimizer_buffer_avg_sq'
+
+
+def create_node_arenas(model_numel,
+                       optimizer_numel,
+                       local_rank,
+                       ranks_per_node,
+                       model_dtype=torch.float16,
+                       optimizer_dtype=torch.float32,
+                       prefix=None):
+    """
+    Size, create and attach the node's DelayCheck arenas.
+
+    Every rank contributes its own partition sizes, local rank 0 creates the
+    three segments with one region per local rank and the other local ranks
+    attach after a barrier. Ranks of a node are expected to be contiguous.
+    Segment names start with `prefix`, `job_prefix()` by default.
+    """
+    import torch.distributed as dist
+
+    if prefix is None:
+        prefix = job_prefix()
+
+    sizes = [None] * dist.get_world_size()
+    dist.all_gather_object(sizes, (int(model_numel), int(optimizer_numel)))
+    node_start = dist.get_rank() - local_rank
+    node_sizes = sizes[node_start:node_start + ranks_per_node]
+
+    specs = {
+        MODEL_BUFFER: ([m for m, _ in node_sizes], model_dtype),
+        OPTIMIZER_BUFFER_AVG: ([o for _, o in node_sizes], optimizer_dtype),
+        OPTIMIZER_BUFFER_AVG_SQ: ([o for _, o in node_sizes], optimizer_dtype),
+    }
+
+    arenas = {}
+    if local_rank == 0:
+        for name, (rank_numels, dtype) in specs.items():
+            arenas[name] = SharedMemoryArena.create(prefix + name, rank_numels, dtype)
+    dist.barrier()
+    if local_rank != 0:
+        for name, (_, dtype) in specs.items():
+            arenas[name] = SharedMemoryArena.attach(prefix + name, dtype)
+    return arenas
+
+
+def attach_node_arenas(model_dtype=torch.float16, optimizer_dtype=torch.float32, prefix=None):
+    """Attach to the node arenas left behind by an earlier run, None if any of them is gone or foreign."""
+    if prefix is None:
+        prefix = job_prefix()
+    dtypes = {
+        MODEL_BUFFER: model_dtype,
+        OPTIMIZER_BUFFER_AVG: optimizer_dtype,
+        OPTIMIZER_BUFFER_AVG_SQ: optimizer_dtype,
+    }
+    arenas = {}
+    try:
+        for name, dtype in dtypes.items():
+            arenas[name] = SharedMemoryArena.attach(prefix + name, dtype)
+    except (FileNotFoundError, ValueError):
+        for arena in arenas.values():
+            arena.close()
+        return None
+    return arenas
@@ -0,0 +1,156 @@
+import threading
+from contextlib import contextmanager
+import torch
+
+from .snapshot_buffer import PinnedRingBuffer
+
+MODEL_PART = 'model'
+OPTIMIZER_PART = 'optimizer'
+
+
+class SnapshotBank:
+    """One version of the in-memory checkpoint: parameter buckets and Adam moments."""
+
+    def __init__(self, model_ring, optimizer_numels, optimizer_dtype, pin_memory):
+        self.model = model_ring
+        self.exp_avg = [
+            torch.zeros(numel, dtype=optimizer_dtype, device='cpu', pin_memory=pin_memory)
+            for numel in optimizer_numels
+        ]
+        self.exp_avg_sq = [
+            torch.zeros(numel, dtype=optimizer_dtype, device='cpu', pin_memory=pin_memory)
+            for numel in optimizer_numels
+        ]
+        # bucket id -> [(ds_id, numel)] of the partition slices packed in that bucket
+        self.bucket_params = {}
+        self.version = -1
+        self.written = set()
+        self.readers = 0
+
+    def model_views(self):
+        return self.model.views(self.version)
+
+
+class CommittedSnapshot:
+    """Read-only handle on a committed bank, valid inside `VersionedSnapshotStore.read`."""
+
+    def __init__(self, bank):
+        self.version = bank.version
+        self.model = bank.model_views()
+        self.bucket_params = [bank.bucket_params[bucket_id] for bucket_id in sorted(bank.bucket_params)]
+        self.exp_avg = bank.exp_avg
+        self.exp_avg_sq = bank.exp_avg_sq
+
+
+class VersionedSnapshotStore:
+    """
+    Double-buffered store of DelayCheck in-memory checkpoints.
+
+    An iteration writes its parameter buckets and optimizer moments into the
+    shadow bank. `commit` publishes that bank by swapping a single
+    (version, bank) pointer, so a reader never sees a mix of iterations.
+    Readers pin the committed bank while they copy out of it. If the next
+    shadow bank is still pinned, that iteration's snapshot is skipped
+    instead of stalling the training loop.
+    """
+
+    required_parts = (MODEL_PART, OPTIMIZER_PART)
+
+    def __init__(self,
+                 partition_numels,
+                 optimizer_numels,
+                 model_dtype=torch.float16,
+                 optimizer_dtype=torch.float32,
+                 pin_memory=None):
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+
+        self.banks = []
+        for _ in range(2):
+            model_ring = PinnedRingBuffer.from_partition_sizes(partition_numels,
+                                                               num_versions=1,
+                                                               dtype=model_dtype,
+                                                               pin_memory=pin_memory)
+            self.banks.append(SnapshotBank(model_ring, optimizer_numels, optimizer_dtype, pin_memory))
+
+        self.lock = threading.Lock()
+        # Published (version, bank index), replaced as a whole on commit
+        self.committed_ref = (-1, -1)
+        self.shadow_index = 0
+        self.shadow_active = False
+        self.skipped = 0
+        self.aborted = 0
+
+    @property
+    def nbytes(self):
+        total = 0
+        for bank in self.banks:
+            total += bank.model.nbytes
+            total += sum(t.numel() * t.element_size() for t in bank.exp_avg + bank.exp_avg_sq)
+        return total
+
+    @property
+    def committed_version(self):
+        return self.committed_ref[0]
+
+    @property
+    def shadow(self):
+        """The bank currently being written, None while the iteration is skipped."""
+        return self.banks[self.shadow_index] if self.shadow_active else None
+
+    def begin(self, version):
+        """Start writing `version` into the shadow bank."""
+        with self.lock:
+            bank = self.banks[self.shadow_index]
+            if bank.readers > 0:
+                self.shadow_active = False
+                self.skipped += 1
+                return None
+            bank.version = version
+            bank.written.clear()
+            bank.bucket_params.clear()
+            bank.model.reset()
+            self.shadow_active = True
+        return bank
+
+    def mark_written(self, part):
+        if self.shadow_active:
+            self.banks[self.shadow_index].written.add(part)
+
+    def commit(self):
+        """Publish the shadow bank if every part of it was written."""
+        if not self.shadow_active:
+            return False
+        bank = self.banks[self.shadow_index]
+        if not all(part in bank.written for part in self.required_parts):
+            self.shadow_active = False
+            self.aborted += 1
+            return False
+
+        sealed = bank.model.seal(bank.version)
+        if sealed != len(bank.bucket_params):
+            # A bucket whose extent was overwritten would shift every later one
+            raise RuntimeError(f"DelayCheck snapshot {bank.version} holds {sealed} of "
+                               f"{len(bank.bucket_params)} buckets, the ring is too small")
+        with self.lock:
+            self.committed_ref = (bank.version, self.shadow_index)
+            self.shadow_index = 1 - self.shadow_index
+            self.shadow_active = False
+        return True
+
+    @contextmanager
+    def read(self):
+        """Pin the last committed bank, yielding a CommittedSnapshot or None."""
+        with self.lock:
+            version, index = self.committed_ref
+            if index < 0:
+                bank = None
+            else:
+                bank = self.banks[index]
+                bank.readers += 1
+        try:
+            yield CommittedSnapshot(bank) if bank is not None else None
+        finally:
+            if bank is not None:
+                with self.lock:
+                    bank.readers -= 1
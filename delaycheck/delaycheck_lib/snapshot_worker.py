@@ -0,0 +1,178 @@
+import queue
+import threading
+import time
+import torch
+
+
+class SnapshotTask:
+    """Descriptor of one bucket copy handed to the snapshot worker."""
+
+    def __init__(self, src, numel, version, bucket_id, ring_buffer, ready_event=None):
+        self.src = src
+        self.ring_buffer = ring_buffer
+        self.numel = numel
+        self.version = version
+        self.bucket_id = bucket_id
+        self.ready_event = ready_event
+        self.done_event = None
+        self.slot_id = None
+        # Set once the copy has been issued and `done_event` is recorded
+        self.issued = threading.Event()
+
+    def source(self):
+        # A list of slices is packed back to back, a tensor is copied up to `numel`
+        if isinstance(self.src, (list, tuple)):
+            return self.src
+        return self.src.narrow(0, 0, self.numel)
+
+    def wait_issued(self, stream=None):
+        """Make `stream` wait until the source bucket has been read."""
+        self.issued.wait()
+        if self.done_event is not None and stream is not None:
+            stream.wait_event(self.done_event)
+
+
+class SnapshotWorker:
+    """
+    Long-lived worker that copies bucket snapshots into a PinnedRingBuffer.
+
+    Tasks go through a bounded queue. When the queue is full, `submit` blocks
+    the producer instead of letting work pile up, and the time spent blocked is
+    counted. A failed copy does not stop the worker: the exception is kept
+    and raised from the next `submit`, `wait` or `drain`. Each worker thread
+    owns one CUDA stream for its whole lifetime, taken from `stream_pool`
+    when one is shared with other snapshot paths.
+    A task may name its own destination ring, e.g. the shadow bank of a
+    VersionedSnapshotStore.
+    """
+
+    def __init__(self, ring_buffer, num_workers=1, max_pending=4, device=None, stream_pool=None):
+        self.ring_buffer = ring_buffer
+        self.stream_pool = stream_pool
+        self.max_pending = max_pending
+        self.use_cuda = torch.cuda.is_available()
+        self.device = device if device is not None else (torch.cuda.current_device() if self.use_cuda else None)
+
+        self.tasks = queue.Queue(maxsize=max_pending)
+        self.error = None
+
+        self.submitted = 0
+        self.completed = 0
+        self.max_queue_depth = 0
+        self.blocked_time = 0.0
+        self.copy_time = 0.0
+        self.stats_lock = threading.Lock()
+
+        self.threads = []
+        for i in range(num_workers):
+            thread = threading.Thread(target=self._run, name=f"delaycheck-snapshot-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    @property
+    def queue_depth(self):
+        return self.tasks.qsize()
+
+    def _raise_error(self):
+        with self.stats_lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def submit(self, src, numel, version, bucket_id, ring_buffer=None):
+        self._raise_error()
+        ready_event = None
+        if self.use_cuda:
+            # The bucket is filled on the caller's current stream
+            ready_event = torch.cuda.Event()
+            ready_event.record()
+        if ring_buffer is None:
+            ring_buffer = self.ring_buffer
+        task = SnapshotTask(src, numel, version, bucket_id, ring_buffer, ready_event)
+
+        start = time.time()
+        self.tasks.put(task)
+        blocked = time.time() - start
+
+        with self.stats_lock:
+            self.submitted += 1
+            self.blocked_time += blocked
+            self.max_queue_depth = max(self.max_queue_depth, self.tasks.qsize())
+        return task
+
+    def wait(self, task, stream=None):
+        """Block until `task` has been issued, counting the time as blocked."""
+        start = time.time()
+        task.wait_issued(stream)
+        with self.stats_lock:
+            self.blocked_time += time.time() - start
+        self._raise_error()
+
+    def drain(self):
+        """Wait until every submitted task has landed in host memory."""
+        start = time.time()
+        self.tasks.join()
+        with self.stats_lock:
+            self.blocked_time += time.time() - start
+        self._raise_error()
+
+    def shutdown(self):
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "queue_depth": self.tasks.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "blocked_time": self.blocked_time,
+                "copy_time": self.copy_time,
+            }
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.max_queue_depth = 0
+            self.blocked_time = 0.0
+            self.copy_time = 0.0
+
+    def _run(self):
+        stream = None
+        if self.use_cuda:
+            torch.cuda.set_device(self.device)
+            stream = self.stream_pool.acquire() if self.stream_pool is not None else torch.cuda.Stream()
+
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                self.tasks.task_done()
+                return
+
+            start = time.time()
+            try:
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        stream.wait_event(task.ready_event)
+                        task.slot_id = task.ring_buffer.copy_from(task.source(), task.version, task.bucket_id)
+                        task.done_event = torch.cuda.Event()
+                        task.done_event.record(stream)
+                    task.issued.set()
+                    task.done_event.synchronize()
+                else:
+                    task.slot_id = task.ring_buffer.copy_from(task.source(), task.version, task.bucket_id)
+                    task.issued.set()
+            except Exception as exc:
+                # Keep serving the queue, the producer would block on it forever otherwise
+                with self.stats_lock:
+                    self.error = exc
+            finally:
+                # Never leave the producer waiting on a failed copy
+                task.issued.set()
+                with self.stats_lock:
+                    self.completed += 1
+                    self.copy_time += time.time() - start
+                self.tasks.task_done()
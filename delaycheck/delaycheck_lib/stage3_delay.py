@@ -10,10 +10,7 @@ from typing import Deque, Dict, Tuple
 from contextlib import contextmanager
 from deepspeed import comm as dist
 # import torch.distributed as dist
-from multiprocessing import shared_memory
-import numpy as np
 from deepspeed.utils import groups
-import threading  
 from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 from deepspeed.runtime.base_optimizer import ZeROOptimizer
 from deepspeed.utils import logger
@@ -33,8 +30,17 @@ from deepspeed.runtime.swap_tensor.pipelined_optimizer_swapper import PipelinedO
 from deepspeed.checkpoint.constants import OPTIMIZER_STATE_DICT, FP32_FLAT_GROUPS, PARTITION_COUNT, ZERO_STAGE, LOSS_SCALER
 from deepspeed.accelerator import get_accelerator
 from deepspeed.utils import z3_leaf_parameter
+import os
 import time
 import multiprocessing as mp
+from .snapshot_worker import SnapshotWorker
+from .snapshot_store import VersionedSnapshotStore, MODEL_PART, OPTIMIZER_PART
+from .copy_scheduler import LayerCopyScheduler
+from .stream_pool import StreamPool
+from .interval_tuner import CheckpointIntervalTuner, DELAYCHECK_CONFIG, _config_dict
+from .node_aggregator import NodeAggregator
+from .peer_replication import PeerReplicator, PEER_REPLICAS, PEER_INTERVAL, PEER_INTERVAL_DEFAULT
+from .shm_arena import create_node_arenas, attach_node_arenas, MODEL_BUFFER, OPTIMIZER_BUFFER_AVG, OPTIMIZER_BUFFER_AVG_SQ
 
 # Toggle this to true to enable correctness test
 # with gradient partitioning and without
@@ -368,30 +374,39 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         self.process_optimizer = None
         self.process_model = None
         
-        # self.cuda_stream_model_array = []
-        self.cuda_stream_model_dict ={}
-        for key, value in self.module.state_dict().items():
-            # stream_.synchronize()
-            self.cuda_stream_model_dict[key]=torch.cuda.Stream()
-
-        self.cuda_stream_optimizer_dict_avg={}
-        self.cuda_stream_optimizer_dict_avg_sq={}
+        # A few copy streams shared by the model and optimizer snapshot paths,
+        # instead of one stream per state_dict key / optimizer state tensor
+        self.snapshot_streams = StreamPool(size=4)
 
         self.threading_is_start=False
 
-        from collections import deque
-
-        self.model_data = deque()
-
-        self.shared_memory_shape = (4, 1024*1024*1024*10)
-        self.optimizer_avg_data = deque()
-        self.optimizer_avg_sq_data = deque()
+        # Bucket snapshots and optimizer moments go into a double-buffered
+        # store, created in _setup_for_real_optimizer once partition sizes are known
+        self.snapshot_store = None
+        self.snapshot_worker = None
+        self.optimizer_copy_scheduler = None
+        self.optimizer_snapshot_planned = False
+        self.pending_snapshot = None
+        self.snapshot_bucket_id = 0
+        self.iteration = 0
+        # Last committed version written to disk, a version is flushed once
+        self.flushed_version = -1
+
+        # Node-local shared memory arenas, see initialize_shared_memory
+        self.shm_arenas = None
+        self.node_aggregator = None
         
-        self.model_data_flush = None
-        self.optimizer_avg_data_flush = None
-        self.optimizer_avg_sq_data_flush = None
-        
-        self.flush_frequency = 10
+        # Snapshot and flush intervals, re-tuned from measured costs and the configured MTBF
+        self.interval_tuner = CheckpointIntervalTuner.from_config(ds_config)
+        self.flush_frequency = self.interval_tuner.flush_interval
+        self.last_seal_time = None
+        # Measurements are agreed on across ranks every tune_period iterations
+        self.tune_period = 10
+
+        # Optional copies of committed snapshots in buddy nodes' CPU memory
+        self.ds_config = ds_config
+        self.peer_replicator = None
+        self.peer_interval = PEER_INTERVAL_DEFAULT
         # self.start_queue =  mp.Queue()
         # self.module_queue = mp.Queue()
         # self.optimizer_queue = mp.Queue()
@@ -538,6 +553,23 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
             hook.remove()
         print_rank_0("Removed grad acc hooks", force=False)
         
+        if self.snapshot_worker is not None:
+            self.snapshot_worker.shutdown()
+        if self.optimizer_copy_scheduler is not None:
+            self.optimizer_copy_scheduler.remove_hooks()
+        if self.node_aggregator is not None:
+            self._record_node_flushes(self.node_aggregator.shutdown())
+            self.node_aggregator = None
+        if self.peer_replicator is not None:
+            # Clean shutdown, the replicas held for other ranks are not needed any more
+            self.peer_replicator.destroy()
+            self.peer_replicator = None
+        if self.shm_arenas is not None:
+            # Clean shutdown, no warm restart will need the node's snapshot
+            for arena in self.shm_arenas.values():
+                arena.destroy()
+            self.shm_arenas = None
+
         del self.__ipg_bucket_flat_buffer
         
         del self.__ipg_parameter_bucket_flat_buffer
@@ -631,8 +663,35 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
             self.__ipg_parameter_bucket_flat_buffer: Tensor = torch.empty(self.reduce_bucket_size,
                                                                 dtype=self.dtype,
                                                                 device=get_accelerator().current_device_name())
-            
-            
+
+            # One iteration of bucket snapshots covers this rank's partition of every trainable
+            # parameter once, the Adam moments have the shape of the fp32 partitions
+            self.snapshot_store = VersionedSnapshotStore(
+                [p.partition_numel() for group in self.fp16_groups for p in group],
+                [fp32_partition.numel() for fp32_partition in self.fp32_partitioned_groups_flat],
+                model_dtype=self.dtype)
+            print_rank_0(f"Allocated {self.snapshot_store.nbytes} bytes for DelayCheck snapshots", force=True)
+
+            # Where each parameter's partition lives, laid out like fp16_partitioned_groups_flat
+            self.snapshot_partition_offsets = {}
+            offset = 0
+            for sub_group in self.fp16_groups:
+                for param in sub_group:
+                    self.snapshot_partition_offsets[param.ds_id] = (offset, param.partition_numel())
+                    offset += param.partition_numel()
+            self.snapshot_partition_numel = offset
+            self.snapshot_worker = SnapshotWorker(None, stream_pool=self.snapshot_streams)
+            self.snapshot_store.begin(self.iteration)
+
+            # Adam moments are copied from the forward pre-hooks of the next iteration
+            self.optimizer_copy_scheduler = LayerCopyScheduler(self.module, stream=self.snapshot_streams.acquire())
+            self.plan_optimizer_snapshot()
+
+            delaycheck_config = _config_dict(self.ds_config).get(DELAYCHECK_CONFIG, {})
+            if delaycheck_config.get(PEER_REPLICAS, 0) > 0:
+                ranks_per_node = int(os.environ.get('LOCAL_WORLD_SIZE', get_accelerator().device_count()))
+                self.peer_replicator = PeerReplicator.from_config(self.ds_config, self.snapshot_store, ranks_per_node)
+                self.peer_interval = delaycheck_config.get(PEER_INTERVAL, PEER_INTERVAL_DEFAULT)
 
         self.grad_partitions_flat_buffer = None
         self.__param_id_to_grad_partition: Dict[int, Tensor] = {}
@@ -1379,6 +1438,11 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         if self.contiguous_gradients and self.elements_in_ipg_bucket + param.grad.numel() <= self.reduce_bucket_size:
             # move the gradient to a contiguous buffer
             with get_accelerator().stream(self.reduce_and_partition_stream):
+                # the previous bucket snapshot must be read before the parameter bucket is overwritten
+                if self.pending_snapshot is not None:
+                    self.snapshot_worker.wait(self.pending_snapshot, self.reduce_and_partition_stream)
+                    self.pending_snapshot = None
+
                 # move the parameter's gradient to the contiguous flat buffer
                 new_grad_tensor = self.__ipg_bucket_flat_buffer.narrow(0, self.elements_in_ipg_bucket,
                                                                        param.grad.numel()).view_as(param.grad)
@@ -1416,23 +1480,156 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         pass
     
     
-    def model_copy_async(self, rank, __ipg_parameter_bucket_flat_buffer):
-
-        if True:
-            model_stream = torch.cuda.Stream()
-            with torch.cuda.stream(model_stream):
-                # if self.elements_in_ipg_bucket<self.reduce_bucket_size:
-                #     self.gpu_model_buffer = torch.empty(self.elements_in_ipg_bucket, dtype=torch.float32, device=self.device)
-                parameter_bucket = __ipg_parameter_bucket_flat_buffer.narrow(0, 0, self.elements_in_ipg_bucket)
-                
-                parameter_tensor_cpu = parameter_bucket.to('cpu', non_blocking=True)
+    def model_copy_async(self, rank, __ipg_parameter_bucket_flat_buffer, numel, version, bucket_id):
+        # The persistent snapshot worker copies this rank's slice of every parameter in
+        # the bucket into a reused pinned extent of the shadow bank. The parameter bucket
+        # is reused by the next bucket, so the caller must wait on the returned task
+        # before writing into it again.
+        shadow = self.snapshot_store.shadow
+        # Parameters only change in step(), so the shadow bank holds one pass over the partitions:
+        # the buckets reduced by the micro-step that ends the gradient accumulation
+        if shadow is None or not self.is_gradient_accumulation_boundary:
+            return None
+        dp_rank = dist.get_rank(group=self.dp_process_group)
+        slices = []
+        params = []
+        bucket_offset = 0
+        for param in self.params_in_ipg_bucket:
+            partition_numel = param.partition_numel()
+            start = dp_rank * partition_numel
+            slice_numel = max(0, min(partition_numel, param.ds_numel - start))
+            if slice_numel > 0:
+                slices.append(__ipg_parameter_bucket_flat_buffer.narrow(0, bucket_offset + start, slice_numel))
+            params.append((param.ds_id, slice_numel))
+            bucket_offset += param.ds_numel
+        shadow.bucket_params[bucket_id] = params
+        return self.snapshot_worker.submit(slices, sum(n for _, n in params), version, bucket_id,
+                                           ring_buffer=shadow.model)
 
-                self.model_data.append(parameter_tensor_cpu)
-                # parameter_tensor_cpu = self.gpu_model_buffer.copy_(parameter_bucket, non_blocking=True).to('cpu', non_blocking=True)
-    
-                if self.iteration % self.flush_frequency==0:
-                    self.model_data_flush(parameter_tensor_cpu)
-        pass
+    @property
+    def model_data(self):
+        # Buckets of the iteration currently being copied, ordered by bucket
+        if self.snapshot_store is None or self.snapshot_store.shadow is None:
+            return []
+        return self.snapshot_store.shadow.model_views()
+
+    @property
+    def model_data_flush(self):
+        # Buckets of the last committed iteration
+        if self.snapshot_store is None:
+            return []
+        with self.snapshot_store.read() as snapshot:
+            return snapshot.model if snapshot is not None else []
+
+    @property
+    def optimizer_avg_data(self):
+        if self.snapshot_store is None or self.snapshot_store.shadow is None:
+            return []
+        return list(self.snapshot_store.shadow.exp_avg)
+
+    @property
+    def optimizer_avg_sq_data(self):
+        if self.snapshot_store is None or self.snapshot_store.shadow is None:
+            return []
+        return list(self.snapshot_store.shadow.exp_avg_sq)
+
+    def plan_optimizer_snapshot(self):
+        # Queue the moments produced by this step for copying during the next forward
+        self.optimizer_snapshot_planned = False
+        shadow = self.snapshot_store.shadow if self.snapshot_store is not None else None
+        if self.optimizer_copy_scheduler is None or shadow is None:
+            return
+        copies = []
+        for i, fp32_partition in enumerate(self.fp32_partitioned_groups_flat):
+            momentum = self.optimizer.state.get(fp32_partition)
+            if momentum is None:
+                return
+            copies.append((momentum['exp_avg'], shadow.exp_avg[i]))
+            copies.append((momentum['exp_avg_sq'], shadow.exp_avg_sq[i]))
+        self.optimizer_copy_scheduler.plan(copies)
+        self.optimizer_snapshot_planned = True
+
+    def _finish_optimizer_snapshot(self):
+        # The forward pre-hooks issued what fit into each layer; issue the rest from the training thread
+        if not self.optimizer_snapshot_planned:
+            return
+        self.optimizer_copy_scheduler.finish()
+        self.optimizer_snapshot_planned = False
+        self.snapshot_store.mark_written(OPTIMIZER_PART)
+
+    def seal_model_snapshot(self):
+        seal_start = time.time()
+        snapshot_taken = self.snapshot_store is not None and self.snapshot_store.shadow is not None
+        self._finish_optimizer_snapshot()
+        if dist.get_rank() == 0 and self.optimizer_copy_scheduler is not None and self.iteration % self.flush_frequency == 0:
+            logger.info(f"DelayCheck optimizer copy schedule:\n{self.optimizer_copy_scheduler.format_report()}")
+        if self.snapshot_worker is not None:
+            self.snapshot_worker.drain()
+            self.pending_snapshot = None
+            if dist.get_rank() == 0 and self.iteration % self.flush_frequency == 0:
+                logger.info(f"DelayCheck snapshot worker stats: {self.snapshot_worker.stats()}")
+            self.snapshot_worker.reset_stats()
+        if self.snapshot_store is not None:
+            # The buckets and moments of this iteration are published together or not at all
+            if self.snapshot_bucket_id > 0:
+                self.snapshot_store.mark_written(MODEL_PART)
+            self.snapshot_store.commit()
+            if self.peer_replicator is not None and self.iteration % self.peer_interval == 0:
+                self.peer_replicator.replicate()
+            self._tune_intervals(seal_start, snapshot_taken)
+            if self.interval_tuner.snapshot_due(self.iteration + 1):
+                self.snapshot_store.begin(self.iteration + 1)
+        self.snapshot_bucket_id = 0
+        self.iteration += 1
+
+    def _tune_intervals(self, seal_start, snapshot_taken):
+        # The snapshot cost is the time the training loop blocks on it here
+        now = time.time()
+        if self.last_seal_time is not None:
+            self.interval_tuner.record_iteration(seal_start - self.last_seal_time)
+        self.last_seal_time = now
+        if snapshot_taken:
+            self.interval_tuner.record_snapshot(now - seal_start, nbytes=self.snapshot_store.nbytes // 2)
+
+        if self.iteration % self.tune_period != 0:
+            return
+        # Every rank must pick the same intervals: snapshots, flushes and replication are collective.
+        # The slowest iteration, largest costs and lowest disk bandwidth win.
+        measured = self.interval_tuner.measured()
+        measured[3] = -measured[3]
+        measured = torch.tensor(measured, dtype=torch.float64, device=get_accelerator().current_device_name())
+        dist.all_reduce(measured, op=dist.ReduceOp.MAX)
+        measured = measured.tolist()
+        measured[3] = -measured[3]
+        self.interval_tuner.set_measured(measured)
+
+        if self.interval_tuner.maybe_retune():
+            self.flush_frequency = self.interval_tuner.flush_interval
+            if dist.get_rank() == 0:
+                logger.info(f"DelayCheck intervals re-tuned: {self.interval_tuner.describe()}")
+
+    def recover_snapshot_from_peer(self, lost_ranks):
+        # Collective; a lost rank gets its snapshot back from its buddy or None (fall back to disk)
+        if self.peer_replicator is None:
+            return None
+        self.peer_replicator.drain()
+        return self.peer_replicator.recover(lost_ranks)
+
+    def flush_due(self, iteration=None):
+        return self.interval_tuner.flush_due(self.iteration if iteration is None else iteration)
+
+    def flush_committed_snapshot(self, rank):
+        # Only the last committed iteration is flushed, never a half-written one
+        if self.snapshot_store is None:
+            return 0
+        start_time = time.time()
+        with self.snapshot_store.read() as snapshot:
+            if snapshot is None or snapshot.version == self.flushed_version:
+                return 0
+            self.flushed_version = snapshot.version
+            nbytes = self.save_ckpt_to_disk_sync(snapshot.model, snapshot.exp_avg, snapshot.exp_avg_sq, rank)
+        self.interval_tuner.record_flush(nbytes, time.time() - start_time)
+        return nbytes
     
     
     def save_ckpt_to_disk_sync(self, model_tensor_cpu_array, parameter_tensor_cpu_array_1, parameter_tensor_cpu_array_2, rank):
@@ -1440,14 +1637,22 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         save_dir = "./checkpoint/"
         if rank == 0:
             print("Start sync on-disk ckpt. ")
-        torch.save(model_tensor_cpu_array, save_dir + "module1_" + "rank" + str(rank) + ".pt")
-        torch.save(model_tensor_cpu_array, save_dir + "module2_" + "rank" + str(rank) + ".pt")
-        torch.save(parameter_tensor_cpu_array_1, save_dir + "optimizer1_" + "rank" + str(rank) + ".pt")
-        torch.save(parameter_tensor_cpu_array_2, save_dir + "optimizer2_" + "rank" + str(rank) + ".pt")
-        torch.save(parameter_tensor_cpu_array_1, save_dir + "optimizer3_" + "rank" + str(rank) + ".pt")
-        torch.save(parameter_tensor_cpu_array_2, save_dir + "optimizer4_" + "rank" + str(rank) + ".pt")
+        saved = [
+            (model_tensor_cpu_array, "module1_"),
+            (model_tensor_cpu_array, "module2_"),
+            (parameter_tensor_cpu_array_1, "optimizer1_"),
+            (parameter_tensor_cpu_array_2, "optimizer2_"),
+            (parameter_tensor_cpu_array_1, "optimizer3_"),
+            (parameter_tensor_cpu_array_2, "optimizer4_"),
+        ]
+        nbytes = 0
+        for tensors, name in saved:
+            path = save_dir + name + "rank" + str(rank) + ".pt"
+            torch.save(tensors, path)
+            nbytes += os.path.getsize(path)
         if rank == 0:
             print("finish save ckpt to disk, time = ", time.time() - start_time)
+        return nbytes
 
     @instrument_w_nvtx
     @torch.no_grad()
@@ -1486,8 +1691,11 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
                 grad_partitions = self.__avg_scatter_contiguous_grads(grad_bucket)
                 
                 
-                self.process_model = threading.Thread(target=self.model_copy_async, args=(rank, self.__ipg_parameter_bucket_flat_buffer,))
-                self.process_model.start()
+                self.pending_snapshot = self.model_copy_async(rank, self.__ipg_parameter_bucket_flat_buffer,
+                                                              self.elements_in_ipg_bucket, self.iteration,
+                                                              self.snapshot_bucket_id)
+                if self.pending_snapshot is not None:
+                    self.snapshot_bucket_id += 1
 
             else:
                 self.params_in_ipg_bucket.sort(key=lambda p: p.ds_id)
@@ -2238,9 +2446,10 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         self.model_elements_copy_to_memory.clear()
         self.gpu_optimizer_exp_avg_elements_array.clear()
         self.gpu_optimizer_exp_avg_sq_elements_array.clear()
-        
-        
-        
+
+        # All buckets of this iteration were reduced during backward
+        self.seal_model_snapshot()
+
         self._pre_step()
         self._partition_all_parameters()
 
@@ -2248,6 +2457,7 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         if self._overflow_check_and_loss_scale_update():
             if self.swap_optimizer:
                 self.optimizer_swapper.log_timers()
+            self.plan_optimizer_snapshot()
             return
 
         norm_groups = self._get_norm_groups()
@@ -2283,6 +2493,8 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
 
         self._post_step(timer_names)
 
+        self.plan_optimizer_snapshot()
+
         # warn user about caching allocator flushes
         memory_stats = get_accelerator().memory_stats()
         alloc_retries = memory_stats.get("num_alloc_retries")
@@ -2443,108 +2655,246 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
 
 
    
-    def first_second_copy_optimizer_async(self, optimizer):
-        # torch.cuda.set_device(dist.get_rank())
-        
-        if optimizer.state == {}:
+    def first_second_copy_optimizer_async(self, optimizer, device=None):
+        if device is not None:
+            torch.cuda.set_device(device)
+
+        shadow = self.snapshot_store.shadow if self.snapshot_store is not None else None
+        if optimizer.state == {} or shadow is None:
             return
-        elif self.cuda_stream_optimizer_dict_avg=={} or self.cuda_stream_optimizer_dict_avg_sq=={}:
-            for tensor, momentum in optimizer.state.items():
-                self.cuda_stream_optimizer_dict_avg[tensor] =torch.cuda.Stream()
-                self.cuda_stream_optimizer_dict_avg_sq[tensor] =torch.cuda.Stream()
-                
-            
 
-        for tensor, momentum in optimizer.state.items():
-            self.cuda_stream_optimizer_dict_1[tensor].synchronize()
-            
-            with torch.cuda.stream(self.cuda_stream_optimizer_dict_1[tensor]):
-                exp_avg_numel = momentum['exp_avg_sq'].numel()
-                parameter_tensor_cpu = momentum['exp_avg'].to('cpu', non_blocking=True)
-                self.optimizer_avg_data.append(parameter_tensor_cpu)
-                
-                if self.iteration % self.flush_frequency==0:
-                    self.optimizer_avg_data_flush(parameter_tensor_cpu)
-        
-        # self.module_queue.put((optimizer.model_data, ))
-        # self.optimizer_queue.put((cpu_optimizer_array_avg, cpu_optimizer_array_avg, cpu_optimizer_array_avg_sq, cpu_optimizer_array_avg_sq))
- 
-            self.cuda_stream_optimizer_dict_2[tensor].synchronize()
-            # with torch.cuda.stream(self.optimizer_stream_2):
-            with torch.cuda.stream(self.cuda_stream_optimizer_dict_2[tensor]): 
- 
-                parameter_tensor_cpu = momentum['exp_avg'].to('cpu', non_blocking=True)
-                self.optimizer_avg_sq_data.append(parameter_tensor_cpu)
-
-                if self.iteration % self.flush_frequency==0:
-                    self.optimizer_avg_sq_data_flush(parameter_tensor_cpu)
+        # The moments are copied into the preallocated buffers of the shadow bank,
+        # indexed like fp32_partitioned_groups_flat
+        for i, fp32_partition in enumerate(self.fp32_partitioned_groups_flat):
+            momentum = optimizer.state.get(fp32_partition)
+            if momentum is None:
+                return
 
-                
-    
-    # Copying optimizer state to CPU shared memory
-    # 
-    def first_second_optimizer_copy_to_shared_memory(self, rank):
-        if self.optimizer_avg_data == None or self.optimizer_avg_sq_data == None:
-            
-            return
+            with self.snapshot_streams.stream():
+                shadow.exp_avg[i].copy_(momentum['exp_avg'].view(-1), non_blocking=True)
 
-        if self.exp_avg_numel == None or self.exp_avg_sq_numel == None:
-                for tensor, momentum in self.optimizer.state.items():
-                    exp_avg_numel = momentum['exp_avg'].numel()
-                    exp_avg_sq_numel = momentum['exp_avg_sq'].numel()
-                    self.exp_avg_numel+=exp_avg_numel
-                    self.exp_avg_sq_numel +=exp_avg_sq_numel
+            with self.snapshot_streams.stream():
+                shadow.exp_avg_sq[i].copy_(momentum['exp_avg_sq'].view(-1), non_blocking=True)
 
-        # 
-        # Allocate GPU buffer
-        # self.gpu_optimizer_buffer_avg = torch.empty(self.exp_avg_numel, dtype=torch.float16, device=self.device)
-        # self.gpu_optimizer_buffer_avg_sq = torch.empty(self.exp_avg_sq_numel, dtype=torch.float16, device=self.device)
-        # 
-        optimizer_buffer_name_avg = 'optimizer_buffer_avg'
-        existing_optimizer_shm_avg = shared_memory.SharedMemory(name = optimizer_buffer_name_avg)
-        optimizer_shard_buffer_avg = np.ndarray(self.shared_memory_shape, dtype=np.float16, buffer=existing_optimizer_shm_avg.buf)
+        self.snapshot_streams.synchronize()
 
-        partition_numel_sum = 0
-        for i in self.optimizer_avg_data():
-            partition =  self.optimizer_avg_data[i]
-            partition_numel = partition.numel()
+        self.snapshot_store.mark_written(OPTIMIZER_PART)
 
-            optimizer_shard_buffer_avg[rank, partition_numel_sum : partition_numel_sum + partition_numel] = partition.numpy()
-            partition_numel_sum = partition.numel()
+    
+    def initialize_shared_memory(self, local_rank, ranks_per_node, prefix=None):
+        # Arenas are sized from the fp16 partition and the fp32 optimizer partitions of each local rank
+        optimizer_numel = sum(fp32_partition.numel() for fp32_partition in self.fp32_partitioned_groups_flat)
+        self.shm_local_rank = local_rank
+        self.shm_ranks_per_node = ranks_per_node
+        self.shm_arenas = create_node_arenas(self.snapshot_partition_numel,
+                                             optimizer_numel,
+                                             local_rank,
+                                             ranks_per_node,
+                                             model_dtype=self.dtype,
+                                             prefix=prefix)
+        return self.shm_arenas
+
+    def _validate_shared_memory(self, arenas, local_rank, ranks_per_node):
+        # Returns the version held for this rank, or -1 if the regions can not be used
+        optimizer_numel = sum(fp32_partition.numel() for fp32_partition in self.fp32_partitioned_groups_flat)
+        expected = {
+            MODEL_BUFFER: self.snapshot_partition_numel,
+            OPTIMIZER_BUFFER_AVG: optimizer_numel,
+            OPTIMIZER_BUFFER_AVG_SQ: optimizer_numel,
+        }
+        if any(partition is None for partition in self.fp16_partitioned_groups_flat):
+            return -1
+        versions = set()
+        for name, arena in arenas.items():
+            if arena.num_ranks != ranks_per_node:
+                return -1
+            _, numel, version = arena.entry(local_rank)
+            if numel != expected[name]:
+                return -1
+            versions.add(version)
+        if len(versions) != 1:
+            return -1
+        return versions.pop()
+
+    def restore_from_shared_memory(self, local_rank, ranks_per_node, prefix=None):
+        """
+        Warm restart from the node's shared-memory snapshot (collective).
+
+        Reattaches to the arenas left by the failed run, checks that every rank
+        holds the same committed version with matching partition sizes and
+        copies the partitions into fp16_partitioned_groups_flat, the fp32
+        partitions and the Adam moments. Returns the restored version, or None
+        on every rank if any rank failed validation so the caller can load
+        from disk. Must run before initialize_shared_memory replaces the arenas.
+        """
+        if self.snapshot_store is None:
+            return None
+        arenas = attach_node_arenas(model_dtype=self.dtype, prefix=prefix)
+        version = self._validate_shared_memory(arenas, local_rank, ranks_per_node) if arenas is not None else -1
 
+        ok = self._all_ranks_agree(version)
+        if ok:
+            self._apply_snapshot(version, arenas[MODEL_BUFFER].region(local_rank),
+                                 arenas[OPTIMIZER_BUFFER_AVG].region(local_rank),
+                                 arenas[OPTIMIZER_BUFFER_AVG_SQ].region(local_rank))
 
-        optimizer_buffer_name_avg_sq = 'optimizer_buffer_avg_sq'
-        existing_optimizer_shm_avg_sq = shared_memory.SharedMemory(name = optimizer_buffer_name_avg_sq)
-        optimizer_shard_buffer_avg_sq = np.ndarray(self.shared_memory_shape, dtype=np.float16, buffer=existing_optimizer_shm_avg_sq.buf)
+        # Nobody closes the old segments while another local rank still reads them
+        dist.barrier()
+        if arenas is not None:
+            for arena in arenas.values():
+                arena.close()
+        if not ok:
+            return None
+        print_rank_0(f"DelayCheck warm restart from shared memory at version {version}", force=True)
+        return version
+
+    def _all_ranks_agree(self, version):
+        # All ranks restore the same version or none does; -1 is a rank with nothing to restore
+        versions = torch.tensor([version, -version], dtype=torch.int64, device=get_accelerator().current_device_name())
+        dist.all_reduce(versions, op=dist.ReduceOp.MIN)
+        agreed = version >= 0 and int(versions[0]) == version and -int(versions[1]) == version
+        ok = torch.tensor([1 if agreed else 0], dtype=torch.int64, device=get_accelerator().current_device_name())
+        dist.all_reduce(ok, op=dist.ReduceOp.MIN)
+        return int(ok.item()) == 1
+
+    def _apply_snapshot(self, version, model, exp_avg, exp_avg_sq):
+        # `model` is laid out like fp16_partitioned_groups_flat, the moments like the fp32 partitions
+        model_offset = 0
+        optimizer_offset = 0
+        for i, (fp16_partition, fp32_partition) in enumerate(
+                zip(self.fp16_partitioned_groups_flat, self.fp32_partitioned_groups_flat)):
+            numel = fp16_partition.numel()
+            fp16_partition.data.copy_(model.narrow(0, model_offset, numel))
+            model_offset += numel
+            self._unflatten_partitioned_parameters(i)
+            fp32_partition.data.copy_(fp16_partition.data)
+
+            numel = fp32_partition.numel()
+            state = self.optimizer.state[fp32_partition]
+            state['exp_avg'].copy_(exp_avg.narrow(0, optimizer_offset, numel).view_as(state['exp_avg']))
+            state['exp_avg_sq'].copy_(exp_avg_sq.narrow(0, optimizer_offset, numel).view_as(state['exp_avg_sq']))
+            optimizer_offset += numel
+            # Snapshot `version` holds the state after `version` optimizer steps
+            if 'step' in state:
+                if torch.is_tensor(state['step']):
+                    state['step'].fill_(version)
+                else:
+                    state['step'] = version
+        self.iteration = version
+        self.snapshot_store.begin(self.iteration)
+        self.plan_optimizer_snapshot()
+
+    def _replica_version(self, snapshot):
+        # The version a replica can restore on this rank, -1 if it is missing or laid out differently
+        if snapshot is None or any(partition is None for partition in self.fp16_partitioned_groups_flat):
+            return -1
+        ds_ids = [ds_id for params in snapshot.bucket_params for ds_id, _ in params]
+        if sorted(ds_ids) != sorted(self.snapshot_partition_offsets):
+            return -1
+        if [t.numel() for t in snapshot.exp_avg] != [p.numel() for p in self.fp32_partitioned_groups_flat]:
+            return -1
+        return snapshot.version
+
+    def restore_from_peer(self):
+        """
+        Restore every rank from the replica its buddy holds (collective).
+
+        Buddies keep the replicas in shared memory that outlives the job, so
+        after a node is replaced the restarted job still finds them. Every rank
+        takes its own replica, since the surviving ranks' local snapshots may
+        be newer than the last replication round. Returns the restored
+        version, or None on every rank if any rank got no usable replica or
+        the versions differ, so the caller can load from disk.
+        """
+        if self.peer_replicator is None or self.snapshot_store is None:
+            return None
+        snapshot = self.recover_snapshot_from_peer(range(dist.get_world_size()))
+        version = self._replica_version(snapshot)
+        if not self._all_ranks_agree(version):
+            return None
+        model = torch.zeros(self.snapshot_partition_numel, dtype=self.dtype)
+        self._copy_bucket_partitions(snapshot.model, snapshot.bucket_params, model)
+        self._apply_snapshot(version, model, torch.cat(snapshot.exp_avg), torch.cat(snapshot.exp_avg_sq))
+        print_rank_0(f"DelayCheck restart from peer replicas at version {version}", force=True)
+        return version
+
+    def start_node_aggregator(self, save_dir='./checkpoint/'):
+        # One aggregator per node, owned by the local rank that created the arenas
+        if self.shm_arenas is None or self.shm_local_rank != 0:
+            return None
+        node_id = dist.get_rank() // self.shm_ranks_per_node
+        self.node_aggregator = NodeAggregator(self.shm_arenas, save_dir, node_id)
+        return self.node_aggregator
+
+    def _record_node_flushes(self, results):
+        for result in results:
+            if "error" in result:
+                logger.warning(f"DelayCheck node flush of version {result['version']} failed: {result['error']}")
+                continue
+            self.interval_tuner.record_flush(result["nbytes"], result["seconds"])
+            logger.info(f"DelayCheck node flush of version {result['version']}: {result['nbytes']} bytes "
+                        f"in {result['seconds']:.3f}s ({result['mb_per_s']:.1f} MB/s)")
 
-        partition_numel_sum = 0
-        for tensor, momentum in self.optimizer.state.items():
-            partition =  self.optimizer_avg_data[i]
-            partition_numel = partition.numel()
+    def flush_to_node_file(self):
+        # Every local rank publishes its committed snapshot, the aggregator writes the node file
+        if self.shm_arenas is None or self.snapshot_store is None:
+            return
+        version = self.snapshot_store.committed_version
+        if version < 0 or version == self.flushed_version:
+            return
+        self.flushed_version = version
+        self.model_copy_to_shared_memory(self.shm_local_rank)
+        self.first_second_optimizer_copy_to_shared_memory(self.shm_local_rank)
+        if self.node_aggregator is not None:
+            self._record_node_flushes(self.node_aggregator.poll())
+            self.node_aggregator.request(version)
+
+    def _copy_bucket_partitions(self, buckets, bucket_params, dst):
+        # Buckets hold this rank's partition slices back to back, in bucket order
+        for bucket, params in zip(buckets, bucket_params):
+            bucket_offset = 0
+            for ds_id, numel in params:
+                dst_offset, _ = self.snapshot_partition_offsets[ds_id]
+                if numel > 0:
+                    dst.narrow(0, dst_offset, numel).copy_(bucket.narrow(0, bucket_offset, numel))
+                bucket_offset += numel
 
-            optimizer_shard_buffer_avg_sq[rank, partition_numel_sum : partition_numel_sum + partition_numel] = partition.numpy()
-            partition_numel_sum = partition.numel()
+    # Copying optimizer state to CPU shared memory
+    # 
+    def first_second_optimizer_copy_to_shared_memory(self, rank):
+        if self.shm_arenas is None or self.snapshot_store is None:
+            return
 
+        with self.snapshot_store.read() as snapshot:
+            if snapshot is None:
+                return
+            for name, moments in ((OPTIMIZER_BUFFER_AVG, snapshot.exp_avg), (OPTIMIZER_BUFFER_AVG_SQ,
+                                                                              snapshot.exp_avg_sq)):
+                arena = self.shm_arenas[name]
+                # A region is only valid once its version is set again, a crash mid-copy leaves -1
+                arena.set_rank_version(rank, -1)
+                region = arena.region(rank)
+                partition_numel_sum = 0
+                for partition in moments:
+                    partition_numel = partition.numel()
+                    region.narrow(0, partition_numel_sum, partition_numel).copy_(partition)
+                    partition_numel_sum += partition_numel
+                arena.set_rank_version(rank, snapshot.version)
 
     # 
     #  Copying sub-checkpoints to shared CPU memory
     # 
     def model_copy_to_shared_memory(self, rank):
-        if self.model_data==None:
+        if self.shm_arenas is None or self.snapshot_store is None:
             return
-        # dq2 = dq1.copy() 
-        model_buffer_name = 'model_buffer'
-        existing_model_shm = shared_memory.SharedMemory(name = model_buffer_name) 
-        model_shard_buffer = np.ndarray(self.shape, dtype=np.float16, buffer=existing_model_shm.buf)
-        
-        # 
-        # Saving sub-checkpoints to shared CPU memory
-        partition_numel_sum = 0
-        for i in self.model_data:
-            partition = self.model_data.numel()
-            partition_numel = partition.numel()
-            model_shard_buffer[rank, partition_numel_sum : partition_numel_sum + partition_numel] = partition.numpy()
-            partition_numel_sum += partition_numel
+
+        with self.snapshot_store.read() as snapshot:
+            if snapshot is None:
+                return
+            arena = self.shm_arenas[MODEL_BUFFER]
+            arena.set_rank_version(rank, -1)
+            self._copy_bucket_partitions(snapshot.model, snapshot.bucket_params, arena.region(rank))
+            arena.set_rank_version(rank, snapshot.version)
     
     
     def copy_model_async(self, model):
@@ -2552,19 +2902,12 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         
 
         for key, value in model.state_dict().items():
-            # stream_.synchronize()
-            self.cuda_stream_model_dict[key].synchronize()
-            
-            # self.cuda_stream_optimizer_dict_avg = []
-            
-            
-            with torch.cuda.stream(self.cuda_stream_model_dict[key]):
-                # pre_gpu_buffer.append()
-                # tensor_numel = value.numel()
+            with self.snapshot_streams.stream():
                 # gpu_buffer_state = torch.empty(tensor_numel, dtype=torch.float16, device=self.device)
                 model_tensor_cpu = value.view(-1).to('cpu', non_blocking=True)
                 # parameter_tensor_cpu = self.gpu_buffer_state[key].copy_(value.view(-1), non_blocking=True).to('cpu', non_blocking=True)
 
+        self.snapshot_streams.synchronize()
         return
 
 
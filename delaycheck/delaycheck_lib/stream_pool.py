@@ -0,0 +1,113 @@
+import threading
+from contextlib import contextmanager, nullcontext
+import torch
+
+
+class _NullEvent:
+    """Stand-in for torch.cuda.Event when running without a GPU; work is already done."""
+
+    def record(self, stream=None):
+        pass
+
+    def query(self):
+        return True
+
+    def synchronize(self):
+        pass
+
+
+class _NullStream:
+    """Stand-in for torch.cuda.Stream when running without a GPU."""
+
+    def wait_event(self, event):
+        pass
+
+    def wait_stream(self, stream):
+        pass
+
+    def record_event(self, event=None):
+        return event if event is not None else _NullEvent()
+
+    def synchronize(self):
+        pass
+
+
+class StreamPool:
+    """
+    Small fixed set of copy streams shared by the model and optimizer snapshot paths.
+
+    Streams are handed out round-robin. Work issued through `stream()` records
+    a completion event, so callers wait on the events of their own copies
+    instead of synchronizing one stream per tensor. Without CUDA the pool uses
+    no-op streams and events, and copies run synchronously on the host.
+    """
+
+    def __init__(self, size=4, use_cuda=None):
+        assert size > 0, "stream pool needs at least one stream"
+        if use_cuda is None:
+            use_cuda = torch.cuda.is_available()
+        self.use_cuda = use_cuda
+        self.size = size
+        self.streams = [torch.cuda.Stream() if use_cuda else _NullStream() for _ in range(size)]
+        self.head = 0
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def _new_event(self):
+        return torch.cuda.Event() if self.use_cuda else _NullEvent()
+
+    def acquire(self):
+        """Next stream in round-robin order."""
+        with self.lock:
+            stream = self.streams[self.head]
+            self.head = (self.head + 1) % self.size
+        return stream
+
+    @contextmanager
+    def stream(self, ready_event=None):
+        """
+        Run the enclosed work on the next pool stream.
+
+        The stream first waits for `ready_event` (or, when omitted, the caller's
+        current stream) so the copies see finished source tensors.
+        """
+        stream = self.acquire()
+        if self.use_cuda:
+            if ready_event is None:
+                stream.wait_stream(torch.cuda.current_stream())
+            else:
+                stream.wait_event(ready_event)
+            context = torch.cuda.stream(stream)
+        else:
+            context = nullcontext()
+        with context:
+            yield stream
+        event = self._new_event()
+        event.record(stream)
+        with self.lock:
+            self.pending.append(event)
+
+    @property
+    def num_pending(self):
+        with self.lock:
+            return len(self.pending)
+
+    def query(self):
+        """True when every copy issued so far has completed."""
+        with self.lock:
+            self.pending = [event for event in self.pending if not event.query()]
+            return not self.pending
+
+    def synchronize(self):
+        """Block until every copy issued so far has completed."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for event in pending:
+            event.synchronize()
+
+    def wait_on(self, stream):
+        """Make `stream` wait for the copies issued so far without blocking the host."""
+        with self.lock:
+            pending = list(self.pending)
+        for event in pending:
+            stream.wait_event(event)
@@ -6,49 +6,6 @@ import torch.distributed as dist
 import torchsnapshot
 
 
-def initialize_cpu_shared_memory():
- 
-    if dist.get_rank() == 0:
-        
-        shape = (4, 1024*1024*1024*10) 
-        dtype = np.float16  
-        size = np.prod(shape) * np.dtype(dtype).itemsize
-
-
-        model_name = 'model_buffer'
-        try:
-            shm_model = shared_memory.SharedMemory(name =model_name)
-            # shm_model.unlink() 
-        except FileNotFoundError:
-            shm_model = shared_memory.SharedMemory(create=True, size=size, name =model_name)
-            pass
-        array_model = np.ndarray(shape, dtype=dtype, buffer=shm_model.buf)
-
-
-        optimizer_name_avg = 'optimizer_buffer_avg'
-        try:
-            shm_optimizer_avg = shared_memory.SharedMemory(name =optimizer_name_avg)
-            
-            # shm_optimizer.unlink() 
-        except FileNotFoundError:
-            shm_optimizer_avg = shared_memory.SharedMemory(create=True, size=size, name =optimizer_name_avg)
-            pass
-        array_optimizer_avg = np.ndarray(shape, dtype=dtype, buffer=shm_optimizer_avg.buf)
-
-
-        optimizer_name_avg_sq = 'optimizer_buffer_avg_sq'
-        try:
-            shm_optimizer_avg = shared_memory.SharedMemory(name =optimizer_name_avg_sq)
-
-            # shm_parameter.unlink() 
-        except FileNotFoundError:
-            shm_optimizer_avg = shared_memory.SharedMemory(create=True, size=size, name =optimizer_name_avg_sq)
-            pass
-        array_optimizer_avg_sq = np.ndarray(shape, dtype=dtype, buffer=shm_optimizer_avg.buf)
-
-    pass
-
-
 def save_checkpoint_iteration(state, epoch,  iteration, save_dir='./checkpoint'):
     
     filename ='ckpt_epoch_' + str(epoch) + '_iteration_' + str(iteration)+ '_rank_' + str(dist.get_rank()) + '.pth.tar'
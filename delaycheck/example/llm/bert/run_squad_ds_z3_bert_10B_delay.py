@@ -83,7 +83,6 @@ from torchsnapshot import Snapshot, Stateful
 import torch.distributed as dist
 from tqdm import tqdm
 from multiprocessing import shared_memory
-import threading
 
 
 
@@ -852,8 +851,6 @@ def full_train():
         for idx, batch_data in enumerate(train_iter):             
             forworad_time = time.time()
             
-            process_optimizer = threading.Thread(target=first_second_copy_optimizer_async, args=(optimizer,))
-            process_optimizer.start()
             if args.max_steps > 0 and global_step > args.max_steps:
                 break
 
@@ -900,14 +897,6 @@ def full_train():
                 
                 backworad_time_array.append(time.time() - backworad_time)
             
-            if idx == 40 and dist.get_rank() % 2 == 0 :
-                optimizer.process_model.join()
-                process_optimizer.join()
-                optimizer.save_ckpt_to_disk_sync(optimizer.model_data, cpu_optimizer_array_avg, cpu_optimizer_array_avg_sq, dist.get_rank())
-                # optimizer.start_queue.put((0))
-                # optimizer.module_queue.put((optimizer.model_data, optimizer.model_data))
-                # optimizer.optimizer_queue.put((cpu_optimizer_array_avg, cpu_optimizer_array_avg, cpu_optimizer_array_avg_sq, cpu_optimizer_array_avg_sq))
-            
             step_time = time.time()
             
             # gradient clipping
@@ -917,6 +906,7 @@ def full_train():
                     scheduler.step()
                 # optimizer.step()
                 model.step()
+                flush_to_disk(optimizer)
 
                 optimizer.zero_grad()
                 global_step += 1
@@ -971,17 +961,15 @@ def delete_folder_contents(folder):
 
 
 
-def flush_to_disk(idx, freq, ranks_per_node):
-    if idx == freq and dist.get_rank() % ranks_per_node == 0 :
-        optimizer.process_model.join()
-        process_optimizer.join()
-        optimizer.save_ckpt_to_disk_sync(optimizer.model_data_flush, optimizer.optimizer_avg_data, optimizer.optimizer_avg_sq_data, dist.get_rank())
-        # 
-        # optimizer.start_queue.put((0))
-        # optimizer.module_queue.put((optimizer.model_data, optimizer.model_data))
-        # optimizer.optimizer_queue.put((cpu_optimizer_array_avg, cpu_optimizer_array_avg, cpu_optimizer_array_avg_sq, cpu_optimizer_array_avg_sq))
-
-    return
+def flush_to_disk(optimizer):
+    # Follows the flush interval tuned by the optimizer; a committed iteration is flushed once
+    if not optimizer.flush_due():
+        return
+    if optimizer.shm_arenas is not None:
+        # Local ranks publish into shared memory, the node aggregator process writes the file
+        optimizer.flush_to_node_file()
+    elif dist.get_rank() % int(os.environ.get('LOCAL_WORLD_SIZE', torch.cuda.device_count())) == 0:
+        optimizer.flush_committed_snapshot(dist.get_rank())
 
 
 
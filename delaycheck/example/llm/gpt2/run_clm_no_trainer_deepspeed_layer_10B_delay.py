@@ -48,9 +48,7 @@ from datasets import load_dataset
 from huggingface_hub import HfApi
 from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
-from multiprocessing import shared_memory
 import torch.distributed as dist
-import threading  
 
 
 
@@ -377,49 +375,17 @@ def parse_args():
     return args
 
 
-def initialize_cpu_shared_memory():
-    
-
-    
-    if dist.get_rank() == 0:
-        
-        shape = (4, 1024*1024*1024*10) 
-        dtype = np.float16  
-        size = np.prod(shape) * np.dtype(dtype).itemsize
-
-
-        model_name = 'model_buffer'
-        try:
-            shm_model = shared_memory.SharedMemory(name =model_name)
-            # shm_model.unlink() 
-        except FileNotFoundError:
-            shm_model = shared_memory.SharedMemory(create=True, size=size, name =model_name)
-            pass
-        array_model = np.ndarray(shape, dtype=dtype, buffer=shm_model.buf)
-
-
-        optimizer_name_1 = 'optimizer_buffer_avg'
-        try:
-            shm_optimizer_1 = shared_memory.SharedMemory(name =optimizer_name_1)
-            
-            # shm_optimizer.unlink() 
-        except FileNotFoundError:
-            shm_optimizer_1 = shared_memory.SharedMemory(create=True, size=size, name =optimizer_name_1)
-            pass
-        array_optimizer_1 = np.ndarray(shape, dtype=dtype, buffer=shm_optimizer_1.buf)
-
-
-        optimizer_name_2 = 'optimizer_buffer_avg_sq'
-        try:
-            shm_optimizer_2 = shared_memory.SharedMemory(name =optimizer_name_2)
-
-            # shm_parameter.unlink() 
-        except FileNotFoundError:
-            shm_optimizer_2 = shared_memory.SharedMemory(create=True, size=size, name =optimizer_name_2)
-            pass
-        array_optimizer_2 = np.ndarray(shape, dtype=dtype, buffer=shm_optimizer_2.buf)
-
-    pass
+def initialize_cpu_shared_memory(optimizer, ranks_per_node):
+    local_rank = int(os.environ['LOCAL_RANK'])
+    # A restarted job first picks up the snapshot the failed run left in the node's shared memory
+    version = optimizer.restore_from_shared_memory(local_rank, ranks_per_node)
+    if version is not None and dist.get_rank() == 0:
+        print(f"Warm restart from the shared-memory snapshot of iteration {version}")
+    # Segments are sized from the partitions of every local rank, see delaycheck_lib/shm_arena.py
+    arenas = optimizer.initialize_shared_memory(local_rank, ranks_per_node)
+    # Local rank 0 also starts the process that writes the node's checkpoint file
+    optimizer.start_node_aggregator()
+    return arenas
 
 
 
@@ -462,8 +428,6 @@ def main():
     random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
-    
-    # initialize_cpu_shared_memory()
         
 
     if not args.do_train and not args.do_predict:
@@ -797,7 +761,9 @@ def main():
         model=model,
         model_parameters=optimizer_grouped_parameters,
         dist_init_required=True)
-    
+
+    ranks_per_node = int(os.environ.get('LOCAL_WORLD_SIZE', torch.cuda.device_count()))
+    initialize_cpu_shared_memory(optimizer, ranks_per_node)
 
 
     array_numel = []
@@ -938,9 +904,6 @@ def main():
                 #     training_model_clone_(optimizer.module)
                 # 
 
-                process_optimizer = threading.Thread(target=first_second_copy_optimizer_async, args=(optimizer,))
-                process_optimizer.start()
-                
                 loss = outputs.loss
 
                 ft = time.time() - forworad_time
@@ -960,6 +923,7 @@ def main():
 
                 # optimizer.step()
                 model.step()
+                flush_to_disk(optimizer)
                 
                 lr_scheduler.step()
                 optimizer.zero_grad()
@@ -1017,17 +981,15 @@ def main():
         logger.info(f"epoch {epoch}: perplexity: {perplexity} eval_loss: {eval_loss}")
 
 
-def flush_to_disk(idx, freq, ranks_per_node):
-    if idx == freq and dist.get_rank() % ranks_per_node == 0 :
-        optimizer.process_model.join()
-        process_optimizer.join()
-        optimizer.save_ckpt_to_disk_sync(optimizer.model_data_flush, optimizer.optimizer_avg_data, optimizer.optimizer_avg_sq_data, dist.get_rank())
-        # 
-        # optimizer.start_queue.put((0))
-        # optimizer.module_queue.put((optimizer.model_data, optimizer.model_data))
-        # optimizer.optimizer_queue.put((cpu_optimizer_array_avg, cpu_optimizer_array_avg, cpu_optimizer_array_avg_sq, cpu_optimizer_array_avg_sq))
-
-    return
+def flush_to_disk(optimizer):
+    # Follows the flush interval tuned by the optimizer; a committed iteration is flushed once
+    if not optimizer.flush_due():
+        return
+    if optimizer.shm_arenas is not None:
+        # Local ranks publish into shared memory, the node aggregator process writes the file
+        optimizer.flush_to_node_file()
+    elif dist.get_rank() % int(os.environ.get('LOCAL_WORLD_SIZE', torch.cuda.device_count())) == 0:
+        optimizer.flush_committed_snapshot(dist.get_rank())
 
 
 
@@ -48,7 +48,6 @@ from datasets import load_dataset
 from huggingface_hub import HfApi
 from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
-import threading
 
 
 import sys
@@ -919,9 +918,6 @@ def main():
                 # with accelerator.accumulate(model):
                 forworad_time = time.time()
                 
-                process_optimizer = threading.Thread(target=first_second_copy_optimizer_async, args=(optimizer,))
-                process_optimizer.start()
-                
                 ### to cuda
                 batch = {key: value.to(device) for key, value in batch.items()}
                 # batch = batch.to(device)
@@ -945,13 +941,9 @@ def main():
                 model.backward(loss)
                 backworad_time_array.append(time.time() - backworad_time)
                 
-                if step == 40 and dist.get_rank() % 2 == 0 :
-                    optimizer.process_model.join()
-                    process_optimizer.join()
-                    optimizer.save_ckpt_to_disk_sync(optimizer.model_data, cpu_optimizer_array_avg, cpu_optimizer_array_avg_sq, dist.get_rank())
-                
                 step_time = time.time()
                 model.step()
+                flush_to_disk(optimizer)
                 lr_scheduler.step()
                 optimizer.zero_grad()
 
@@ -1047,17 +1039,15 @@ def first_second_copy_optimizer_async(optimizer):
     if dist.get_rank()==0:
         print('Optimizer Numel = ',  numel)
 
-def flush_to_disk(idx, freq, ranks_per_node):
-    if idx == freq and dist.get_rank() % ranks_per_node == 0 :
-        optimizer.process_model.join()
-        process_optimizer.join()
-        optimizer.save_ckpt_to_disk_sync(optimizer.model_data_flush, optimizer.optimizer_avg_data, optimizer.optimizer_avg_sq_data, dist.get_rank())
-        # 
-        # optimizer.start_queue.put((0))
-        # optimizer.module_queue.put((optimizer.model_data, optimizer.model_data))
-        # optimizer.optimizer_queue.put((cpu_optimizer_array_avg, cpu_optimizer_array_avg, cpu_optimizer_array_avg_sq, cpu_optimizer_array_avg_sq))
-
-    return
+def flush_to_disk(optimizer):
+    # Follows the flush interval tuned by the optimizer; a committed iteration is flushed once
+    if not optimizer.flush_due():
+        return
+    if optimizer.shm_arenas is not None:
+        # Local ranks publish into shared memory, the node aggregator process writes the file
+        optimizer.flush_to_node_file()
+    elif dist.get_rank() % int(os.environ.get('LOCAL_WORLD_SIZE', torch.cuda.device_count())) == 0:
+        optimizer.flush_committed_snapshot(dist.get_rank())
 
 
 if __name__ == "__main__":
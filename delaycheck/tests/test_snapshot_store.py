@@ -0,0 +1,64 @@
+import os
+import sys
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from delaycheck_lib.snapshot_store import VersionedSnapshotStore, MODEL_PART, OPTIMIZER_PART
+from delaycheck_lib.snapshot_worker import SnapshotWorker
+
+
+def _snapshot_iterations(accumulation_steps, boundary_only, iterations=4):
+    # Buckets of partition slices, reduced once per micro-step as in the ZeRO-3 backward
+    buckets = [[0, 1], [2], [3, 4, 5]]
+    partition_numels = [96, 64, 128, 32, 80, 48]
+    store = VersionedSnapshotStore(partition_numels, [16], pin_memory=False)
+    worker = SnapshotWorker(None)
+    try:
+        for iteration in range(iterations):
+            params = [torch.full((numel, ), float(iteration * 10 + i), dtype=torch.float16)
+                      for i, numel in enumerate(partition_numels)]
+            store.begin(iteration)
+            bucket_id = 0
+            for micro_step in range(accumulation_steps):
+                boundary = micro_step == accumulation_steps - 1
+                for bucket in buckets:
+                    if boundary_only and not boundary:
+                        continue
+                    shadow = store.shadow
+                    shadow.bucket_params[bucket_id] = [(i, partition_numels[i]) for i in bucket]
+                    worker.submit([params[i] for i in bucket], sum(partition_numels[i] for i in bucket), iteration,
+                                  bucket_id, ring_buffer=shadow.model)
+                    bucket_id += 1
+            worker.drain()
+            store.mark_written(MODEL_PART)
+            store.mark_written(OPTIMIZER_PART)
+            assert store.commit(), iteration
+
+            with store.read() as snapshot:
+                assert snapshot.version == iteration
+                restored = torch.cat(snapshot.model)
+                assert torch.equal(restored, torch.cat([params[i] for bucket in buckets for i in bucket]))
+    finally:
+        worker.shutdown()
+
+
+def test_snapshot_gradient_accumulation():
+    for accumulation_steps in (1, 2, 4):
+        _snapshot_iterations(accumulation_steps, boundary_only=True)
+    print("Snapshots of the accumulation boundary fit the ring")
+
+
+def test_snapshot_every_micro_step_overflows():
+    # One pass over the partitions per bank: snapshotting every micro-step wraps the ring
+    try:
+        _snapshot_iterations(2, boundary_only=False)
+    except RuntimeError as e:
+        assert "the ring is too small" in str(e)
+    else:
+        assert False, "a wrapped ring must not be committed"
+    print("A wrapped ring is refused at commit")
+
+
+if __name__ == "__main__":
+    test_snapshot_gradient_accumulation()
+    test_snapshot_every_micro_step_overflows()
@@ -0,0 +1,139 @@
+import errno
+import json
+import mmap
+import os
+import struct
+import torch
+
+# A checkpoint file is [aligned sections][JSON index][footer]
+FILE_MAGIC = b'FPCKIDX1'
+ALIGNMENT = 4096
+# index offset, magic
+_FOOTER = struct.Struct('<Q8s')
+
+
+def align_up(nbytes, alignment=ALIGNMENT):
+    return (nbytes + alignment - 1) // alignment * alignment
+
+
+def checkpoint_file_path(save_dir, rank, tag):
+    return os.path.join(save_dir, f"ckpt_rank{rank}_{tag}.fpck")
+
+
+def _dtype_name(dtype):
+    return str(dtype).split('.')[-1]
+
+
+def build_index(sections):
+    """
+    Lay out `sections`, a list of (name, dtype, tensors), in one file.
+
+    Each section starts at an aligned offset and holds its tensors back to
+    back in `dtype`, so a section is one contiguous byte stream. Returns the
+    index and the number of data bytes before it.
+    """
+    index = {"alignment": ALIGNMENT, "sections": []}
+    offset = 0
+    for name, dtype, tensors in sections:
+        offset = align_up(offset)
+        itemsize = torch.tensor([], dtype=dtype).element_size()
+        section = {"name": name, "dtype": _dtype_name(dtype), "offset": offset, "tensors": []}
+        for tensor in tensors:
+            nbytes = tensor.numel() * itemsize
+            section["tensors"].append({
+                "dtype": _dtype_name(dtype),
+                "shape": list(tensor.shape),
+                "offset": offset,
+                "nbytes": nbytes,
+            })
+            offset += nbytes
+        section["nbytes"] = offset - section["offset"]
+        # O_DIRECT writes round the tail up to the alignment; nbytes stays the true length
+        section["padded_nbytes"] = align_up(section["nbytes"])
+        index["sections"].append(section)
+    data_bytes = align_up(offset)
+    index["data_bytes"] = data_bytes
+    return index, data_bytes
+
+
+def encode_index(index):
+    return json.dumps(index).encode()
+
+
+def open_for_write(path, direct=False):
+    """
+    Open `path` for writing, with O_DIRECT if asked and supported.
+
+    Returns the fd and whether O_DIRECT is in effect; file systems that
+    reject it at open time (tmpfs, some FUSE mounts) get a buffered fd.
+    """
+    flags = os.O_CREAT | os.O_RDWR | os.O_TRUNC
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(path, flags | os.O_DIRECT, 0o660), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(path, flags, 0o660), False
+
+
+def preallocate(path, nbytes, direct=False):
+    fd, direct = open_for_write(path, direct)
+    if hasattr(os, 'posix_fallocate') and nbytes > 0:
+        os.posix_fallocate(fd, 0, nbytes)
+    else:
+        os.ftruncate(fd, nbytes)
+    return fd, direct
+
+
+def write_index(path, index_bytes, data_bytes):
+    """
+    Append the index and footer after the data; the file is valid once this returns.
+
+    Goes through its own buffered fd since the index is not aligned.
+    """
+    footer = _FOOTER.pack(data_bytes, FILE_MAGIC)
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.pwrite(fd, index_bytes + footer, data_bytes)
+        os.ftruncate(fd, data_bytes + len(index_bytes) + len(footer))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_index(path):
+    with open(path, 'rb') as f:
+        f.seek(-_FOOTER.size, os.SEEK_END)
+        footer_offset = f.tell()
+        index_offset, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+        if magic != FILE_MAGIC:
+            raise ValueError(f"{path} is not a FastPersist checkpoint file")
+        f.seek(index_offset)
+        return json.loads(f.read(footer_offset - index_offset))
+
+
+def load_checkpoint_file(path):
+    """
+    Map a checkpoint file back into tensors without reading it eagerly.
+
+    Returns {section name: [tensors]}. The tensors are copy-on-write views
+    of a private mapping of the file, so modifying them never touches it.
+    """
+    index = read_index(path)
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), index["data_bytes"], access=mmap.ACCESS_COPY) if index["data_bytes"] else None
+
+    sections = {}
+    for section in index["sections"]:
+        tensors = []
+        for entry in section["tensors"]:
+            dtype = getattr(torch, entry["dtype"])
+            if entry["nbytes"] == 0:
+                tensors.append(torch.empty(entry["shape"], dtype=dtype))
+                continue
+            count = entry["nbytes"] // torch.tensor([], dtype=dtype).element_size()
+            tensor = torch.frombuffer(mapping, dtype=dtype, count=count, offset=entry["offset"])
+            tensors.append(tensor.view(entry["shape"]))
+        sections[section["name"]] = tensors
+    return sections
@@ -0,0 +1,122 @@
+import os
+import queue
+import time
+from collections import deque
+
+import torch
+
+from .ckpt_file import read_index
+from .uring_writer import UringWriter, StagingPool
+
+RESTORE_CHUNK_BYTES = 32 * 1024 * 1024
+RESTORE_QUEUE_DEPTH = 32
+
+
+def _allocate_sections(index, device):
+    # One flat buffer per section, in the order the sections were saved; tensors are views into it
+    sections = {}
+    flats = []
+    for section in index["sections"]:
+        dtype = getattr(torch, section["dtype"])
+        flat = torch.empty(section["nbytes"], dtype=torch.uint8, device=device,
+                           pin_memory=device.type == 'cpu' and torch.cuda.is_available())
+        tensors = []
+        for entry in section["tensors"]:
+            start = entry["offset"] - section["offset"]
+            tensors.append(flat[start:start + entry["nbytes"]].view(dtype).view(entry["shape"]))
+        sections[section["name"]] = tensors
+        flats.append((section["offset"], flat))
+    return sections, flats
+
+
+def _chunks(flats, chunk_bytes):
+    for file_offset, flat in flats:
+        for start in range(0, flat.numel(), chunk_bytes):
+            yield flat[start:start + chunk_bytes], file_offset + start
+
+
+def restore_checkpoint_file(path, device='cpu', chunk_bytes=RESTORE_CHUNK_BYTES, queue_depth=RESTORE_QUEUE_DEPTH):
+    """
+    Read a checkpoint file written by `persist_arrays` back into tensors on `device`.
+
+    Many chunk reads are kept in flight on one io_uring. For a CPU target the
+    reads land directly in the (pinned) destination; for a GPU target they
+    land in registered pinned staging buffers whose host-to-device copies run
+    on a side stream while the next chunks are still being read. Returns
+    ({section name: [tensors]}, seconds), with the tensors in save order.
+    """
+    device = torch.device(device)
+    index = read_index(path)
+    sections, flats = _allocate_sections(index, device)
+
+    writer = UringWriter(queue_depth=queue_depth)
+    fd = os.open(path, os.O_RDONLY)
+    start = time.time()
+    try:
+        writer.register_files([fd])
+        if device.type == 'cpu':
+            for dest, offset in _chunks(flats, chunk_bytes):
+                writer.read(fd, dest, offset)
+            writer.wait()
+        else:
+            _restore_to_device(writer, fd, flats, chunk_bytes, queue_depth, device)
+        writer.unregister_files()
+    finally:
+        os.close(fd)
+        writer.close()
+    return sections, time.time() - start
+
+
+def _restore_to_device(writer, fd, flats, chunk_bytes, queue_depth, device):
+    pool = StagingPool(writer, queue_depth, chunk_bytes, pin_memory=True)
+    stream = torch.cuda.Stream(device=device)
+    # The destinations were allocated on the current stream
+    stream.wait_stream(torch.cuda.current_stream(device))
+    chunks = list(_chunks(flats, chunk_bytes))
+    completed = queue.Queue()
+    # (event, staging index) of host-to-device copies still reading a staging buffer
+    copies = deque()
+    issued = 0
+    reads_inflight = 0
+    done = 0
+
+    while done < len(chunks):
+        while issued < len(chunks):
+            staging = pool.try_acquire()
+            if staging is None:
+                break
+            index, buffer = staging
+            dest, offset = chunks[issued]
+            writer.read(fd, buffer[:dest.numel()], offset, buf_index=index,
+                        callback=lambda nbytes, chunk=issued, index=index: completed.put((chunk, index, nbytes)))
+            issued += 1
+            reads_inflight += 1
+        writer.submit()
+
+        while copies and copies[0][0].query():
+            pool.release(copies.popleft()[1])
+
+        if reads_inflight == 0:
+            # Every buffer is waiting on a copy
+            event, index = copies.popleft()
+            event.synchronize()
+            pool.release(index)
+            continue
+
+        chunk, index, nbytes = completed.get()
+        reads_inflight -= 1
+        dest, _ = chunks[chunk]
+        if nbytes != dest.numel():
+            writer.wait()
+            raise RuntimeError(f"short read of chunk {chunk}: {nbytes} of {dest.numel()} bytes")
+        with torch.cuda.stream(stream):
+            dest.copy_(pool.buffers[index][:nbytes], non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(stream)
+        copies.append((event, index))
+        done += 1
+
+    stream.synchronize()
+    for _, index in copies:
+        pool.release(index)
+    writer.wait()
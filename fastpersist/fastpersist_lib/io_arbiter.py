@@ -0,0 +1,245 @@
+import fcntl
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+FASTPERSIST_CONFIG = 'fastpersist'
+IO_ARBITER = 'io_arbiter'
+IO_ARBITER_DEFAULT = False
+# Checkpoint mount points of a node, one per device; local ranks are spread over them
+SAVE_DIRS = 'save_dirs'
+SAVE_DIRS_DEFAULT = ('./checkpoint/', )
+# Write bandwidth of one device (bytes/s) that the local ranks share, or one per mount point
+DEVICE_BANDWIDTH = 'device_bandwidth'
+DEVICE_BANDWIDTH_DEFAULT = 3e9
+
+IO_ARBITER_PREFIX = 'fastpersist_io'
+# Bucket depth in seconds of device bandwidth; bounds how much a rank can burst ahead of the others
+BURST_SECONDS = 0.05
+ATTACH_TIMEOUT = 60.0
+
+# The segment starts with the creator's generation stamp, then one row per device:
+# token bucket state, then (bytes, first start, last end) per local rank
+_GENERATION_BYTES = 8
+_TOKENS = 0
+_LAST_REFILL = 1
+_HEADER = 2
+_RANK_FIELDS = 3
+
+
+def _job_id():
+    # Jobs sharing a node must not share a bucket: FASTPERSIST_RUN_ID if set, else the job's MASTER_PORT
+    return os.environ.get('FASTPERSIST_RUN_ID') or os.environ.get('MASTER_PORT', '0')
+
+
+def _fastpersist_config(ds_config):
+    if not isinstance(ds_config, dict):
+        ds_config = getattr(ds_config, '_param_dict', None) or {}
+    return ds_config.get(FASTPERSIST_CONFIG, {})
+
+
+def io_arbiter_enabled(ds_config):
+    return bool(_fastpersist_config(ds_config).get(IO_ARBITER, IO_ARBITER_DEFAULT))
+
+
+def fastpersist_save_dirs(ds_config):
+    save_dirs = _fastpersist_config(ds_config).get(SAVE_DIRS, SAVE_DIRS_DEFAULT)
+    if isinstance(save_dirs, str):
+        save_dirs = [save_dirs]
+    if len(save_dirs) == 0:
+        raise ValueError(f'"{FASTPERSIST_CONFIG}": "{SAVE_DIRS}" needs at least one directory')
+    return tuple(save_dirs)
+
+
+def fastpersist_device_bandwidth(ds_config):
+    device_bandwidth = _fastpersist_config(ds_config).get(DEVICE_BANDWIDTH, DEVICE_BANDWIDTH_DEFAULT)
+    if np.isscalar(device_bandwidth):
+        return float(device_bandwidth)
+    return [float(rate) for rate in device_bandwidth]
+
+
+def _untrack(shm):
+    # Every local rank maps the segment; only the creator may unlink it
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+class NodeIOArbiter:
+    """
+    Shares the write bandwidth of the node's checkpoint devices between local ranks.
+
+    Each device (mount point in `mounts`) has a token bucket in node shared
+    memory refilled at its `device_bandwidth` bytes/s; a rank takes tokens
+    for every write before it enters its ring, so all local ranks together
+    stay at the device's peak instead of queueing far past it. The bucket
+    only holds BURST_SECONDS worth of tokens, which keeps the device queue,
+    and with it the tail latency of every rank's writes, short. Ranks are
+    spread over the mounts so every device is used. Every rank records the
+    bytes it wrote, from which `report` gives per-rank and per-device
+    throughput.
+
+    The segment is named per user and job, so jobs sharing a node keep
+    their own buckets. Local rank 0 replaces any segment left by an
+    earlier run of the job. The other
+    ranks attach only after `barrier` (a collective every local rank calls
+    once local rank 0 has created the segment), or, without one, once the
+    segment carries the creator's `generation` stamp, so no rank ends up
+    throttling on a stale bucket.
+    """
+
+    def __init__(self, mounts, device_bandwidth, local_rank, local_world_size,
+                 prefix=IO_ARBITER_PREFIX, burst_seconds=BURST_SECONDS, barrier=None, generation=None):
+        self.mounts = list(mounts)
+        if np.isscalar(device_bandwidth):
+            device_bandwidth = [device_bandwidth] * len(self.mounts)
+        self.rates = [float(rate) for rate in device_bandwidth]
+        self.burst_seconds = burst_seconds
+        self.local_rank = local_rank
+        self.local_world_size = local_world_size
+        self.device = local_rank % len(self.mounts)
+        self.owner = local_rank == 0
+
+        name = f"{prefix}_{os.getuid()}_{_job_id()}"
+        shape = (len(self.mounts), _HEADER + _RANK_FIELDS * local_world_size)
+        nbytes = _GENERATION_BYTES + int(np.prod(shape)) * 8
+        self.lock_fd = os.open(os.path.join(tempfile.gettempdir(), name + '.lock'), os.O_CREAT | os.O_RDWR, 0o600)
+        if self.owner:
+            try:
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+            except FileNotFoundError:
+                pass
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=nbytes)
+            self.generation = generation if generation is not None else int.from_bytes(os.urandom(7), 'little') | 1
+            self._map(shape)
+            with self._locked():
+                self.state[:] = 0
+                now = time.time()
+                for device, rate in enumerate(self.rates):
+                    self.state[device, _TOKENS] = rate * burst_seconds
+                    self.state[device, _LAST_REFILL] = now
+                # Stamped last, a rank waiting for this generation sees an initialized bucket
+                self.stamp[0] = self.generation
+            if barrier is not None:
+                barrier()
+        else:
+            if barrier is not None:
+                barrier()
+            elif generation is None:
+                raise ValueError("a local rank other than 0 needs a barrier or the creator's generation")
+            self.shm = self._attach(name, nbytes, generation)
+            self._map(shape)
+            self.generation = int(self.stamp[0])
+
+    def _map(self, shape):
+        self.stamp = np.ndarray((1, ), dtype=np.int64, buffer=self.shm.buf)
+        self.state = np.ndarray(shape, dtype=np.float64, buffer=self.shm.buf, offset=_GENERATION_BYTES)
+
+    @staticmethod
+    def _attach(name, nbytes, generation=None):
+        deadline = time.time() + ATTACH_TIMEOUT
+        while True:
+            try:
+                shm = _untrack(shared_memory.SharedMemory(name=name))
+                stamp = int(np.ndarray((1, ), dtype=np.int64, buffer=shm.buf)[0]) if shm.size >= nbytes else None
+                # A zero stamp is a segment its creator has not initialized yet
+                if stamp and (generation is None or stamp == generation):
+                    return shm
+                shm.close()
+            except FileNotFoundError:
+                pass
+            if time.time() > deadline:
+                raise RuntimeError(f"local rank 0 did not create the I/O arbiter segment {name}")
+            time.sleep(0.05)
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    @property
+    def save_dir(self):
+        return self.mounts[self.device]
+
+    def acquire(self, nbytes):
+        """Block until this rank may put `nbytes` more on its device."""
+        rate = self.rates[self.device]
+        burst = rate * self.burst_seconds
+        # A request larger than the bucket waits for a full bucket and leaves it in debt
+        need = min(nbytes, burst)
+        while True:
+            with self._locked():
+                row = self.state[self.device]
+                now = time.time()
+                row[_TOKENS] = min(burst, row[_TOKENS] + (now - row[_LAST_REFILL]) * rate)
+                row[_LAST_REFILL] = now
+                if row[_TOKENS] >= need:
+                    row[_TOKENS] -= nbytes
+                    return
+                deficit = need - row[_TOKENS]
+            time.sleep(deficit / rate)
+
+    def record(self, nbytes, start, end):
+        """Account a finished write phase of this rank that ran from `start` to `end`."""
+        column = _HEADER + _RANK_FIELDS * self.local_rank
+        with self._locked():
+            row = self.state[self.device]
+            row[column] += nbytes
+            if row[column + 1] == 0 or start < row[column + 1]:
+                row[column + 1] = start
+            row[column + 2] = max(row[column + 2], end)
+
+    def report(self):
+        """Per-rank and per-device bytes and bytes per second since the arbiter was created."""
+        with self._locked():
+            state = self.state.copy()
+        ranks = {}
+        devices = {}
+        for device, mount in enumerate(self.mounts):
+            total = 0.0
+            first, last = None, None
+            for rank in range(self.local_world_size):
+                column = _HEADER + _RANK_FIELDS * rank
+                nbytes, start, end = state[device, column:column + _RANK_FIELDS]
+                if nbytes == 0:
+                    continue
+                ranks[rank] = {"device": mount, "nbytes": nbytes, "bytes_per_s": nbytes / max(end - start, 1e-9)}
+                total += nbytes
+                first = start if first is None else min(first, start)
+                last = end if last is None else max(last, end)
+            devices[mount] = {
+                "nbytes": total,
+                "bytes_per_s": total / max(last - first, 1e-9) if total else 0.0,
+                "peak": self.rates[device],
+            }
+        return ranks, devices
+
+    def format_report(self):
+        ranks, devices = self.report()
+        lines = [f"local rank {rank} -> {r['device']}: {r['nbytes'] / 1e9:.2f} GB, {r['bytes_per_s'] / 1e9:.2f} GB/s"
+                 for rank, r in sorted(ranks.items())]
+        lines += [f"{mount}: {d['nbytes'] / 1e9:.2f} GB, {d['bytes_per_s'] / 1e9:.2f} GB/s of {d['peak'] / 1e9:.2f} GB/s peak"
+                  for mount, d in devices.items()]
+        return "\n".join(lines)
+
+    def close(self):
+        self.state = None
+        self.stamp = None
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+        os.close(self.lock_fd)
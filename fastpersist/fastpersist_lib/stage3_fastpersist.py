@@ -42,54 +42,231 @@ OPTIMIZER_SWAP_OUT_STATE_TIMER = 'optimizer_swap_out_state'
 OPTIMIZER_STEP_TIMER = 'optimizer_step'
 
 from collections import deque
+import errno
+import os
 import time
 import numpy as np
 import torch.multiprocessing as mp
 import threading
 import torch.distributed 
-import liburing
 import pickle
-from liburing import O_CREAT, O_RDWR, AT_FDCWD, iovec, io_uring, io_uring_get_sqe, \
-                     io_uring_prep_openat, io_uring_prep_write, io_uring_prep_read, \
-                     io_uring_prep_close, io_uring_submit, io_uring_wait_cqe, \
-                     io_uring_cqe_seen, io_uring_cqe, io_uring_queue_init, io_uring_queue_exit, \
-                     io_uring_sqe_set_data64, trap_error
-
-def _submit_and_wait(ring, cqe):
-    io_uring_submit(ring)  # submit entry
-    io_uring_wait_cqe(ring, cqe)  # wait for entry to finish
-    result = trap_error(cqe.res)  # auto raise appropriate exception if failed
-    # note `cqe.res` returns results, if ``< 0`` its an error, if ``>= 0`` its the value
-
-    # done with current entry so clear it from completion queue.
-    io_uring_cqe_seen(ring, cqe)
-    return result  # type: int
-
-def open(ring, cqe, path, flags, mode=0o660, dir_fd=AT_FDCWD):
-    _path = path if isinstance(path, bytes) else str(path).encode()
-    # if `path` is relative and `dir_fd` is `AT_FDCWD`, then `path` is relative
-    # to current working directory. Also `_path` must be in bytes
-
-    sqe = io_uring_get_sqe(ring)  # sqe(submission queue entry)
-    io_uring_prep_openat(sqe, _path, flags, mode, dir_fd)
-    # set submit entry identifier as `1` which is returned back in `cqe.user_data`
-    # so you can keep track of submit/completed entries.
-    io_uring_sqe_set_data64(sqe, 1)
-    return _submit_and_wait(ring, cqe)  # returns fd
-    
-def write(ring, cqe, fd, data, offset=0):
-    iov = iovec(data)  # or iovec([bytearray(data)])
-    sqe = io_uring_get_sqe(ring)
-    io_uring_prep_write(sqe, fd, iov.iov_base, iov.iov_len, offset)
-    io_uring_sqe_set_data64(sqe, 2)
-    return _submit_and_wait(ring, cqe)  # returns length(s) of bytes written
+from .uring_writer import UringWriter, StagingPool, IOV_MAX
+from .ckpt_file import align_up, build_index, encode_index, preallocate, write_index, checkpoint_file_path
+from .ckpt_restore import restore_checkpoint_file
+from .io_arbiter import NodeIOArbiter, io_arbiter_enabled, fastpersist_save_dirs, fastpersist_device_bandwidth, \
+    SAVE_DIRS_DEFAULT, DEVICE_BANDWIDTH_DEFAULT
+
+# Every rank writes one preallocated file per checkpoint, filled through registered staging buffers
+FASTPERSIST_CHUNK_BYTES = 32 * 1024 * 1024
+FASTPERSIST_QUEUE_DEPTH = 32
+# Staging buffers allocated once per writer: one is filled while the others are being written
+FASTPERSIST_STAGING_BUFFERS = 4
+# Opt-in: bypass the page cache; falls back to buffered writes where the file system refuses O_DIRECT.
+# Only page-aligned tensors keep the zero-copy path under O_DIRECT, the rest go through staging.
+FASTPERSIST_DIRECT_IO = False
+
+
+class _SectionWriter:
+    """
+    Queues the tensors of one section at consecutive file offsets.
+
+    Contiguous CPU tensors already in the section dtype are written straight
+    from their storage: large ones in chunk-sized writes, small ones gathered
+    into vectored writes. Only tensors that need a dtype conversion (or are
+    not contiguous) are copied, into the registered staging buffers. With
+    `direct`, every write must be aligned: tensors whose address, size and
+    file offset are page aligned are still written from their storage, the
+    others are streamed through the staging buffers and the tail is zero
+    padded.
+    """
+
+    def __init__(self, writer, pool, fd, dtype, offset, chunk_bytes=FASTPERSIST_CHUNK_BYTES, direct=False):
+        self.writer = writer
+        self.direct = direct
+        self.pool = pool
+        self.fd = fd
+        self.dtype = dtype
+        self.offset = offset
+        self.chunk_bytes = chunk_bytes
+        # Pending vectored write: views and the file offset of the first one
+        self.gather = []
+        self.gather_offset = offset
+        self.gather_bytes = 0
+        # Pending staging buffer: (index, buffer), bytes filled and its file offset
+        self.staging = None
+        self.staging_fill = 0
+        self.staging_offset = offset
+        self.bytes_copied = 0
+        self.bytes_zero_copy = 0
+        self.copy_seconds = 0.0
+        # Time spent waiting for a staging buffer to come back from the writer
+        self.stall_seconds = 0.0
+
+    def add(self, tensor):
+        nbytes = tensor.numel() * tensor.element_size()
+        if nbytes == 0:
+            return
+        zero_copy = tensor.dtype == self.dtype and tensor.device.type == 'cpu' and tensor.is_contiguous()
+        if zero_copy and self.direct:
+            # Staged bytes still pending would leave the offset unaligned
+            zero_copy = (self.staging is None and self.offset == align_up(self.offset) and nbytes == align_up(nbytes)
+                         and tensor.data_ptr() == align_up(tensor.data_ptr()) and nbytes >= self.chunk_bytes)
+        if zero_copy:
+            self._flush_staging()
+            if nbytes >= self.chunk_bytes:
+                self._flush_gather()
+                data = tensor.view(-1).view(torch.uint8)
+                for start in range(0, nbytes, self.chunk_bytes):
+                    self.writer.write(self.fd, data[start:start + self.chunk_bytes], self.offset + start)
+            else:
+                if not self.gather:
+                    self.gather_offset = self.offset
+                self.gather.append(tensor)
+                self.gather_bytes += nbytes
+                if self.gather_bytes >= self.chunk_bytes or len(self.gather) == IOV_MAX:
+                    self._flush_gather()
+            self.bytes_zero_copy += nbytes
+            self.offset += nbytes
+        else:
+            self._flush_gather()
+            self._stage(tensor.reshape(-1))
+
+    def _stage(self, flat):
+        saved_numel = 0
+        while saved_numel < flat.numel():
+            if self.staging is None:
+                start = time.time()
+                self.staging = self.pool.acquire()
+                self.stall_seconds += time.time() - start
+                self.staging_fill = 0
+                self.staging_offset = self.offset
+            buffer = self.staging[1].view(self.dtype)
+            numel = self.staging_fill // buffer.element_size()
+            tosave_numel = min(buffer.numel() - numel, flat.numel() - saved_numel)
+            start = time.time()
+            buffer[numel:numel + tosave_numel].copy_(flat[saved_numel:saved_numel + tosave_numel])
+            self.copy_seconds += time.time() - start
+            nbytes = tosave_numel * buffer.element_size()
+            self.staging_fill += nbytes
+            self.bytes_copied += nbytes
+            self.offset += nbytes
+            saved_numel += tosave_numel
+            if self.staging_fill == self.staging[1].numel():
+                self._flush_staging()
 
+    def _flush_gather(self):
+        if not self.gather:
+            return
+        if len(self.gather) == 1:
+            self.writer.write(self.fd, self.gather[0], self.gather_offset)
+        else:
+            self.writer.writev(self.fd, self.gather, self.gather_offset)
+        self.gather = []
+        self.gather_bytes = 0
+
+    def _flush_staging(self):
+        if self.staging is None:
+            return
+        index, buffer = self.staging
+        self.staging = None
+        nbytes = self.staging_fill
+        if self.direct:
+            nbytes = align_up(nbytes)
+            buffer[self.staging_fill:nbytes].zero_()
+        try:
+            self.writer.write(self.fd, buffer[:nbytes], self.staging_offset,
+                              callback=lambda _: self.pool.release(index), buf_index=index)
+        except Exception:
+            self.pool.release(index)
+            raise
+
+    def close(self):
+        self._flush_gather()
+        self._flush_staging()
+
+
+def _write_sections(writer, pool, fd, sections, index, direct):
+    stats = {"bytes_copied": 0, "copy_seconds": 0.0, "stall_seconds": 0.0}
+    busy_time = writer.busy_time
+    bytes_written = writer.bytes_written
+    start = time.time()
+    for (_, dtype, arrays), section in zip(sections, index["sections"]):
+        section_writer = _SectionWriter(writer, pool, fd, dtype, section["offset"], direct=direct)
+        for tensor in arrays:
+            section_writer.add(tensor)
+        section_writer.close()
+        stats["bytes_copied"] += section_writer.bytes_copied
+        stats["copy_seconds"] += section_writer.copy_seconds
+        stats["stall_seconds"] += section_writer.stall_seconds
+    writer.wait()
+    stats["nbytes"] = writer.bytes_written - bytes_written
+    stats["seconds"] = time.time() - start
+    stats["io_seconds"] = writer.busy_time - busy_time
+    # Share of the shorter of copy and I/O that was hidden behind the other: 1 means wall time = max(copy, I/O)
+    hidden = stats["copy_seconds"] + stats["io_seconds"] - stats["seconds"]
+    shorter = min(stats["copy_seconds"], stats["io_seconds"])
+    stats["overlap"] = min(1.0, max(0.0, hidden / shorter)) if shorter > 0 else 1.0
+    return stats
+
+
+def format_persist_stats(stats):
+    return (f"{stats['seconds']:.3f}s wall, copy {stats['copy_seconds']:.3f}s ({stats['bytes_copied'] / 1e9:.3f} GB), "
+            f"I/O {stats['io_seconds']:.3f}s, stalled on staging {stats['stall_seconds']:.3f}s, "
+            f"overlap {stats['overlap'] * 100:.1f}%")
+
+
+def _drain(writer):
+    # Let every write still in flight finish, dropping the errors they raise
+    while True:
+        try:
+            writer.wait()
+            return
+        except OSError:
+            continue
+
+
+def persist_arrays(writer, pool, module_arrays, optimizer_arrays, rank, tag, save_dir='./checkpoint/',
+                   direct=FASTPERSIST_DIRECT_IO):
+    """
+    Write the module (fp16) and optimizer (fp32) arrays of `rank` into one checkpoint file.
+
+    The file is preallocated to its final size, every section is written at
+    its offset from the layout, and the index is appended last, so a file
+    without a valid footer is an incomplete checkpoint. With `direct` the
+    data bypasses the page cache; if the file system rejects O_DIRECT at
+    open or on the first writes, the file is rewritten buffered. Returns the
+    path and the stats of the write: bytes that went through a staging
+    copy, copy, I/O and wall seconds, and how much of copy and I/O overlapped.
+    """
+    sections = [('module%d' % i, torch.float16, arrays) for i, arrays in enumerate(module_arrays)]
+    sections += [('optimizer%d' % i, torch.float32, arrays) for i, arrays in enumerate(optimizer_arrays)]
+    index, data_bytes = build_index(sections)
+
+    path = checkpoint_file_path(save_dir, rank, tag)
+    while True:
+        fd, direct = preallocate(path, data_bytes, direct=direct)
+        try:
+            writer.register_files([fd])
+            try:
+                stats = _write_sections(writer, pool, fd, sections, index, direct)
+            except OSError as e:
+                if not direct or e.errno != errno.EINVAL:
+                    raise
+                _drain(writer)
+                logger.warning(f"{save_dir} rejected O_DIRECT writes, falling back to buffered I/O")
+                direct = False
+                continue
+            finally:
+                writer.unregister_files()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        break
+
+    index["direct"] = direct
+    write_index(path, encode_index(index), data_bytes)
+    return path, stats
 
-def close(ring, cqe, fd):
-    sqe = io_uring_get_sqe(ring)
-    io_uring_prep_close(sqe, fd)
-    io_uring_sqe_set_data64(sqe, 4)
-    _submit_and_wait(ring, cqe)  # no error means success!
 
 def print_rank_0(message, debug=False, force=False):
     rank = dist.get_rank()
@@ -152,203 +329,102 @@ def unwrap_model_for_generation(model):
         optimizer_offload._register_hooks_recursively(optimizer_offload.module)
     return
 
-def save_ckpt(event, queue, rank):
+def _local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0)), int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+
+
+def rank_save_dir(local_rank, save_dirs=SAVE_DIRS_DEFAULT):
+    return save_dirs[local_rank % len(save_dirs)]
+
+
+def create_io_arbiter(save_dirs=SAVE_DIRS_DEFAULT, device_bandwidth=DEVICE_BANDWIDTH_DEFAULT, barrier=None,
+                      generation=None):
+    """The node's I/O arbiter, seen from this process's local rank; one per rank and node."""
+    local_rank, local_world_size = _local_rank()
+    return NodeIOArbiter(save_dirs, device_bandwidth, local_rank, local_world_size,
+                         barrier=barrier, generation=generation)
+
+
+def _persist_arbitrated(writer, pool, arbiter, module_arrays, optimizer_arrays, rank, tag, save_dirs=SAVE_DIRS_DEFAULT):
+    # Without an arbiter the rank writes unthrottled to its own save dir
+    save_dir = arbiter.save_dir if arbiter is not None else rank_save_dir(_local_rank()[0], save_dirs)
+    start = time.time()
+    path, stats = persist_arrays(writer, pool, module_arrays, optimizer_arrays, rank, tag, save_dir=save_dir)
+    if arbiter is not None:
+        arbiter.record(stats["nbytes"], start, time.time())
+    return path, stats
+
+
+def save_ckpt(event, queue, rank, generation=None, save_dirs=SAVE_DIRS_DEFAULT,
+              device_bandwidth=DEVICE_BANDWIDTH_DEFAULT):
     # torch.cuda.set_device(rank)
-    # stream = torch.cuda.Stream()
-    ring = io_uring()
-    cqe = io_uring_cqe()
-    io_uring_queue_init(32, ring, 0)
+    # The ring, its staging buffers and their registration live as long as the process;
+    # `event` is set each time a dequeued checkpoint is on disk, a None item stops the writer.
+    # Use either this process or save_ckpt_sync on a rank, they would both own the rank's arbiter slot.
+    # `generation` is the parent's arbiter generation; the process cannot join the ranks' barrier.
+    # `save_dirs` and `device_bandwidth` come from the parent's "fastpersist" config section.
+    arbiter = create_io_arbiter(save_dirs, device_bandwidth, generation=generation) if generation is not None else None
+    writer = UringWriter(queue_depth=FASTPERSIST_QUEUE_DEPTH, throttle=arbiter.acquire if arbiter is not None else None)
+    pool = StagingPool(writer, FASTPERSIST_STAGING_BUFFERS, FASTPERSIST_CHUNK_BYTES, pin_memory=torch.cuda.is_available())
+    ckpt_id = 0
     while True :
-        cpu_tensor_array_module1, cpu_tensor_array_module2, cpu_tensor_array_optimizer1, cpu_tensor_array_optimizer2  = queue.get()
-        alignment = 32 * 1024 * 1024
-        # alignment = 16 * 1024 * 1024
-        # alignment = 512 * 1024 * 1024
-
-        onetime_elements_module = alignment // 2
-        onetime_elements_optimizer = alignment // 4
-        buffer_module = torch.empty(onetime_elements_module, dtype=torch.float16)
-        buffer_optimizer = torch.empty(onetime_elements_optimizer, dtype=torch.float32)
-            
-        numel = 0
-        save_dir = './checkpoint/'
-        id = 0
-        # fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank)+ '_step' +  str(step) + str(id)+ '.pt', O_CREAT | O_RDWR)
-        for tensor in cpu_tensor_array_module1:
-            saved_numel = 0
-            tensor_numel = tensor.numel()
-            while saved_numel < tensor_numel:
-                tosave_numel = min(onetime_elements_module - numel, tensor_numel - saved_numel)
-                buffer_module[numel : numel + tosave_numel] = tensor.view(-1)[saved_numel : saved_numel + tosave_numel]
-                numel += tosave_numel
-                saved_numel += tosave_numel
-                if numel == onetime_elements_module:
-                    fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-                    write(ring, cqe, fd, buffer_module.numpy().tobytes())
-                    numel = 0
-                    id +=  1
-                    close(ring, cqe, fd)
-            
-        for tensor in cpu_tensor_array_module2:
-            saved_numel = 0
-            tensor_numel = tensor.numel()
-            while saved_numel < tensor_numel:
-                tosave_numel = min(onetime_elements_module - numel, tensor_numel - saved_numel)
-                buffer_module[numel : numel + tosave_numel] = tensor.view(-1)[saved_numel : saved_numel + tosave_numel]
-                numel += tosave_numel
-                saved_numel += tosave_numel
-                if numel == onetime_elements_module:
-                    fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-                    write(ring, cqe, fd, buffer_module.numpy().tobytes())
-                    numel = 0
-                    id +=  1
-                    close(ring, cqe, fd)
-        
-        if numel != 0:
-            fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-            write(ring, cqe, fd, buffer_module.numpy().tobytes())
-            numel = 0
-            id +=  1
-            close(ring, cqe, fd)
-        
-        for tensor in cpu_tensor_array_optimizer1:
-            saved_numel = 0
-            tensor_numel = tensor.numel()
-            while saved_numel < tensor_numel:
-                tosave_numel = min(onetime_elements_optimizer - numel, tensor_numel - saved_numel)
-                buffer_optimizer[numel : numel + tosave_numel] = tensor.view(-1)[saved_numel : saved_numel + tosave_numel]
-                numel += tosave_numel
-                saved_numel += tosave_numel
-                if numel == onetime_elements_optimizer:
-                    fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-                    write(ring, cqe, fd, buffer_optimizer.numpy().tobytes())
-                    numel = 0
-                    id +=  1
-                    close(ring, cqe, fd)
-            
-        for tensor in cpu_tensor_array_optimizer2:
-            saved_numel = 0
-            tensor_numel = tensor.numel()
-            while saved_numel < tensor_numel:
-                tosave_numel = min(onetime_elements_optimizer - numel, tensor_numel - saved_numel)
-                buffer_optimizer[numel : numel + tosave_numel] = tensor.view(-1)[saved_numel : saved_numel + tosave_numel]
-                numel += tosave_numel
-                saved_numel += tosave_numel
-                if numel == onetime_elements_optimizer:
-                    fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-                    write(ring, cqe, fd, buffer_optimizer.numpy().tobytes())
-                    numel = 0
-                    id +=  1
-                    close(ring, cqe, fd)
-        
-        if numel != 0:
-            fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-            write(ring, cqe, fd, buffer_optimizer.numpy().tobytes())
-            numel = 0
-            id +=  1
-            close(ring, cqe, fd)
-                    
-    io_uring_queue_exit(ring)
-
-def save_ckpt_sync(cpu_tensor_array_module1, cpu_tensor_array_module2, cpu_tensor_array_optimizer1, cpu_tensor_array_optimizer2, rank):
+        item = queue.get()
+        if item is None:
+            break
+        cpu_tensor_array_module1, cpu_tensor_array_module2, cpu_tensor_array_optimizer1, cpu_tensor_array_optimizer2  = item
+        _, stats = _persist_arbitrated(writer, pool, arbiter, (cpu_tensor_array_module1, cpu_tensor_array_module2),
+                                       (cpu_tensor_array_optimizer1, cpu_tensor_array_optimizer2), rank, ckpt_id,
+                                       save_dirs=save_dirs)
+        if rank == 0:
+            print(f"ckpt {ckpt_id} persisted: {format_persist_stats(stats)}")
+        if arbiter is not None and arbiter.owner:
+            print(arbiter.format_report())
+        ckpt_id += 1
+        event.set()
+
+    writer.close()
+    if arbiter is not None:
+        arbiter.close()
+
+def save_ckpt_sync(cpu_tensor_array_module1, cpu_tensor_array_module2, cpu_tensor_array_optimizer1, cpu_tensor_array_optimizer2, rank, tag=0, arbiter=None,
+                   save_dirs=SAVE_DIRS_DEFAULT):
     # torch.cuda.set_device(rank)
-    # stream = torch.cuda.Stream()
     start_time = time.time()
     if rank == 0:
         print("Start sync on-disk ckpt.")
-    ring = io_uring()
-    cqe = io_uring_cqe()
-    io_uring_queue_init(32, ring, 0)
-    
-    alignment = 32 * 1024 * 1024
+    writer = UringWriter(queue_depth=FASTPERSIST_QUEUE_DEPTH, throttle=arbiter.acquire if arbiter is not None else None)
+    pool = StagingPool(writer, FASTPERSIST_STAGING_BUFFERS, FASTPERSIST_CHUNK_BYTES, pin_memory=torch.cuda.is_available())
 
-    onetime_elements_module = alignment // 2
-    onetime_elements_optimizer = alignment // 4
-    buffer_module = torch.empty(onetime_elements_module, dtype=torch.float16)
-    buffer_optimizer = torch.empty(onetime_elements_optimizer, dtype=torch.float32)
-        
-    numel = 0
-    save_dir = './checkpoint/'
-    id = 0
-    # fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank)+ '_step' +  str(step) + str(id)+ '.pt', O_CREAT | O_RDWR)
-    for tensor in cpu_tensor_array_module1:
-        saved_numel = 0
-        tensor_numel = tensor.numel()
-        while saved_numel < tensor_numel:
-            tosave_numel = min(onetime_elements_module - numel, tensor_numel - saved_numel)
-            buffer_module[numel : numel + tosave_numel] = tensor.view(-1)[saved_numel : saved_numel + tosave_numel]
-            numel += tosave_numel
-            saved_numel += tosave_numel
-            if numel == onetime_elements_module:
-                fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-                write(ring, cqe, fd, buffer_module.numpy().tobytes())
-                numel = 0
-                id +=  1
-                close(ring, cqe, fd)
-        
-    for tensor in cpu_tensor_array_module2:
-        saved_numel = 0
-        tensor_numel = tensor.numel()
-        while saved_numel < tensor_numel:
-            tosave_numel = min(onetime_elements_module - numel, tensor_numel - saved_numel)
-            buffer_module[numel : numel + tosave_numel] = tensor.view(-1)[saved_numel : saved_numel + tosave_numel]
-            numel += tosave_numel
-            saved_numel += tosave_numel
-            if numel == onetime_elements_module:
-                fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-                write(ring, cqe, fd, buffer_module.numpy().tobytes())
-                numel = 0
-                id +=  1
-                close(ring, cqe, fd)
-    
-    if numel != 0:
-        fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-        write(ring, cqe, fd, buffer_module.numpy().tobytes())
-        numel = 0
-        id +=  1
-        close(ring, cqe, fd)
-    
-    for tensor in cpu_tensor_array_optimizer1:
-        saved_numel = 0
-        tensor_numel = tensor.numel()
-        while saved_numel < tensor_numel:
-            tosave_numel = min(onetime_elements_optimizer - numel, tensor_numel - saved_numel)
-            buffer_optimizer[numel : numel + tosave_numel] = tensor.view(-1)[saved_numel : saved_numel + tosave_numel]
-            numel += tosave_numel
-            saved_numel += tosave_numel
-            if numel == onetime_elements_optimizer:
-                fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-                write(ring, cqe, fd, buffer_optimizer.numpy().tobytes())
-                numel = 0
-                id +=  1
-                close(ring, cqe, fd)
-        
-    for tensor in cpu_tensor_array_optimizer2:
-        saved_numel = 0
-        tensor_numel = tensor.numel()
-        while saved_numel < tensor_numel:
-            tosave_numel = min(onetime_elements_optimizer - numel, tensor_numel - saved_numel)
-            buffer_optimizer[numel : numel + tosave_numel] = tensor.view(-1)[saved_numel : saved_numel + tosave_numel]
-            numel += tosave_numel
-            saved_numel += tosave_numel
-            if numel == onetime_elements_optimizer:
-                fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-                write(ring, cqe, fd, buffer_optimizer.numpy().tobytes())
-                numel = 0
-                id +=  1
-                close(ring, cqe, fd)
-    
-    if numel != 0:
-        fd = open(ring, cqe, save_dir + 'ckpt_' + 'rank' + str(rank) + str(id)+ '.pt', O_CREAT | O_RDWR)
-        write(ring, cqe, fd, buffer_optimizer.numpy().tobytes())
-        numel = 0
-        id +=  1
-        close(ring, cqe, fd)
-                    
-    io_uring_queue_exit(ring)
+    _, stats = _persist_arbitrated(writer, pool, arbiter, (cpu_tensor_array_module1, cpu_tensor_array_module2),
+                                   (cpu_tensor_array_optimizer1, cpu_tensor_array_optimizer2), rank, tag,
+                                   save_dirs=save_dirs)
+    writer.close()
     
     if rank == 0:
-        print("finish save ckpt to disk, time = ", time.time() - start_time)
+        print("finish save ckpt to disk, time = ", time.time() - start_time,
+              ", throughput = ", writer.throughput() / 1e9, "GB/s",
+              ", written = ", writer.bytes_written / 1e9, "GB,", format_persist_stats(stats))
+    if arbiter is not None and arbiter.owner:
+        print(arbiter.format_report())
     
+def load_ckpt(rank, tag, save_dir=None, device='cpu', save_dirs=SAVE_DIRS_DEFAULT):
+    """
+    Restore the arrays `save_ckpt`/`save_ckpt_sync` wrote for `rank` and `tag`.
+
+    Returns ((module arrays...), (optimizer arrays...)) with every array's
+    tensors in the order they were saved.
+    """
+    if save_dir is None:
+        save_dir = rank_save_dir(_local_rank()[0], save_dirs)
+    path = checkpoint_file_path(save_dir, rank, tag)
+    sections, seconds = restore_checkpoint_file(path, device)
+    nbytes = sum(t.numel() * t.element_size() for tensors in sections.values() for t in tensors)
+    if rank == 0:
+        print("finish load ckpt from disk, time = ", seconds, ", throughput = ", nbytes / seconds / 1e9, "GB/s")
+    module_arrays = tuple(tensors for name, tensors in sections.items() if name.startswith('module'))
+    optimizer_arrays = tuple(tensors for name, tensors in sections.items() if name.startswith('optimizer'))
+    return module_arrays, optimizer_arrays
+
 INITIAL_MICRO_STEP_ID = -1
 
 
@@ -701,10 +777,16 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         # self.cuda_stream_optimizer_dict_avg={}
         # self.cuda_stream_optimizer_dict_avg_sq={}
         
+        # "fastpersist": {"save_dirs": [...], "device_bandwidth": bytes/s}; node-wide write throttling is
+        # opt-in with "io_arbiter": true
+        self.save_dirs = fastpersist_save_dirs(ds_config)
+        self.device_bandwidth = fastpersist_device_bandwidth(ds_config)
+        self.io_arbiter = create_io_arbiter(self.save_dirs, self.device_bandwidth,
+                                            barrier=dist.barrier) if io_arbiter_enabled(ds_config) else None
         # if dist.get_rank() % 2 == 0:
         #     self.event = mp.Event()
         #     self.queue = mp.Queue()
-        #     self.to_disk_process = mp.Process(target=save_ckpt, args=(self.event, self.queue, dist.get_rank(), ))
+        #     self.to_disk_process = mp.Process(target=save_ckpt, args=(self.event, self.queue, dist.get_rank(), self.io_arbiter.generation, self.save_dirs, self.device_bandwidth))
         #     self.to_disk_process.start()
 
     def save_ckpt_in_memory(self, rank, module_state_dict, optimizer_state_dict):
@@ -802,6 +884,8 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
             hook.remove()
         print_rank_0("Removed grad acc hooks", force=False)
         del self.__ipg_bucket_flat_buffer
+        if self.io_arbiter is not None:
+            self.io_arbiter.close()
 
     def initialize_ds_offload(
         self,
@@ -2412,7 +2496,6 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
     
     
     import threading  
-    import torch.multiprocessing as mp
   
     # thread = threading.Thread(target=second_part_checkpoint, args=(optimizer,))
 
@@ -2437,7 +2520,7 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
             #     optimizer_stream.synchronize()
                 
             if self.step_count == 40 and dist.get_rank() % 2 == 0:
-               save_ckpt_sync(self.cpu_tensor_array_module, self.cpu_tensor_array_module, self.cpu_tensor_array_optimizer, self.cpu_tensor_array_optimizer, dist.get_rank())
+               save_ckpt_sync(self.cpu_tensor_array_module, self.cpu_tensor_array_module, self.cpu_tensor_array_optimizer, self.cpu_tensor_array_optimizer, dist.get_rank(), self.step_count, self.io_arbiter, self.save_dirs)
                 
         """
             Not supporting closure.
@@ -0,0 +1,442 @@
+import os
+import queue
+import threading
+import time
+import torch
+from liburing import io_uring, io_uring_cqe, io_uring_queue_init, io_uring_queue_exit, io_uring_get_sqe, \
+                     io_uring_prep_write, io_uring_prep_writev, io_uring_prep_write_fixed, io_uring_prep_read, \
+                     io_uring_prep_read_fixed, io_uring_prep_nop, io_uring_sqe_set_data64, \
+                     io_uring_sqe_set_flags, io_uring_submit, io_uring_wait_cqe, io_uring_cqe_seen, \
+                     io_uring_cqe_get_data64, io_uring_register_buffers, io_uring_unregister_buffers, \
+                     io_uring_register_files, io_uring_unregister_files, iovec, IOSQE_FIXED_FILE, trap_error
+
+# user_data of the NOP that stops the completion loop
+_STOP = 0
+# Most iovecs the kernel accepts in one vectored write
+IOV_MAX = 1024
+
+
+def tensor_memoryview(tensor):
+    """Writable byte view of a contiguous CPU tensor's storage; no copy is made."""
+    assert tensor.device.type == 'cpu' and tensor.is_contiguous(), "io_uring needs contiguous CPU memory"
+    return memoryview(tensor.view(-1).view(torch.uint8).numpy()).cast('B')
+
+
+class _WriteRequest:
+    __slots__ = ('fd', 'fixed_file', 'views', 'nbytes', 'buf_index', 'offset', 'written', 'callback', 'iov', 'read')
+
+    def __init__(self, fd, fixed_file, views, buf_index, offset, callback, read=False):
+        self.fd = fd
+        self.read = read
+        self.fixed_file = fixed_file
+        self.views = views
+        self.nbytes = sum(len(view) for view in views)
+        self.buf_index = buf_index
+        self.offset = offset
+        self.written = 0
+        self.callback = callback
+        self.iov = None
+
+    def remaining(self):
+        """The views still to be written after a short write."""
+        skip = self.written
+        views = []
+        for view in self.views:
+            if skip >= len(view):
+                skip -= len(view)
+                continue
+            views.append(view[skip:])
+            skip = 0
+        return views
+
+
+class UringWriter:
+    """
+    Asynchronous io_uring writer with up to `queue_depth` writes in flight.
+
+    `write` only prepares an SQE; SQEs are submitted in batches of
+    `submit_batch` (or when the queue is full), and a separate thread reaps
+    completions, resubmits short writes and runs the per-write callback.
+    Buffers registered with `register_buffers` are written with
+    WRITE_FIXED, files registered with `register_files` are addressed by
+    index, which saves the kernel a lookup and a page pin per request.
+    `read` queues reads on the same ring, for restoring what was written.
+    `throttle(nbytes)`, if given, is called before every write enters the
+    ring and may block, e.g. to share a device with other processes.
+    """
+
+    def __init__(self, queue_depth=32, submit_batch=None, throttle=None):
+        self.queue_depth = queue_depth
+        self.throttle = throttle
+        self.submit_batch = submit_batch or max(1, queue_depth // 4)
+        self.ring = io_uring()
+        io_uring_queue_init(queue_depth * 2, self.ring, 0)
+
+        self.slots = threading.Semaphore(queue_depth)
+        # The submission queue has a single producer at a time: the caller, or the reaper for short writes
+        self.sq_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.requests = {}
+        self.next_id = 1
+        self.unsubmitted = 0
+        self.error = None
+
+        self.fixed_buffers = []
+        self.fixed_files = {}
+
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.busy_time = 0.0
+        self.busy_since = None
+
+        self.reaper = threading.Thread(target=self._reap, name="fastpersist-uring-reaper", daemon=True)
+        self.reaper.start()
+
+    @property
+    def inflight(self):
+        with self.lock:
+            return len(self.requests)
+
+    def register_buffers(self, buffers):
+        """Register long-lived CPU tensors as fixed buffers; returns their indices."""
+        assert self.inflight == 0, "buffers can only be registered while the writer is idle"
+        if self.fixed_buffers:
+            io_uring_unregister_buffers(self.ring)
+        self.fixed_buffers = [tensor_memoryview(buffer) for buffer in buffers]
+        io_uring_register_buffers(self.ring, iovec(self.fixed_buffers), len(self.fixed_buffers))
+        return list(range(len(self.fixed_buffers)))
+
+    def register_files(self, fds):
+        """Register long-lived file descriptors; writes to them then use the fixed file table."""
+        assert self.inflight == 0, "files can only be registered while the writer is idle"
+        if self.fixed_files:
+            io_uring_unregister_files(self.ring)
+            self.fixed_files = {}
+        if fds:
+            io_uring_register_files(self.ring, list(fds), len(fds))
+            self.fixed_files = {fd: index for index, fd in enumerate(fds)}
+
+    def unregister_files(self):
+        self.register_files([])
+
+    def write(self, fd, data, offset, callback=None, buf_index=None):
+        """
+        Queue a write of `data` (a CPU tensor or a bytes-like object) at `offset`.
+
+        `data` must stay untouched until `callback(nbytes)` has run; nbytes
+        is short of the request only if the write failed, in which case the
+        error is raised from the next `write` or `wait`. With
+        `buf_index`, `data` must lie inside that registered buffer.
+        """
+        return self._queue(fd, [data], offset, callback, buf_index)
+
+    def read(self, fd, data, offset, callback=None, buf_index=None):
+        """
+        Queue a read into `data` (a CPU tensor or a writable buffer) from `offset`.
+
+        Short reads are resubmitted; `callback(nbytes)` gets fewer bytes than
+        asked for only at end of file or on error.
+        """
+        return self._queue(fd, [data], offset, callback, buf_index, read=True)
+
+    def writev(self, fd, buffers, offset, callback=None):
+        """
+        Queue one vectored write of `buffers` laid back to back from `offset`.
+
+        Lets many small tensors go out in a single request straight from
+        their own memory, instead of being packed into a staging buffer.
+        """
+        assert 0 < len(buffers) <= IOV_MAX, f"a vectored write takes 1 to {IOV_MAX} buffers"
+        return self._queue(fd, buffers, offset, callback, None)
+
+    def _queue(self, fd, buffers, offset, callback, buf_index, read=False):
+        views = [tensor_memoryview(data) if torch.is_tensor(data) else memoryview(data).cast('B') for data in buffers]
+        if self.throttle is not None and not read:
+            self.throttle(sum(len(view) for view in views))
+        if not self.slots.acquire(blocking=False):
+            # Queue full: make sure what was prepared is in the kernel before waiting on it
+            self.submit()
+            self.slots.acquire()
+        if self.error is not None:
+            self.slots.release()
+            self._raise_error()
+
+        request = _WriteRequest(fd, fd in self.fixed_files, views, buf_index, offset, callback, read)
+        with self.lock:
+            request_id = self.next_id
+            self.next_id += 1
+            self.requests[request_id] = request
+            if self.busy_since is None:
+                self.busy_since = time.time()
+        with self.sq_lock:
+            self._prep(request_id, request)
+            self.unsubmitted += 1
+        if self.unsubmitted >= self.submit_batch:
+            self.submit()
+        return request_id
+
+    def _prep(self, request_id, request):
+        views = request.remaining()
+        request.iov = iovec(views[0] if len(views) == 1 else views)
+        sqe = io_uring_get_sqe(self.ring)
+        target = self.fixed_files[request.fd] if request.fixed_file else request.fd
+        if request.read:
+            if request.buf_index is not None:
+                io_uring_prep_read_fixed(sqe, target, request.iov.iov_base, request.iov.iov_len,
+                                         request.offset + request.written, request.buf_index)
+            else:
+                io_uring_prep_read(sqe, target, request.iov.iov_base, request.iov.iov_len,
+                                   request.offset + request.written)
+        elif len(views) > 1:
+            io_uring_prep_writev(sqe, target, request.iov, len(views), request.offset + request.written)
+        elif request.buf_index is not None:
+            io_uring_prep_write_fixed(sqe, target, request.iov.iov_base, request.iov.iov_len,
+                                      request.offset + request.written, request.buf_index)
+        else:
+            io_uring_prep_write(sqe, target, request.iov.iov_base, request.iov.iov_len,
+                                request.offset + request.written)
+        if request.fixed_file:
+            io_uring_sqe_set_flags(sqe, IOSQE_FIXED_FILE)
+        io_uring_sqe_set_data64(sqe, request_id)
+
+    def submit(self):
+        with self.sq_lock:
+            if self.unsubmitted:
+                io_uring_submit(self.ring)
+                self.unsubmitted = 0
+
+    def wait(self):
+        """Submit everything and block until all writes have completed."""
+        self.submit()
+        with self.idle:
+            while self.requests:
+                self.idle.wait()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _reap(self):
+        cqe = io_uring_cqe()
+        while True:
+            io_uring_wait_cqe(self.ring, cqe)
+            request_id = io_uring_cqe_get_data64(cqe)
+            res = cqe.res
+            io_uring_cqe_seen(self.ring, cqe)
+            if request_id == _STOP:
+                return
+
+            with self.lock:
+                request = self.requests[request_id]
+            try:
+                written = trap_error(res)
+            except Exception as e:
+                self.error = e
+                written = None
+
+            if written is not None:
+                request.written += written
+                if 0 < written and request.written < request.nbytes:
+                    # Short transfer: the remainder goes back into the ring under the same id
+                    with self.sq_lock:
+                        self._prep(request_id, request)
+                        io_uring_submit(self.ring)
+                    continue
+
+            # The callback also runs after a failed write, with the bytes that did land, so buffers get released
+            if request.callback is not None:
+                try:
+                    request.callback(request.written)
+                except Exception as e:
+                    self.error = e
+            with self.idle:
+                del self.requests[request_id]
+                if written is not None and request.read:
+                    self.bytes_read += request.written
+                elif written is not None:
+                    self.bytes_written += request.written
+                if not self.requests:
+                    self.busy_time += time.time() - self.busy_since
+                    self.busy_since = None
+                    self.idle.notify_all()
+            self.slots.release()
+
+    def throughput(self):
+        """Bytes per second over the time the writer had requests in flight."""
+        return self.bytes_written / self.busy_time if self.busy_time > 0 else 0.0
+
+    def reset_stats(self):
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.busy_time = 0.0
+
+    def close(self):
+        self.wait()
+        with self.sq_lock:
+            sqe = io_uring_get_sqe(self.ring)
+            io_uring_prep_nop(sqe)
+            io_uring_sqe_set_data64(sqe, _STOP)
+            io_uring_submit(self.ring)
+        self.reaper.join()
+        if self.fixed_files:
+            io_uring_unregister_files(self.ring)
+        if self.fixed_buffers:
+            io_uring_unregister_buffers(self.ring)
+        io_uring_queue_exit(self.ring)
+
+
+def aligned_empty(nbytes, alignment=4096, pin_memory=False):
+    """Byte tensor whose data pointer is a multiple of `alignment`, as O_DIRECT requires."""
+    raw = torch.empty(nbytes + alignment, dtype=torch.uint8, pin_memory=pin_memory)
+    start = -raw.data_ptr() % alignment
+    return raw[start:start + nbytes]
+
+
+class StagingPool:
+    """
+    Staging buffers allocated and registered once, handed out in turn.
+
+    `acquire` blocks until a buffer's previous write has completed, so the
+    producer fills one buffer while the others are being written. Buffers
+    are page aligned so they can be used for O_DIRECT writes.
+    """
+
+    def __init__(self, writer, num_buffers, buffer_bytes, pin_memory=False, alignment=4096):
+        self.buffers = [aligned_empty(buffer_bytes, alignment, pin_memory) for _ in range(num_buffers)]
+        self.indices = writer.register_buffers(self.buffers)
+        self.free = queue.Queue()
+        for index in self.indices:
+            self.free.put(index)
+
+    def acquire(self):
+        index = self.free.get()
+        return index, self.buffers[index]
+
+    def try_acquire(self):
+        """Like `acquire`, but returns None instead of blocking when every buffer is busy."""
+        try:
+            index = self.free.get(block=False)
+        except queue.Empty:
+            return None
+        return index, self.buffers[index]
+
+    def release(self, index):
+        self.free.put(index)
+
+
+def benchmark_writer(path,
+                     total_bytes=1 << 30,
+                     queue_depths=(1, 2, 4, 8, 16, 32, 64),
+                     chunk_sizes=(1 << 20, 4 << 20, 32 << 20)):
+    """Write `total_bytes` to `path` for each (queue depth, chunk size) and print the throughput."""
+    results = {}
+    for chunk_bytes in chunk_sizes:
+        for depth in queue_depths:
+            writer = UringWriter(queue_depth=depth)
+            pool = StagingPool(writer, depth, chunk_bytes)
+            for buffer in pool.buffers:
+                buffer.random_(0, 255)
+            fd = os.open(path, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o660)
+            writer.register_files([fd])
+
+            start = time.time()
+            for offset in range(0, total_bytes, chunk_bytes):
+                index, buffer = pool.acquire()
+                writer.write(fd, buffer, offset, callback=lambda _, index=index: pool.release(index), buf_index=index)
+            writer.wait()
+            os.fsync(fd)
+            seconds = time.time() - start
+
+            writer.close()
+            os.close(fd)
+            results[(depth, chunk_bytes)] = total_bytes / seconds
+            print(f"queue depth {depth:3d}, chunk {chunk_bytes >> 20:3d} MB: {total_bytes / seconds / 1e9:.2f} GB/s")
+    os.remove(path)
+    return results
+
+
+def _read_file(path, block_bytes, stop=None):
+    """Read `path` sequentially (in a loop until `stop` is set, else once); returns bytes per second."""
+    nbytes = 0
+    start = time.time()
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            data = f.read(block_bytes)
+            if not data:
+                if stop is None or stop.is_set():
+                    break
+                f.seek(0)
+                continue
+            nbytes += len(data)
+            if stop is not None and stop.is_set():
+                break
+    return nbytes / (time.time() - start)
+
+
+def benchmark_direct_io(path, reader_path, total_bytes=8 << 30, chunk_bytes=32 << 20, queue_depth=32, reader_bytes=1 << 30):
+    """
+    Compare buffered and O_DIRECT checkpoint writes of `total_bytes` to `path`.
+
+    A reader keeps re-reading `reader_path` (a stand-in for the training
+    dataset, warm in the page cache) while each write runs; the report gives
+    the write bandwidth, the reader's bandwidth during the write and how fast
+    the reader's file can be read right after it, i.e. whether the write
+    evicted it from the page cache.
+    """
+    if not os.path.exists(reader_path) or os.path.getsize(reader_path) < reader_bytes:
+        with open(reader_path, 'wb') as f:
+            for _ in range(0, reader_bytes, chunk_bytes):
+                f.write(os.urandom(chunk_bytes))
+    block_bytes = 1 << 20
+    _read_file(reader_path, block_bytes)
+    print(f"reader alone (page cache warm): {_read_file(reader_path, block_bytes) / 1e9:.2f} GB/s")
+
+    results = {}
+    for direct in (False, True):
+        mode = "direct" if direct else "buffered"
+        flags = os.O_CREAT | os.O_RDWR | os.O_TRUNC
+        try:
+            fd = os.open(path, flags | os.O_DIRECT if direct else flags, 0o660)
+        except OSError as e:
+            print(f"{mode}: not supported on this file system ({e.strerror})")
+            continue
+        writer = UringWriter(queue_depth=queue_depth)
+        pool = StagingPool(writer, queue_depth, chunk_bytes)
+        for buffer in pool.buffers:
+            buffer.random_(0, 255)
+        writer.register_files([fd])
+        _read_file(reader_path, block_bytes)
+
+        stop = threading.Event()
+        reader = []
+        reader_thread = threading.Thread(target=lambda: reader.append(_read_file(reader_path, block_bytes, stop)))
+        reader_thread.start()
+        start = time.time()
+        for offset in range(0, total_bytes, chunk_bytes):
+            index, buffer = pool.acquire()
+            writer.write(fd, buffer, offset, callback=lambda _, index=index: pool.release(index), buf_index=index)
+        writer.wait()
+        os.fsync(fd)
+        seconds = time.time() - start
+        stop.set()
+        reader_thread.join()
+        writer.close()
+        os.close(fd)
+
+        after = _read_file(reader_path, block_bytes)
+        results[mode] = (total_bytes / seconds, reader[0], after)
+        print(f"{mode:8s}: write {total_bytes / seconds / 1e9:.2f} GB/s, reader during write {reader[0] / 1e9:.2f} GB/s, "
+              f"reader after write {after / 1e9:.2f} GB/s")
+        os.remove(path)
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 2:
+        benchmark_direct_io(sys.argv[1], sys.argv[2])
+    else:
+        benchmark_writer(sys.argv[1] if len(sys.argv) > 1 else './checkpoint/uring_benchmark.bin')
@@ -0,0 +1,156 @@
+import time
+
+import torch
+
+# "gemini" section of the DeepSpeed config
+GEMINI_CONFIG = 'gemini'
+PIPELINE_DEPTH = 'pipeline_depth'
+CHUNK_BYTES = 'chunk_bytes'
+DISK_INTERVAL = 'disk_interval'
+SAVE_DIR = 'save_dir'
+REPLICAS = 'replicas'
+PLACEMENT = 'placement'
+REPLICA_PIECE_BYTES = 'replica_piece_bytes'
+
+PIPELINE_DEPTH_DEFAULT = 2
+CHUNK_BYTES_DEFAULT = 32 * 1024 * 1024
+# Iterations between on-disk checkpoints; 0 keeps checkpoints in memory only
+DISK_INTERVAL_DEFAULT = 0
+SAVE_DIR_DEFAULT = './checkpoint/'
+# Peer nodes holding a copy of each rank's snapshot in CPU memory; 0 disables replication
+REPLICAS_DEFAULT = 0
+PLACEMENT_DEFAULT = 'mixed'
+REPLICA_PIECE_BYTES_DEFAULT = 8 * 1024 * 1024
+
+
+def gemini_config(ds_config):
+    if not isinstance(ds_config, dict):
+        ds_config = getattr(ds_config, '_param_dict', None) or {}
+    return ds_config.get(GEMINI_CONFIG, {})
+
+
+class CheckpointPipeline:
+    """
+    Copies GPU tensors into host chunks through `depth` device staging buffers.
+
+    The tensors are packed into a staging buffer; a full buffer is copied
+    to its host chunk on the buffer's own stream while the next buffer is
+    filled. Staging buffers and streams are allocated here, once; pinned
+    host chunks are allocated the first time a checkpoint needs them and
+    reused by every later one, so `run` allocates nothing in steady state.
+    `run` alternates between two sets of host chunks and only fills the set
+    not returned last, so the previous checkpoint stays whole until the new
+    one is complete; the chunks returned by `run` stay valid until the
+    `run` after next.
+    `host_alloc(numel, dtype)` -> (tensor, handle) replaces the pinned host
+    allocation, e.g. to place the chunks in shared memory.
+    """
+
+    def __init__(self, dtype, device, depth=PIPELINE_DEPTH_DEFAULT, chunk_bytes=CHUNK_BYTES_DEFAULT, host_alloc=None):
+        self.dtype = dtype
+        self.device = device
+        self.depth = depth
+        self.chunk_numel = chunk_bytes // torch.tensor([], dtype=dtype).element_size()
+        self.staging = [torch.empty(self.chunk_numel, dtype=dtype, device=device) for _ in range(depth)]
+        self.streams = [torch.cuda.Stream(device=device) for _ in range(depth)]
+        self.host_alloc = host_alloc
+        # (tensor, handle) per host chunk, for each of the two sets; `run` fills set `back`
+        self.host_chunks = ([], [])
+        self.back = 0
+        self.stats = None
+
+    @classmethod
+    def from_config(cls, ds_config, dtype, device, host_alloc=None):
+        section = gemini_config(ds_config)
+        return cls(dtype, device,
+                   depth=section.get(PIPELINE_DEPTH, PIPELINE_DEPTH_DEFAULT),
+                   chunk_bytes=section.get(CHUNK_BYTES, CHUNK_BYTES_DEFAULT),
+                   host_alloc=host_alloc)
+
+    def _host_chunk(self, k):
+        host_chunks = self.host_chunks[self.back]
+        if k == len(host_chunks):
+            if self.host_alloc is not None:
+                host_chunks.append(self.host_alloc(self.chunk_numel, self.dtype))
+            else:
+                host_chunks.append((torch.empty(self.chunk_numel, dtype=self.dtype, pin_memory=True), None))
+        return host_chunks[k]
+
+    def run(self, tensors, on_chunk=None):
+        """
+        Copy every tensor of the iterable `tensors` to host memory, packed in order.
+
+        Returns the list of host chunks (the last one trimmed to its fill);
+        per-call copy, wait and queue seconds are left in `stats`. If given,
+        `on_chunk(host_chunk, handle)` is called for each chunk, in order, as
+        soon as its data has reached host memory.
+        """
+        stats = {"copy_seconds": 0.0, "wait_seconds": 0.0, "queue_seconds": 0.0, "chunks": 0, "numel": 0}
+        start = time.time()
+        current = torch.cuda.current_stream(self.device)
+        chunks = []
+        # Chunk being copied out of each staging buffer: (sequence number, host chunk, handle)
+        inflight = [None] * self.depth
+        index = 0
+        numel = 0
+
+        def flush(numel):
+            # Hand the filled staging buffer to its stream
+            t = time.time()
+            stream = self.streams[index]
+            stream.wait_stream(current)
+            host, handle = self._host_chunk(len(chunks))
+            host = host[:numel]
+            with torch.cuda.stream(stream):
+                host.copy_(self.staging[index][:numel], non_blocking=True)
+            inflight[index] = (len(chunks), host, handle)
+            chunks.append(host)
+            stats["queue_seconds"] += time.time() - t
+
+        def wait(index):
+            # The staging buffer is free again once its previous copy to host is done
+            t = time.time()
+            self.streams[index].synchronize()
+            stats["wait_seconds"] += time.time() - t
+            if inflight[index] is not None:
+                if on_chunk is not None:
+                    on_chunk(inflight[index][1], inflight[index][2])
+                inflight[index] = None
+
+        wait(index)
+        for tensor in tensors:
+            flat = tensor.view(-1)
+            saved_numel = 0
+            while saved_numel < flat.numel():
+                tosave_numel = min(self.chunk_numel - numel, flat.numel() - saved_numel)
+                t = time.time()
+                self.staging[index][numel:numel + tosave_numel].copy_(flat[saved_numel:saved_numel + tosave_numel])
+                stats["copy_seconds"] += time.time() - t
+                saved_numel += tosave_numel
+                numel += tosave_numel
+                if numel == self.chunk_numel:
+                    flush(numel)
+                    stats["numel"] += numel
+                    numel = 0
+                    index = (index + 1) % self.depth
+                    wait(index)
+        if numel:
+            flush(numel)
+            stats["numel"] += numel
+
+        # Drain oldest first so `on_chunk` sees the chunks in order
+        for i in sorted(range(self.depth), key=lambda i: inflight[i][0] if inflight[i] is not None else -1):
+            wait(i)
+        stats["chunks"] = len(chunks)
+        stats["seconds"] = time.time() - start
+        self.stats = stats
+        # The next run fills the other set
+        self.back ^= 1
+        return chunks
+
+    def format_stats(self):
+        stats = self.stats
+        if stats is None:
+            return "no checkpoint yet"
+        return (f"{stats['chunks']} chunks in {stats['seconds']:.4f}s: copy {stats['copy_seconds']:.4f}s, "
+                f"wait {stats['wait_seconds']:.4f}s, queue {stats['queue_seconds']:.4f}s")
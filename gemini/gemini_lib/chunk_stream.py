@@ -0,0 +1,212 @@
+import json
+import multiprocessing as mp
+import os
+import queue
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import torch
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def _attach(name):
+    shm = shared_memory.SharedMemory(name=name)
+    # The allocating process owns the segment; a worker must not unlink it on exit
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+class SharedChunkAllocator:
+    """
+    Allocates host chunks in named shared memory so a disk worker can read them in place.
+
+    Each chunk is its own segment, page-locked with cudaHostRegister when
+    CUDA is available so device-to-host copies into it stay asynchronous.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.segments = []
+
+    def __call__(self, numel, dtype):
+        nbytes = numel * torch.tensor([], dtype=dtype).element_size()
+        shm = shared_memory.SharedMemory(name=f"{self.prefix}_{len(self.segments)}", create=True, size=nbytes)
+        tensor = torch.frombuffer(shm.buf, dtype=dtype, count=numel)
+        if torch.cuda.is_available():
+            torch.cuda.cudart().cudaHostRegister(tensor.data_ptr(), nbytes, 0)
+        self.segments.append((shm, tensor))
+        return tensor, shm.name
+
+    def close(self):
+        for shm, tensor in self.segments:
+            if torch.cuda.is_available():
+                torch.cuda.cudart().cudaHostUnregister(tensor.data_ptr())
+            del tensor
+            try:
+                shm.close()
+            except BufferError:
+                # A chunk view is still referenced; the mapping goes away with the process
+                pass
+            shm.unlink()
+        self.segments = []
+
+
+def persist_chunk_stream(requests, results, path):
+    """
+    Worker loop: append chunks to `path` as their descriptors arrive.
+
+    Messages are ("begin", tag), ("chunk", name, nbytes, dtype, numel) and
+    ("end",); None stops the worker. A chunk is read straight from its
+    shared-memory segment, so nothing but the descriptor crosses the pipe.
+    On "end" the file is fsynced, renamed into place and described by a
+    manifest, and a summary is put on `results`. If writing a checkpoint
+    fails, its remaining chunks are dropped, the partial file is removed
+    and {"tag", "error"} is put on `results` instead; the worker keeps
+    serving the next checkpoint.
+    """
+    segments = {}
+    tmp_path = path + '.tmp'
+    fd = None
+    failed = None
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        kind = message[0]
+        try:
+            if kind == "begin":
+                tag = message[1]
+                failed = None
+                fd = os.open(tmp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o644)
+                chunks = []
+                offset = 0
+                start = time.time()
+            elif kind == "chunk":
+                if failed is not None:
+                    continue
+                _, name, nbytes, dtype, numel = message
+                if name not in segments:
+                    segments[name] = _attach(name)
+                view = segments[name].buf[:nbytes]
+                try:
+                    written = 0
+                    while written < nbytes:
+                        written += os.write(fd, view[written:])
+                finally:
+                    view.release()
+                chunks.append({"offset": offset, "nbytes": nbytes, "dtype": dtype, "numel": numel})
+                offset += nbytes
+            elif kind == "end":
+                if failed is not None:
+                    results.put({"tag": tag, "error": failed})
+                    continue
+                os.fsync(fd)
+                os.close(fd)
+                fd = None
+                os.replace(tmp_path, path)
+                seconds = time.time() - start
+                manifest = {
+                    "tag": tag,
+                    "file": os.path.basename(path),
+                    "nbytes": offset,
+                    "chunks": chunks,
+                    "seconds": seconds,
+                }
+                manifest_tmp = path + MANIFEST_SUFFIX + '.tmp'
+                with open(manifest_tmp, 'w') as f:
+                    json.dump(manifest, f, indent=1)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(manifest_tmp, path + MANIFEST_SUFFIX)
+                results.put({"tag": tag, "nbytes": offset, "chunks": len(chunks), "seconds": seconds})
+        except Exception as e:
+            failed = f"{type(e).__name__}: {e}"
+            if fd is not None:
+                os.close(fd)
+                fd = None
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            if kind == "end":
+                results.put({"tag": tag, "error": failed})
+    if fd is not None:
+        os.close(fd)
+    for shm in segments.values():
+        shm.close()
+
+
+def load_chunk_stream(path):
+    """Read a file written by `persist_chunk_stream` back into its list of chunks."""
+    with open(path + MANIFEST_SUFFIX) as f:
+        manifest = json.load(f)
+    chunks = []
+    with open(path, 'rb') as f:
+        for chunk in manifest["chunks"]:
+            f.seek(chunk["offset"])
+            data = bytearray(f.read(chunk["nbytes"]))
+            chunks.append(torch.frombuffer(data, dtype=getattr(torch, chunk["dtype"]), count=chunk["numel"]))
+    return chunks
+
+
+class ChunkDiskWriter:
+    """
+    Background process that persists host chunks of one snapshot kind as they are produced.
+
+    `begin`, `chunk` for each chunk in order, then `end` stream one
+    checkpoint; the chunks must not be overwritten until `wait` returns.
+    """
+
+    def __init__(self, path):
+        ctx = mp.get_context('spawn')
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.path = path
+        self.process = ctx.Process(target=persist_chunk_stream, args=(self.requests, self.results, path), daemon=True)
+        self.process.start()
+        self.pending = 0
+
+    def begin(self, tag):
+        self.requests.put(("begin", tag))
+
+    def chunk(self, name, tensor):
+        self.requests.put(("chunk", name, tensor.numel() * tensor.element_size(),
+                           str(tensor.dtype).split('.')[-1], tensor.numel()))
+
+    def end(self):
+        self.requests.put(("end",))
+        self.pending += 1
+
+    def wait(self, block=True):
+        """
+        Summaries of the checkpoints finished since the last call.
+
+        Raises RuntimeError for a checkpoint the worker failed to write; the
+        worker keeps serving, so the next checkpoint can still be written.
+        """
+        done = []
+        while self.pending > 0:
+            try:
+                result = self.results.get(block=block)
+            except queue.Empty:
+                break
+            self.pending -= 1
+            if "error" in result:
+                raise RuntimeError(f"persisting checkpoint {result['tag']} to {self.path} failed: {result['error']}")
+            done.append(result)
+        return done
+
+    def shutdown(self):
+        if self.process is None:
+            return []
+        try:
+            done = self.wait()
+        finally:
+            self.requests.put(None)
+            self.process.join()
+            self.process = None
+        return done
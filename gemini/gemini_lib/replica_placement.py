@@ -0,0 +1,403 @@
+import json
+import os
+import threading
+import time
+
+import torch
+import torch.distributed as dist
+
+PLACEMENT_STRATEGIES = ('ring', 'group', 'mixed')
+# Collectives the ZeRO-3 training loop issues, in deepspeed.comm or torch.distributed
+COLLECTIVES = ('all_gather_into_tensor', 'allgather_fn', 'all_gather', 'reduce_scatter_tensor', 'reduce_scatter_fn',
+               'reduce_scatter', 'all_reduce', 'all_to_all_single', 'broadcast')
+
+_TAG_COUNT = 1
+_TAG_SIZES = 2
+_TAG_CHUNK = 16
+
+
+def _ring(nodes, replicas):
+    return {node: [nodes[(i + k) % len(nodes)] for k in range(1, replicas + 1)] for i, node in enumerate(nodes)}
+
+
+def _groups(nodes, size):
+    placement = {}
+    for start in range(0, len(nodes), size):
+        group = nodes[start:start + size]
+        for node in group:
+            placement[node] = [peer for peer in group if peer != node]
+    return placement
+
+
+def node_placement(num_nodes, replicas, strategy='mixed'):
+    """
+    Nodes holding a replica of each node's checkpoint, as {node: [peer nodes]}.
+
+    `ring` sends to the next `replicas` nodes. `group` splits the nodes into
+    groups of replicas + 1 that hold each other's checkpoints, which survives
+    more failure patterns but needs the node count to divide evenly. `mixed`
+    uses groups and places the remaining nodes (together with the last full
+    group) on a ring.
+    """
+    if strategy not in PLACEMENT_STRATEGIES:
+        raise ValueError(f"unknown placement strategy {strategy}, expected one of {PLACEMENT_STRATEGIES}")
+    replicas = min(replicas, num_nodes - 1)
+    nodes = list(range(num_nodes))
+    if replicas <= 0:
+        return {node: [] for node in nodes}
+    size = replicas + 1
+    if strategy == 'ring' or num_nodes < size:
+        return _ring(nodes, replicas)
+    if num_nodes % size == 0:
+        return _groups(nodes, size)
+    if strategy == 'group':
+        raise ValueError(f"group placement needs the node count ({num_nodes}) to be a multiple of {size}")
+    num_grouped = (num_nodes // size - 1) * size
+    placement = _groups(nodes[:num_grouped], size)
+    placement.update(_ring(nodes[num_grouped:], replicas))
+    return placement
+
+
+def rank_placement(rank, world_size, ranks_per_node, replicas, strategy='mixed'):
+    """Ranks this rank sends its replica to, and ranks it holds replicas for; peers share the local rank."""
+    num_nodes = world_size // ranks_per_node
+    node, local_rank = divmod(rank, ranks_per_node)
+    placement = node_placement(num_nodes, replicas, strategy)
+    send_to = [peer * ranks_per_node + local_rank for peer in placement[node]]
+    recv_from = [src * ranks_per_node + local_rank for src, peers in placement.items() if node in peers]
+    return send_to, recv_from
+
+
+def _overlap(start, end, intervals):
+    return sum(max(0.0, min(end, e) - max(start, s)) for s, e in intervals)
+
+
+class CommTimeline:
+    """
+    Records when collectives run, to find the idle gaps between them.
+
+    `instrument(module)` wraps the collectives of `module` (deepspeed.comm
+    in training, torch.distributed in a local gloo run). Every call is an
+    event; for async calls the event ends when the handle is waited on.
+    Times are host wall clock, so on NCCL they mark when a collective was
+    issued and awaited rather than when it ran on the device. The gaps of the
+    previous iteration, as offsets from its start, predict the gaps of the
+    current one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.active = 0
+        self.last_end = None
+        self.iteration_start = time.time()
+        self.gaps = []
+        self.previous_gaps = []
+        self.patched = []
+
+    def instrument(self, module, names=COLLECTIVES):
+        for name in names:
+            fn = getattr(module, name, None)
+            if fn is None or getattr(fn, '_timeline', None) is self:
+                continue
+            wrapper = self._wrap(name, fn)
+            setattr(module, name, wrapper)
+            self.patched.append((module, name, fn))
+
+    def uninstrument(self):
+        for module, name, fn in reversed(self.patched):
+            setattr(module, name, fn)
+        self.patched = []
+
+    def _wrap(self, name, fn):
+
+        def wrapper(*args, **kwargs):
+            start = self._begin()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                self._end(name, start)
+                raise
+            if kwargs.get('async_op') and hasattr(result, 'wait'):
+                wait = result.wait
+                ended = []
+
+                def timed_wait(*wargs, **wkwargs):
+                    try:
+                        return wait(*wargs, **wkwargs)
+                    finally:
+                        if not ended:
+                            ended.append(True)
+                            self._end(name, start)
+
+                result.wait = timed_wait
+            else:
+                self._end(name, start)
+            return result
+
+        wrapper._timeline = self
+        return wrapper
+
+    def _begin(self):
+        now = time.time()
+        with self.lock:
+            if self.active == 0 and self.last_end is not None:
+                self.gaps.append((self.last_end - self.iteration_start, now - self.iteration_start))
+            self.active += 1
+        return now
+
+    def _end(self, name, start):
+        now = time.time()
+        with self.lock:
+            self.active -= 1
+            self.events.append(("collective", name, start, now, 0))
+            if self.active == 0:
+                self.last_end = now
+
+    def mark_iteration(self):
+        """Start a new iteration; its gaps will be predicted from the one that just ended."""
+        now = time.time()
+        with self.lock:
+            if self.active == 0 and self.last_end is not None:
+                self.gaps.append((self.last_end - self.iteration_start, now - self.iteration_start))
+            self.previous_gaps = self.gaps
+            self.gaps = []
+            self.events.append(("iteration", "iteration", now, now, 0))
+            self.iteration_start = now
+            if self.active == 0:
+                self.last_end = now
+
+    def idle_remaining(self):
+        """
+        Seconds of idle time predicted to be left, 0 while a collective runs.
+
+        None when there is no profile yet to predict from.
+        """
+        with self.lock:
+            if self.active:
+                return 0.0
+            if not self.previous_gaps:
+                return None
+            offset = time.time() - self.iteration_start
+            for start, end in self.previous_gaps:
+                if start <= offset < end:
+                    return end - offset
+            return 0.0
+
+    def record(self, kind, name, start, end, nbytes=0):
+        with self.lock:
+            self.events.append((kind, name, start, end, nbytes))
+
+    def summary(self):
+        """Replica traffic: bytes, seconds, and the share of that time that overlapped a collective."""
+        with self.lock:
+            events = list(self.events)
+        collectives = [(s, e) for kind, _, s, e, _ in events if kind == "collective"]
+        replica = [(s, e, n) for kind, _, s, e, n in events if kind == "replica"]
+        seconds = sum(e - s for s, e, _ in replica)
+        overlapped = sum(_overlap(s, e, collectives) for s, e, _ in replica)
+        return {
+            "replica_bytes": sum(n for _, _, n in replica),
+            "replica_seconds": seconds,
+            "overlapped_seconds": overlapped,
+            "in_gaps": 1.0 - overlapped / seconds if seconds > 0 else 1.0,
+            "collectives": len(collectives),
+        }
+
+    def export_chrome_trace(self, path, rank=0):
+        """Write the timeline as a Chrome trace (chrome://tracing, Perfetto), one track per event kind."""
+        with self.lock:
+            events = list(self.events)
+        origin = min((s for _, _, s, _, _ in events), default=0.0)
+        tracks = {"collective": 0, "replica": 1, "iteration": 2}
+        trace = []
+        for kind, name, start, end, nbytes in events:
+            trace.append({
+                "name": name,
+                "cat": kind,
+                "ph": "X" if end > start else "i",
+                "ts": (start - origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": rank,
+                "tid": tracks.get(kind, 3),
+                "args": {"bytes": nbytes},
+            })
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": trace}, f)
+
+
+class ReplicaScheduler:
+    """
+    Replicates this rank's host snapshot into peer ranks' CPU memory in the idle gaps of training.
+
+    Peers come from `rank_placement`. `replicate(chunks)` starts a background
+    exchange over a dedicated gloo group: sizes first, then the chunks, cut
+    into `piece_bytes` sends. A send is only issued while no collective is
+    running and the gap predicted by the timeline is long enough for it at
+    the measured bandwidth; after `max_delay` seconds it goes anyway so a
+    replica can't starve. The chunks must stay untouched until `wait`.
+    """
+
+    def __init__(self, timeline, ranks_per_node, replicas=1, strategy='mixed', piece_bytes=8 << 20,
+                 bandwidth=1e9, max_delay=1.0, group=None):
+        self.timeline = timeline
+        self.rank = dist.get_rank()
+        self.send_to, self.recv_from = rank_placement(self.rank, dist.get_world_size(), ranks_per_node, replicas,
+                                                      strategy)
+        # Every rank has to create the group, whether or not it has peers
+        self.group = group if group is not None else dist.new_group(backend='gloo')
+        self.piece_bytes = piece_bytes
+        self.bandwidth = bandwidth
+        self.max_delay = max_delay
+        self.replicas = {}
+        # Per source, the replica the last exchange replaced; the next exchange receives into it
+        self.spares = {}
+        self.thread = None
+        self.error = None
+        self.stats = None
+
+    @property
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def replicate(self, chunks):
+        self.wait()
+        views = [chunk.reshape(-1).view(torch.uint8) for chunk in chunks]
+        self.thread = threading.Thread(target=self._run, args=(views, ), name="gemini-replica", daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        """Block until the running replication is done; returns its stats."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return self.stats
+
+    def replica(self, src):
+        """
+        The chunks last fully received from rank `src`, or None.
+
+        They are left untouched by the exchange that follows, and are reused
+        as receive buffers by the one after that.
+        """
+        return self.replicas.get(src)
+
+    def _pieces(self, nbytes):
+        return [(start, min(self.piece_bytes, nbytes - start)) for start in range(0, nbytes, self.piece_bytes)]
+
+    def _wait_for_gap(self, nbytes):
+        needed = nbytes / self.bandwidth
+        deadline = time.time() + self.max_delay
+        while time.time() < deadline:
+            remaining = self.timeline.idle_remaining()
+            if remaining is None:
+                if self.timeline.active == 0:
+                    return
+            elif remaining >= needed:
+                return
+            time.sleep(0.0005)
+
+    def _exchange_sizes(self, views):
+        sizes = torch.tensor([len(views)] + [view.numel() for view in views], dtype=torch.int64)
+        works = [dist.isend(sizes[:1], dst, group=self.group, tag=_TAG_COUNT) for dst in self.send_to]
+        counts = {src: torch.zeros(1, dtype=torch.int64) for src in self.recv_from}
+        works += [dist.irecv(counts[src], src, group=self.group, tag=_TAG_COUNT) for src in self.recv_from]
+        for work in works:
+            work.wait()
+        works = [dist.isend(sizes[1:], dst, group=self.group, tag=_TAG_SIZES) for dst in self.send_to if len(views)]
+        remote = {src: torch.zeros(int(counts[src]), dtype=torch.int64) for src in self.recv_from}
+        works += [
+            dist.irecv(remote[src], src, group=self.group, tag=_TAG_SIZES) for src in self.recv_from if remote[src].numel()
+        ]
+        for work in works:
+            work.wait()
+        return {src: remote[src].tolist() for src in self.recv_from}
+
+    def _receive_buffers(self, src, sizes):
+        # Receive into the spare set, never the published replica, and reuse it when the layout did not change
+        spare = self.spares.pop(src, None)
+        if spare is not None and [chunk.numel() for chunk in spare] == sizes:
+            return spare
+        return [torch.empty(size, dtype=torch.uint8) for size in sizes]
+
+    def _run(self, views):
+        try:
+            start = time.time()
+            remote_sizes = self._exchange_sizes(views)
+            received = {}
+            recvs = []
+            for src, sizes in remote_sizes.items():
+                buffers = self._receive_buffers(src, sizes)
+                received[src] = buffers
+                tag = _TAG_CHUNK
+                for buffer in buffers:
+                    for offset, nbytes in self._pieces(buffer.numel()):
+                        recvs.append(dist.irecv(buffer[offset:offset + nbytes], src, group=self.group, tag=tag))
+                        tag += 1
+
+            sent = 0
+            tag = _TAG_CHUNK
+            for view in views:
+                for offset, nbytes in self._pieces(view.numel()):
+                    piece = view[offset:offset + nbytes]
+                    for dst in self.send_to:
+                        self._wait_for_gap(nbytes)
+                        send_start = time.time()
+                        dist.isend(piece, dst, group=self.group, tag=tag).wait()
+                        send_end = time.time()
+                        self.timeline.record("replica", f"to rank {dst}", send_start, send_end, nbytes)
+                        if send_end > send_start:
+                            self.bandwidth = 0.8 * self.bandwidth + 0.2 * nbytes / (send_end - send_start)
+                        sent += nbytes
+                    tag += 1
+            for work in recvs:
+                work.wait()
+            # Publish only complete replicas; the ones they replace become the spares
+            for src, buffers in received.items():
+                previous = self.replicas.get(src)
+                if previous is not None:
+                    self.spares[src] = previous
+                self.replicas[src] = buffers
+            self.stats = {"sent_bytes": sent, "seconds": time.time() - start, "bandwidth": self.bandwidth}
+        except Exception as e:
+            self.error = e
+
+
+def _simulate(rank, world_size, ranks_per_node, strategy, iterations, trace_dir):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29513')
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    timeline = CommTimeline()
+    timeline.instrument(dist)
+    scheduler = ReplicaScheduler(timeline, ranks_per_node, replicas=1, strategy=strategy, piece_bytes=1 << 20)
+    snapshot = [torch.full((4 << 20, ), rank, dtype=torch.uint8) for _ in range(4)]
+    params = torch.ones(1 << 20)
+    for iteration in range(iterations):
+        timeline.mark_iteration()
+        if iteration > 0 and not scheduler.busy:
+            scheduler.replicate(snapshot)
+        # Forward/backward: compute separated by all-gathers and reduce-scatters
+        for _ in range(4):
+            time.sleep(0.01)
+            dist.all_reduce(params)
+        time.sleep(0.02)
+    scheduler.wait()
+    for src in scheduler.recv_from:
+        assert all(bool((chunk == src).all()) for chunk in scheduler.replica(src)), f"bad replica from {src}"
+    summary = timeline.summary()
+    print(f"rank {rank}: sends to {scheduler.send_to}, holds {scheduler.recv_from}; "
+          f"{summary['replica_bytes'] / 1e6:.1f} MB replicated, {summary['in_gaps'] * 100:.1f}% of it in idle gaps")
+    timeline.export_chrome_trace(os.path.join(trace_dir, f"gemini_timeline_rank{rank}.json"), rank)
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    import sys
+    import torch.multiprocessing as mp
+    world_size = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    ranks_per_node = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    strategy = sys.argv[3] if len(sys.argv) > 3 else 'mixed'
+    mp.spawn(_simulate, args=(world_size, ranks_per_node, strategy, 20, '.'), nprocs=world_size)
@@ -3,6 +3,7 @@
 
 # DeepSpeed Team
 
+import os
 import sys
 import gc
 import collections
@@ -12,7 +13,6 @@ from deepspeed import comm as dist
 from deepspeed.utils import groups
 import time
 import threading  
-import torch.multiprocessing as mp
 
 from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 from deepspeed.runtime.base_optimizer import ZeROOptimizer
@@ -35,6 +35,11 @@ from deepspeed.accelerator import get_accelerator
 from deepspeed.utils import z3_leaf_parameter
 
 from collections import deque
+from .checkpoint_pipeline import CheckpointPipeline, gemini_config, DISK_INTERVAL, DISK_INTERVAL_DEFAULT, SAVE_DIR, \
+    SAVE_DIR_DEFAULT, REPLICAS, REPLICAS_DEFAULT, PLACEMENT, PLACEMENT_DEFAULT, REPLICA_PIECE_BYTES, \
+    REPLICA_PIECE_BYTES_DEFAULT
+from .chunk_stream import ChunkDiskWriter, SharedChunkAllocator
+from .replica_placement import CommTimeline, ReplicaScheduler
 
 # Toggle this to true to enable correctness test
 # with gradient partitioning and without
@@ -75,19 +80,12 @@ def move_to_cpu(tensor_list):
         tensor.data = tensor.data.cpu()
 
 
-def save_optimzier_to_disk(queue, rank, save_dir):
-    while True:
-        cpu_tensor_array = queue.get()
-        torch.save(cpu_tensor_array, save_dir + "optimizer_" + "rank" + str(rank) + ".pt")
-        print("rank{}: finish to save optimizer".format(rank))
-        sys.stdout.flush()
-        
-def save_module_to_disk(queue, rank, save_dir):
-    while True:
-        cpu_tensor_array = queue.get()
-        torch.save(cpu_tensor_array, save_dir + "model_" + "rank" + str(rank) + ".pt")
-        print("rank{}: finish to save module".format(rank))
-        sys.stdout.flush()
+def optimizer_disk_path(rank, save_dir):
+    return save_dir + "optimizer_" + "rank" + str(rank) + ".bin"
+
+
+def module_disk_path(rank, save_dir):
+    return save_dir + "model_" + "rank" + str(rank) + ".bin"
 
 
 def save_ckpt_to_disk_sync(module_cpu_tensor_array, optimizer_cpu_tensor_array, rank, save_dir):
@@ -478,12 +476,44 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         
         self.module_state_backup = {}
         
-        self.module_queue = mp.Queue()
-        self.optimizer_queue = mp.Queue()
-        # self.save_module_to_disk_process = mp.Process(target=save_module_to_disk, args=(self.module_queue, dist.get_rank(), "./checkpoint/"))
-        # self.save_optimzier_process = mp.Process(target=save_optimzier_to_disk, args=(self.optimizer_queue, dist.get_rank(), "./checkpoint/")) 
-        # self.save_module_to_disk_process.start()   
-        # self.save_optimzier_process.start()
+        # Disk workers stream the host chunks straight out of shared memory as the snapshot produces them
+        gemini_section = gemini_config(ds_config)
+        self.disk_interval = gemini_section.get(DISK_INTERVAL, DISK_INTERVAL_DEFAULT)
+        self.module_disk_writer = None
+        self.optimizer_disk_writer = None
+        self.module_host_alloc = None
+        self.optimizer_host_alloc = None
+        self.save_dir = gemini_section.get(SAVE_DIR, SAVE_DIR_DEFAULT)
+        if self.disk_interval:
+            rank = dist.get_rank()
+            save_dir = self.save_dir
+            os.makedirs(save_dir, exist_ok=True)
+            self.module_host_alloc = SharedChunkAllocator(f"gemini_model_rank{rank}_{os.getpid()}")
+            self.optimizer_host_alloc = SharedChunkAllocator(f"gemini_optimizer_rank{rank}_{os.getpid()}")
+            self.module_disk_writer = ChunkDiskWriter(module_disk_path(rank, save_dir))
+            self.optimizer_disk_writer = ChunkDiskWriter(optimizer_disk_path(rank, save_dir))
+
+        # Staging buffers and streams of the in-memory checkpoint, reused by every checkpoint
+        checkpoint_device = get_accelerator().current_device_name()
+        self.module_pipeline = CheckpointPipeline.from_config(ds_config, torch.float16, checkpoint_device,
+                                                              host_alloc=self.module_host_alloc)
+        self.optimizer_pipeline = CheckpointPipeline.from_config(ds_config, torch.float32, checkpoint_device,
+                                                                 host_alloc=self.optimizer_host_alloc)
+
+        # Snapshot replicas in peer CPU memory, sent in the gaps between the collectives of training
+        self.comm_timeline = None
+        self.replicator = None
+        replicas = gemini_section.get(REPLICAS, REPLICAS_DEFAULT)
+        if replicas:
+            self.comm_timeline = CommTimeline()
+            self.comm_timeline.instrument(dist)
+            ranks_per_node = int(os.environ.get('LOCAL_WORLD_SIZE', get_accelerator().device_count()))
+            self.replicator = ReplicaScheduler(self.comm_timeline, ranks_per_node, replicas=replicas,
+                                               strategy=gemini_section.get(PLACEMENT, PLACEMENT_DEFAULT),
+                                               piece_bytes=gemini_section.get(REPLICA_PIECE_BYTES,
+                                                                              REPLICA_PIECE_BYTES_DEFAULT))
+        # Whether the module and optimizer halves of the current iteration are snapshotted, see _decide_snapshot
+        self.snapshot_iteration = False
         
 
     def destroy(self):
@@ -494,6 +524,18 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
             hook.remove()
         print_rank_0("Removed grad acc hooks", force=False)
         del self.__ipg_bucket_flat_buffer
+        for writer in (self.module_disk_writer, self.optimizer_disk_writer):
+            if writer is not None:
+                writer.shutdown()
+        for alloc in (self.module_host_alloc, self.optimizer_host_alloc):
+            if alloc is not None:
+                alloc.close()
+        if self.replicator is not None:
+            self.replicator.wait()
+            os.makedirs(self.save_dir, exist_ok=True)
+            self.comm_timeline.export_chrome_trace(
+                os.path.join(self.save_dir, f"gemini_timeline_rank{dist.get_rank()}.json"), dist.get_rank())
+            self.comm_timeline.uninstrument()
 
     def initialize_ds_offload(
         self,
@@ -2103,380 +2145,90 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
     
     
     
-    def first_part_checkpoint_backward(self, model):
-        
-        stream_buffer = [torch.cuda.Stream() , torch.cuda.Stream()]
-
-
-        buffer_size = 32 * 1024 * 1024 // 2 
-
-        gpu_buffer = [ torch.empty(buffer_size, dtype=torch.float16, device=self.device),
-                        torch.empty(buffer_size, dtype=torch.float16, device=self.device) ]   
-        
-        cpu_buffer = [None, None]
-        cpu_tensor_array = []
-        numel = 0
-        total_size = 0
-        time = 0
-        index = 0
-        for key, value in model.state_dict().items():
-            saved_numel = 0
-            tensor_numel = value.numel()
-            total_size += tensor_numel
-            while saved_numel < tensor_numel:
-                tosave_numel = min(buffer_size - numel, tensor_numel - saved_numel)
-                gpu_buffer[index][numel : numel + tosave_numel] = value.view(-1)[saved_numel : saved_numel + tosave_numel]
-
-                saved_numel += tosave_numel
-                numel += tosave_numel
-                if numel == buffer_size:
-                    time += 1
-                    stream_buffer[index].synchronize()
-                    if cpu_buffer[index] != None:
-                        cpu_tensor_array.append(cpu_buffer[index])
-                        cpu_buffer[index] = None
-                    with torch.cuda.stream(stream_buffer[index]):
-                        cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-                    
-                    numel = 0
-                    index = (index + 1) % 2
-        if numel:
-            time += 1 
-            stream_buffer[index].synchronize()
-            if cpu_buffer[index] != None:
-                    cpu_tensor_array.append(cpu_buffer[index])
-                    cpu_buffer[index] = None
-            with torch.cuda.stream(stream_buffer[index]):
-                cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-            
-            saved_numel += tosave_numel
-            numel = 0
-            index = (index + 1) % 2
-        
-        stream_buffer[index].synchronize()
-        if cpu_buffer[index] != None:
-            cpu_tensor_array.append(cpu_buffer[index])
-            cpu_buffer[index] = None
-        
-        index = (index + 1) % 2
-
-        stream_buffer[index].synchronize()
-        if cpu_buffer[index] != None:
-            cpu_tensor_array.append(cpu_buffer[index])
-            cpu_buffer[index] = None
-            
-        
-        # print("model write times = ", time)
-        # print("model total size = ", total_size)
-        # print("model target write times = ", (total_size / buffer_size))
-        # print("model cpu tensor num = ", len(cpu_tensor_array))
-        
-    def first_part_checkpoint_backward_async(self, model_state_dict):
-
-        torch.cuda.set_device(dist.get_rank())
-
-        if model_state_dict == {}:
+    def _snapshot(self, pipeline, disk_writer, tensors):
+        if disk_writer is None:
+            return deque(pipeline.run(tensors))
+        # The host chunks are reused, so the previous on-disk checkpoint must be written out first
+        for done in disk_writer.wait():
+            if dist.get_rank() == 0:
+                print("persisted {}: {}".format(disk_writer.path, done))
+        if self.step_count <= 0 or self.step_count % self.disk_interval != 0:
+            return deque(pipeline.run(tensors))
+        disk_writer.begin(self.step_count)
+        chunks = pipeline.run(tensors, on_chunk=lambda chunk, name: disk_writer.chunk(name, chunk))
+        disk_writer.end()
+        return deque(chunks)
+
+    def _decide_snapshot(self):
+        # Taken once per iteration for both halves, and the same on every rank, so neither a rank's snapshot
+        # nor the replicas mix iterations; skipped while the host chunks are still being sent to peers
+        if self.replicator is None:
+            return True
+        free = torch.tensor([0 if self.replicator.busy else 1], dtype=torch.int32,
+                            device=get_accelerator().current_device_name())
+        dist.all_reduce(free, op=dist.ReduceOp.MIN)
+        return bool(free.item())
+
+    def _replicate(self):
+        self.comm_timeline.mark_iteration()
+        if self.replicator.busy:
             return
+        stats = self.replicator.wait()
+        if stats is not None and dist.get_rank() == 0 and self.step_count % 10 == 0:
+            summary = self.comm_timeline.summary()
+            print("replica to {}: {:.2f} GB in {:.4f}s, {:.1f}% of replica traffic in idle gaps".format(
+                self.replicator.send_to, stats["sent_bytes"] / 1e9, stats["seconds"], summary["in_gaps"] * 100))
+        if self.module_cpu_tensor_array or self.optimizer_cpu_tensor_array:
+            self.replicator.replicate(list(self.module_cpu_tensor_array) + list(self.optimizer_cpu_tensor_array))
 
-        stream_buffer = [torch.cuda.Stream() , torch.cuda.Stream()]
+    def first_part_checkpoint_backward(self, model):
+        self.module_pipeline.run(model.state_dict().values())
 
-        buffer_size = 32 * 1024 * 1024 // 2 
-        # gpu_tensor_1 = torch.zeros(buffer_size, dtype=torch.float32, device=self.device)
-        gpu_buffer = [ torch.empty(buffer_size, dtype=torch.float16, device=self.device),
-                        torch.empty(buffer_size, dtype=torch.float16, device=self.device) ]   
-        
-        cpu_buffer = [None, None]
-        cpu_tensor_array = deque()
-        # cpu_tensor_array = []
-        numel = 0
+    def _module_snapshot_tensors(self, model_state_dict):
         total_size = 0
-        time = 0
-        index = 0
-        # for key, value in model_state_dict.items():
-        #     saved_numel = 0
-        #     tensor_numel = value.numel()
-        #     total_size += tensor_numel
-        #     while saved_numel < tensor_numel:
-        #         tosave_numel = min(buffer_size - numel, tensor_numel - saved_numel)
-        #         gpu_buffer[index][numel : numel + tosave_numel] = value.view(-1)[saved_numel : saved_numel + tosave_numel]
-        #         saved_numel += tosave_numel
-        #         numel += tosave_numel
-        #         if numel == buffer_size:
-        #             time += 1
-        #             stream_buffer[index].synchronize()
-        #             if cpu_buffer[index] != None:
-        #                 cpu_tensor_array.append(cpu_buffer[index])
-        #                 cpu_buffer[index] = None
-        #             with torch.cuda.stream(stream_buffer[index]):
-        #                 cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-                    
-        #             numel = 0
-        #             index = (index + 1) % 2
-                    
-        # for key, value in model_state_dict.items():
-        #     saved_numel = 0
-        #     tensor_numel = value.numel()
-        #     total_size += tensor_numel
-        #     while saved_numel < tensor_numel:
-        #         tosave_numel = min(buffer_size - numel, tensor_numel - saved_numel)
-        #         gpu_buffer[index][numel : numel + tosave_numel] = value.view(-1)[saved_numel : saved_numel + tosave_numel]
-        #         saved_numel += tosave_numel
-        #         numel += tosave_numel
-        #         if numel == buffer_size:
-        #             time += 1
-        #             stream_buffer[index].synchronize()
-        #             if cpu_buffer[index] != None:
-        #                 cpu_tensor_array.append(cpu_buffer[index])
-        #                 cpu_buffer[index] = None
-        #             with torch.cuda.stream(stream_buffer[index]):
-        #                 cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-                    
-        #             numel = 0
-        #             index = (index + 1) % 2
-            
-        while True:         
+        while True:
             for key, value in model_state_dict.items():
-                    
                 # RoBERTa config
                 if total_size >= 3759661145:
                     break
-                saved_numel = 0
-                tensor_numel = value.numel()
-                total_size += tensor_numel
-                while saved_numel < tensor_numel:
-                    tosave_numel = min(buffer_size - numel, tensor_numel - saved_numel)
-                    gpu_buffer[index][numel : numel + tosave_numel] = value.view(-1)[saved_numel : saved_numel + tosave_numel]
-                    saved_numel += tosave_numel
-                    numel += tosave_numel
-                    if numel == buffer_size:
-                        time += 1
-                        stream_buffer[index].synchronize()
-                        if cpu_buffer[index] != None:
-                            cpu_tensor_array.append(cpu_buffer[index])
-                            cpu_buffer[index] = None
-                        with torch.cuda.stream(stream_buffer[index]):
-                            cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-                        
-                        numel = 0
-                        index = (index + 1) % 2
-                        
-            
+                total_size += value.numel()
+                yield value
             # RoBERTa config
             if total_size >= 3759661145:
                 break
-        if numel:
-            time += 1 
-            stream_buffer[index].synchronize()
-            if cpu_buffer[index] != None:
-                    cpu_tensor_array.append(cpu_buffer[index])
-                    cpu_buffer[index] = None
-            with torch.cuda.stream(stream_buffer[index]):
-                cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-            
-            saved_numel += tosave_numel
-            numel = 0
-            index = (index + 1) % 2
-        
-        stream_buffer[index].synchronize()
-        if cpu_buffer[index] != None:
-            cpu_tensor_array.append(cpu_buffer[index])
-            cpu_buffer[index] = None
-        
-        index = (index + 1) % 2
 
-        stream_buffer[index].synchronize()
-        if cpu_buffer[index] != None:
-            cpu_tensor_array.append(cpu_buffer[index])
-            cpu_buffer[index] = None
-        
-        
-        
-        self.module_cpu_tensor_array = cpu_tensor_array
+    def first_part_checkpoint_backward_async(self, model_state_dict):
 
+        torch.cuda.set_device(dist.get_rank())
 
-    def second_part_checkpoint_step(self, optimizer):
+        if model_state_dict == {} or not self.snapshot_iteration:
+            return
 
-        stream_buffer = [torch.cuda.Stream() , torch.cuda.Stream()]
+        self.module_cpu_tensor_array = self._snapshot(self.module_pipeline, self.module_disk_writer,
+                                                      self._module_snapshot_tensors(model_state_dict))
+        if dist.get_rank() == 0 and self.step_count % 10 == 0:
+            print("module ckpt pipeline: " + self.module_pipeline.format_stats())
 
+    def _optimizer_snapshot_tensors(self, optimizer):
+        for tensor, momentum in optimizer.state.items():
+            yield momentum['exp_avg']
+            yield momentum['exp_avg_sq']
 
-        buffer_size = 32 * 1024 * 1024 // 4  
-        # gpu_tensor_1 = torch.zeros(buffer_size, dtype=torch.float32, device=self.device)
-        gpu_buffer = [ torch.empty(buffer_size, dtype=torch.float32, device=self.device),
-                        torch.empty(buffer_size, dtype=torch.float32, device=self.device) ]   
-        
-        cpu_buffer = [None, None]
-        cpu_tensor_array = []
-        numel = 0
-        total_size = 0
-        time = 0
-        index = 0
+    def second_part_checkpoint_step(self, optimizer):
         if optimizer.state == {}:
             return
-        for tensor,  momentum in optimizer.state.items():
-            saved_numel = 0
-            exp_avg_numel = momentum['exp_avg'].numel()
-            total_size += exp_avg_numel
-            while saved_numel < exp_avg_numel:
-                tosave_numel = min(buffer_size - numel, exp_avg_numel - saved_numel)
-                gpu_buffer[index][numel : numel + tosave_numel] = momentum['exp_avg'][saved_numel : saved_numel + tosave_numel]
-                saved_numel += tosave_numel
-                numel += tosave_numel
-                if numel == buffer_size:
-                    time += 1
-                    stream_buffer[index].synchronize()
-                    if cpu_buffer[index] != None:
-                        cpu_tensor_array.append(cpu_buffer[index])
-                        cpu_buffer[index] = None
-                    with torch.cuda.stream(stream_buffer[index]):
-                        cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-                    
-                    numel = 0
-                    index = (index + 1) % 2
-
-            saved_numel = 0
-            exp_avg_sq_numel = momentum['exp_avg_sq'].numel()
-            total_size += exp_avg_sq_numel
-            while saved_numel < exp_avg_sq_numel:
-                tosave_numel = min(buffer_size - numel, exp_avg_sq_numel - saved_numel)
-                gpu_buffer[index][numel : numel + tosave_numel] = momentum['exp_avg_sq'][saved_numel : saved_numel + tosave_numel]
-                saved_numel += tosave_numel
-                numel += tosave_numel
-                if numel == buffer_size:
-                    time += 1
-                    stream_buffer[index].synchronize()
-                    if cpu_buffer[index] != None:
-                        cpu_tensor_array.append(cpu_buffer[index])
-                        cpu_buffer[index] = None
-                    with torch.cuda.stream(stream_buffer[index]):
-                        cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-                    
-                    numel = 0
-                    index = (index + 1) % 2
-        
-        if numel:
-            time += 1 
-            stream_buffer[index].synchronize()
-            if cpu_buffer[index] != None:
-                    cpu_tensor_array.append(cpu_buffer[index])
-                    cpu_buffer[index] = None
-            with torch.cuda.stream(stream_buffer[index]):
-                cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-            
-            saved_numel += tosave_numel
-            numel = 0
-            index = (index + 1) % 2
-            
-        stream_buffer[index].synchronize()
-        if cpu_buffer[index] != None:
-            cpu_tensor_array.append(cpu_buffer[index])
-            cpu_buffer[index] = None
-        
-        index = (index + 1) % 2
+        self.optimizer_pipeline.run(self._optimizer_snapshot_tensors(optimizer))
 
-        stream_buffer[index].synchronize()
-        if cpu_buffer[index] != None:
-            cpu_tensor_array.append(cpu_buffer[index])
-            cpu_buffer[index] = None
-        
-        # 
-        # print("optimizer write times = ", time)
-        # print("optimizer total size = ", total_size)
-        # print("optimizer target write times = ", (total_size / buffer_size))
-        # print("optimizer cpu tensor num = ", len(cpu_tensor_array))
-        # 
-    
     def second_part_checkpoint_step_async(self, optimizer):
         torch.cuda.set_device(dist.get_rank())
 
-        stream_buffer = [torch.cuda.Stream() , torch.cuda.Stream()]
-
-
-        buffer_size = 32 * 1024 * 1024 // 4  
-        # gpu_tensor_1 = torch.zeros(buffer_size, dtype=torch.float32, device=self.device)
-        gpu_buffer = [ torch.empty(buffer_size, dtype=torch.float32, device=self.device),
-                        torch.empty(buffer_size, dtype=torch.float32, device=self.device) ]   
-        
-        cpu_buffer = [None, None]
-        numel = 0
-        total_size = 0
-        time = 0
-        index = 0
-        cpu_tensor_array = deque()
-        # cpu_tensor_array = []
-        if optimizer.state == {}:
+        if optimizer.state == {} or not self.snapshot_iteration:
             return
-        for tensor,  momentum in optimizer.state.items():
-            saved_numel = 0
-            exp_avg_numel = momentum['exp_avg'].numel()
-            total_size += exp_avg_numel
-            while saved_numel < exp_avg_numel:
-                tosave_numel = min(buffer_size - numel, exp_avg_numel - saved_numel)
-                gpu_buffer[index][numel : numel + tosave_numel] = momentum['exp_avg'][saved_numel : saved_numel + tosave_numel]
-                saved_numel += tosave_numel
-                numel += tosave_numel
-                if numel == buffer_size:
-                    time += 1
-                    stream_buffer[index].synchronize()
-                    if cpu_buffer[index] != None:
-                        cpu_tensor_array.append(cpu_buffer[index])
-                        cpu_buffer[index] = None
-                    with torch.cuda.stream(stream_buffer[index]):
-                        cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-                    
-                    numel = 0
-                    index = (index + 1) % 2
-
-            saved_numel = 0
-            exp_avg_sq_numel = momentum['exp_avg_sq'].numel()
-            total_size += exp_avg_sq_numel
-            while saved_numel < exp_avg_sq_numel:
-                tosave_numel = min(buffer_size - numel, exp_avg_sq_numel - saved_numel)
-                gpu_buffer[index][numel : numel + tosave_numel] = momentum['exp_avg_sq'][saved_numel : saved_numel + tosave_numel]
-                saved_numel += tosave_numel
-                numel += tosave_numel
-                if numel == buffer_size:
-                    time += 1
-                    stream_buffer[index].synchronize()
-                    if cpu_buffer[index] != None:
-                        cpu_tensor_array.append(cpu_buffer[index])
-                        cpu_buffer[index] = None
-                    with torch.cuda.stream(stream_buffer[index]):
-                        cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-                    
-                    numel = 0
-                    index = (index + 1) % 2
-        
-        if numel:
-            time += 1 
-            stream_buffer[index].synchronize()
-            if cpu_buffer[index] != None:
-                    cpu_tensor_array.append(cpu_buffer[index])
-                    cpu_buffer[index] = None
-            with torch.cuda.stream(stream_buffer[index]):
-                cpu_buffer[index] = gpu_buffer[index].to('cpu', non_blocking=True)
-            
-            saved_numel += tosave_numel
-            numel = 0
-            index = (index + 1) % 2
-            
-        stream_buffer[index].synchronize()
-        if cpu_buffer[index] != None:
-            cpu_tensor_array.append(cpu_buffer[index])
-            cpu_buffer[index] = None
-        
-        index = (index + 1) % 2
-
-        stream_buffer[index].synchronize()
-        if cpu_buffer[index] != None:
-            cpu_tensor_array.append(cpu_buffer[index])
-            cpu_buffer[index] = None
-        
-        self.optimizer_cpu_tensor_array = cpu_tensor_array
+        self.optimizer_cpu_tensor_array = self._snapshot(self.optimizer_pipeline, self.optimizer_disk_writer,
+                                                         self._optimizer_snapshot_tensors(optimizer))
+        if dist.get_rank() == 0 and self.step_count % 10 == 0:
+            print("optimizer ckpt pipeline: " + self.optimizer_pipeline.format_stats())
         # queue.put(cpu_tensor_array)
-        # print("optimizer write times = ", time)
-        # print("optimizer total size = ", total_size)
-        # print("optimizer target write times = ", (total_size / buffer_size))
-        # print("optimizer cpu tensor num = ", len(cpu_tensor_array))
         
     
     
@@ -2499,13 +2251,12 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         if self.save_module_thread != None:
             # print("wait for module ckpt")
             self.save_module_thread.join()
+        if self.replicator is not None:
+            self._replicate()
             
         # if self.step_count == 40:
         #     save_dir = "./checkpoint/"
         #     save_ckpt_to_disk_sync(self.module_cpu_tensor_array, self.optimizer_cpu_tensor_array, dist.get_rank(), "./checkpoint/")
-        # if self.step_count == 40:
-        #     self.module_queue.put(self.module_cpu_tensor_array)
-        #     self.optimizer_queue.put(self.optimizer_cpu_tensor_array)
             
         """
             Not supporting closure.
@@ -2517,6 +2268,8 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
         if self._overflow_check_and_loss_scale_update():
             if self.swap_optimizer:
                 self.optimizer_swapper.log_timers()
+            # No module snapshot this iteration, so no optimizer half either
+            self.snapshot_iteration = False
             return
 
         norm_groups = self._get_norm_groups()
@@ -2572,6 +2325,8 @@ class DeepSpeedZeroOptimizer_Stage3(ZeROOptimizer):
                     alloc_retries - self.n_caching_allocator_flushes)
             self.n_caching_allocator_flushes = alloc_retries
             
+        # The optimizer half of this iteration, taken in the next backward, follows the same decision
+        self.snapshot_iteration = self._decide_snapshot()
         self.save_module_thread = threading.Thread(target=self.first_part_checkpoint_backward_async, args=(self.module_state_backup, ))
         self.save_module_thread.start()
         